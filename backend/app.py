@@ -11,6 +11,7 @@ import json
 from services.object_detection import ObjectDetectionService
 from services.feature_extraction import FeatureExtractionService
 from services.similarity_search import SimilaritySearchService
+from services.duplicate_finder import DuplicateFinder, DuplicateJob
 from services.image_manager import ImageManager
 from services.shape3d_features import Shape3DFeatureExtractor, Shape3DSimilaritySearch
 
@@ -25,8 +26,41 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 app.config['ALLOWED_3D_EXTENSIONS'] = {'obj'}
 app.config['MODEL_PATH'] = Path(__file__).parent.parent / 'models' / 'yolov8n_15classes_finetuned.pt'
-app.config['DATABASE_PATH'] = Path(__file__).parent / 'database' / 'features.json'
+app.config['DATABASE_PATH'] = Path(__file__).parent / 'database' / 'features.store'
 app.config['DATABASE_3D_PATH'] = Path(__file__).parent / 'database' / 'features_3d.json'
+app.config['IMAGE_CATALOG_PATH'] = Path(__file__).parent / 'database' / 'image_catalog.json'
+app.config['IMAGE_HASH_INDEX_PATH'] = Path(__file__).parent / 'database' / 'image_hashes.json'
+# Upload duplicate check: hash variant ('average', 'difference', 'perceptual') and
+# Hamming radius out of 64 bits (0 = identical hash only; ~8 with perceptual catches edited copies)
+app.config['IMAGE_DUPLICATE_HASH'] = 'average'
+app.config['IMAGE_DUPLICATE_RADIUS'] = 0
+# Upper bound of ?radius= on /api/images/<id>/near-duplicates
+app.config['IMAGE_MAX_DUPLICATE_RADIUS'] = 16
+# /api/images page size (default and upper bound of ?limit=)
+app.config['IMAGE_PAGE_SIZE'] = 60
+app.config['IMAGE_MAX_PAGE_SIZE'] = 500
+# Resized derivatives served by /api/images/file/<name>?w=<width>
+app.config['THUMBNAIL_FOLDER'] = app.config['UPLOAD_FOLDER'] / '.thumbnails'
+app.config['THUMBNAIL_SIZES'] = (128, 256, 512, 1024)  # ?w= is snapped up to one of these
+app.config['THUMBNAIL_FORMAT'] = 'webp'  # 'webp' or 'jpeg'
+app.config['THUMBNAIL_QUALITY'] = {'webp': 80, 'jpeg': 85}
+app.config['THUMBNAIL_PREGENERATE'] = (256,)  # Widths generated at upload (gallery tiles)
+app.config['SEARCH_ANN_INDEX'] = False  # Approximate candidate pruning for large galleries (changes rankings)
+app.config['SEARCH_ANN_MIN_ROWS'] = 2048
+app.config['SEARCH_PQ_INDEX'] = False  # Compressed codes for very large (10M+) galleries
+app.config['SEARCH_PQ_SHORTLIST'] = 1000
+app.config['FEATURE_SPILL_DIR'] = None  # e.g. database/spill to keep features on disk
+app.config['SEARCH_CASCADE_SIZE'] = 0  # Candidates kept by the cheap first stage, 0 = off
+app.config['SEARCH_CACHE_SIZE'] = 256  # Cached search results, 0 = off
+app.config['SEARCH_CACHE_TTL'] = 300  # Seconds
+app.config['SEARCH_HISTOGRAM_EMBEDDING'] = None  # None (exact chi-square), 'hellinger' or 'additive_chi2'
+app.config['SEARCH_FUSED_INDEX'] = False  # One-matvec ranking for default-weight queries
+app.config['SEARCH_FUSED_SHORTLIST'] = 500
+app.config['SEARCH_SCORE_CACHE_SIZE'] = 32  # Searches kept for re-weighting by query_token, 0 = off
+app.config['SEARCH_SHARDS'] = 1  # Slices scored in parallel per search, 1 = single-threaded
+app.config['SEARCH_WORKERS'] = None  # Scoring threads, None = one per shard
+app.config['SEARCH_NEIGHBOUR_GRAPH'] = False  # Background top-K lists for "more like this"
+app.config['SEARCH_GRAPH_NEIGHBOURS'] = 50
 
 # Create necessary directories
 app.config['UPLOAD_FOLDER'].mkdir(parents=True, exist_ok=True)
@@ -36,8 +70,40 @@ app.config['3D_MODELS_FOLDER'].mkdir(parents=True, exist_ok=True)
 # Initialize services
 detection_service = ObjectDetectionService(str(app.config['MODEL_PATH']))
 feature_service = FeatureExtractionService()
-similarity_service = SimilaritySearchService(str(app.config['DATABASE_PATH']))
-image_manager = ImageManager(str(app.config['UPLOAD_FOLDER']))
+similarity_service = SimilaritySearchService(
+    str(app.config['DATABASE_PATH']),
+    ann_index=app.config['SEARCH_ANN_INDEX'],
+    ann_min_rows=app.config['SEARCH_ANN_MIN_ROWS'],
+    pq_index=app.config['SEARCH_PQ_INDEX'],
+    pq_shortlist=app.config['SEARCH_PQ_SHORTLIST'],
+    feature_spill_dir=app.config['FEATURE_SPILL_DIR'],
+    cascade_size=app.config['SEARCH_CASCADE_SIZE'],
+    result_cache_size=app.config['SEARCH_CACHE_SIZE'],
+    result_cache_ttl=app.config['SEARCH_CACHE_TTL'],
+    histogram_embedding=app.config['SEARCH_HISTOGRAM_EMBEDDING'],
+    fused_index=app.config['SEARCH_FUSED_INDEX'],
+    fused_shortlist=app.config['SEARCH_FUSED_SHORTLIST'],
+    score_cache_size=app.config['SEARCH_SCORE_CACHE_SIZE'],
+    search_shards=app.config['SEARCH_SHARDS'],
+    search_workers=app.config['SEARCH_WORKERS'],
+    neighbour_graph=app.config['SEARCH_NEIGHBOUR_GRAPH'],
+    graph_neighbours=app.config['SEARCH_GRAPH_NEIGHBOURS']
+)
+image_manager = ImageManager(
+    str(app.config['UPLOAD_FOLDER']), similarity_service,
+    catalog_path=app.config['IMAGE_CATALOG_PATH'],
+    hash_index_path=app.config['IMAGE_HASH_INDEX_PATH'],
+    duplicate_hash=app.config['IMAGE_DUPLICATE_HASH'],
+    duplicate_radius=app.config['IMAGE_DUPLICATE_RADIUS'],
+    thumbnail_folder=app.config['THUMBNAIL_FOLDER'],
+    thumbnail_sizes=app.config['THUMBNAIL_SIZES'],
+    thumbnail_format=app.config['THUMBNAIL_FORMAT'],
+    thumbnail_quality=app.config['THUMBNAIL_QUALITY'],
+    pregenerate_thumbnails=app.config['THUMBNAIL_PREGENERATE']
+)
+duplicate_finder = DuplicateFinder(similarity_service)
+duplicate_jobs = {}  # job_id -> DuplicateJob (most recent MAX_DUPLICATE_JOBS kept)
+MAX_DUPLICATE_JOBS = 20
 shape3d_extractor = Shape3DFeatureExtractor()
 shape3d_similarity = Shape3DSimilaritySearch(str(app.config['DATABASE_3D_PATH']))
 
@@ -48,6 +114,47 @@ def allowed_3d_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_3D_EXTENSIONS']
 
 
+def keep_existing_images(similar_objects, top_k):
+    """Drop results whose image file is gone and add filenames (first top_k kept)"""
+    valid_results = []
+    for obj in similar_objects:
+        image_info = image_manager.get_image(obj['image_id'])
+        if image_info:  # Only include if image file still exists
+            obj['filename'] = image_info['filename']
+            valid_results.append(obj)
+            if len(valid_results) >= top_k:  # Stop when we have enough valid results
+                break
+    return valid_results
+
+def search_existing_images(query_features, query_class, query_image_id, query_object_id,
+                           top_k, **options):
+    """
+    find_similar restricted to images whose file still exists
+    
+    Asks for exactly top_k and only widens the search when some results
+    point at deleted image files. Returns (results, search stats).
+    """
+    fetch_k = top_k
+    while True:
+        search_stats = {}
+        similar_objects = similarity_service.find_similar(
+            query_features=query_features,
+            query_class=query_class,
+            top_k=fetch_k,
+            exclude_image_id=query_image_id,
+            same_class_only=True,
+            stats=search_stats,
+            query_key=(query_image_id, query_object_id),
+            **options
+        )
+        
+        # ✅ FILTER OUT MISSING IMAGES & ADD FILENAME
+        valid_results = keep_existing_images(similar_objects, top_k)
+        if len(valid_results) >= top_k or len(similar_objects) < fetch_k:
+            return valid_results, search_stats
+        fetch_k *= 2
+
+
 # REST API Resources
 class ImageUpload(Resource):
     """Upload single or multiple images"""
@@ -56,21 +163,63 @@ class ImageUpload(Resource):
             return {'error': 'No images provided'}, 400
         
         files = request.files.getlist('images')
-        results = []
+        valid_files = [file for file in files if file and allowed_file(file.filename)]
         
-        for file in files:
-            if file and allowed_file(file.filename):
-                result = image_manager.save_image(file)
-                results.append(result)
+        # One batched duplicate check for the whole upload
+        results = image_manager.save_images(valid_files)
         
         return {'uploaded': results}, 201
 
 
 class ImageList(Resource):
-    """Get all images or delete multiple"""
+    """List images (paginated) or delete multiple"""
     def get(self):
-        images = image_manager.get_all_images()
-        return {'images': images}, 200
+        """
+        Query parameters:
+            limit: Page size (default IMAGE_PAGE_SIZE)
+            cursor: next_cursor of the previous page
+            sort: 'newest' (default) or 'oldest' upload time first
+            class: Only images with a detection of this class
+            has_features: 'true' / 'false'
+        """
+        try:
+            limit = int(request.args.get('limit', app.config['IMAGE_PAGE_SIZE']))
+        except ValueError:
+            return {'error': 'limit must be an integer'}, 400
+        if limit < 1:
+            return {'error': 'limit must be positive'}, 400
+        limit = min(limit, app.config['IMAGE_MAX_PAGE_SIZE'])
+        
+        sort = request.args.get('sort', 'newest')
+        if sort not in ('newest', 'oldest'):
+            return {'error': "sort must be 'newest' or 'oldest'"}, 400
+        cursor = request.args.get('cursor') or None
+        class_name = request.args.get('class') or None
+        has_features = request.args.get('has_features')
+        if has_features is not None:
+            if has_features.lower() not in ('true', 'false', '1', '0'):
+                return {'error': "has_features must be 'true' or 'false'"}, 400
+            has_features = has_features.lower() in ('true', '1')
+        
+        # ✅ CONDITIONAL GET - Unchanged pages are answered before being built
+        etag = image_manager.listing_tag(
+            limit, cursor, sort, class_name, has_features,
+            features=class_name is not None or has_features is not None
+        )
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        
+        try:
+            page = image_manager.list_images(
+                limit=limit, cursor=cursor, newest_first=sort == 'newest',
+                class_name=class_name, has_features=has_features
+            )
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        # no-cache: the browser keeps the page but revalidates it with If-None-Match
+        return page, 200, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
     
     def delete(self):
         """Delete multiple images"""
@@ -95,6 +244,30 @@ class ImageDetail(Resource):
         return {'message': 'Image deleted successfully'}, 200
 
 
+class ImageNearDuplicates(Resource):
+    """Stored images whose hash is within a Hamming radius of an image's"""
+    def get(self, image_id):
+        """
+        Query parameters:
+            radius: Hamming distance in bits (default IMAGE_DUPLICATE_RADIUS)
+        """
+        try:
+            radius = int(request.args.get('radius', app.config['IMAGE_DUPLICATE_RADIUS']))
+        except ValueError:
+            return {'error': 'radius must be an integer'}, 400
+        max_radius = app.config['IMAGE_MAX_DUPLICATE_RADIUS']
+        if not 0 <= radius <= max_radius:
+            return {'error': f'radius must be between 0 and {max_radius}'}, 400
+        
+        if image_manager.get_image(image_id) is None:
+            return {'error': 'Image not found'}, 404
+        return {
+            'image_id': image_id,
+            'radius': radius,
+            'duplicates': image_manager.find_near_duplicates(image_id, radius)
+        }, 200
+
+
 class ImageTransform(Resource):
     """Apply transformations to images (crop, resize, rotate)"""
     def post(self, image_id):
@@ -140,15 +313,17 @@ class ObjectDetectBatch(Resource):
         image_ids = data.get('image_ids', [])
         
         results = []
-        for image_id in image_ids:
-            image_path = image_manager.get_image_path(image_id)
-            if image_path:
-                detections = detection_service.detect(image_path)
-                similarity_service.save_detections(image_id, detections)
-                results.append({
-                    'image_id': image_id,
-                    'detections': detections
-                })
+        # One atomic write for the whole batch
+        with similarity_service.batch():
+            for image_id in image_ids:
+                image_path = image_manager.get_image_path(image_id)
+                if image_path:
+                    detections = detection_service.detect(image_path)
+                    similarity_service.save_detections(image_id, detections)
+                    results.append({
+                        'image_id': image_id,
+                        'detections': detections
+                    })
         
         return {'results': results}, 200
 
@@ -194,25 +369,27 @@ class FeatureExtractBatch(Resource):
         image_ids = data.get('image_ids', [])
         
         results = []
-        for image_id in image_ids:
-            image_path = image_manager.get_image_path(image_id)
-            if not image_path:
-                continue
-            
-            detections = similarity_service.get_detections(image_id)
-            if not detections:
-                continue
-            
-            for obj_idx, detection in enumerate(detections):
-                bbox = detection['bbox']
-                features = feature_service.extract_all_features(image_path, bbox)
-                similarity_service.save_features(image_id, obj_idx, features)
-                results.append({
-                    'image_id': image_id,
-                    'object_id': obj_idx,
-                    'class': detection['class'],
-                    'confidence': detection['confidence']
-                })
+        # One atomic write for the whole batch
+        with similarity_service.batch():
+            for image_id in image_ids:
+                image_path = image_manager.get_image_path(image_id)
+                if not image_path:
+                    continue
+                
+                detections = similarity_service.get_detections(image_id)
+                if not detections:
+                    continue
+                
+                for obj_idx, detection in enumerate(detections):
+                    bbox = detection['bbox']
+                    features = feature_service.extract_all_features(image_path, bbox)
+                    similarity_service.save_features(image_id, obj_idx, features)
+                    results.append({
+                        'image_id': image_id,
+                        'object_id': obj_idx,
+                        'class': detection['class'],
+                        'confidence': detection['confidence']
+                    })
         
         return {'processed': results}, 200
 
@@ -225,6 +402,11 @@ class SimilaritySearch(Resource):
         query_object_id = data.get('query_object_id')
         top_k = data.get('top_k', 10)
         weights = data.get('weights', None)
+        ann_probes = data.get('ann_probes', None)  # ANN recall/latency knob, 0 = exact
+        cascade_size = data.get('cascade_size', None)  # Coarse-stage survivors, 0 = off
+        query_token = data.get('query_token', None)  # From an earlier reweightable search
+        reweightable = data.get('reweightable', False) or query_token is not None
+        live_scan = data.get('live_scan', False)  # Bypass the neighbour graph
         
         if not query_image_id or query_object_id is None:
             return {'error': 'query_image_id and query_object_id required'}, 400
@@ -239,31 +421,106 @@ class SimilaritySearch(Resource):
         
         query_class = detections[query_object_id]['class']
         
-        similar_objects = similarity_service.find_similar(
-            query_features=query_features,
-            query_class=query_class,
-            top_k=top_k * 2,  # Get more results to filter
-            weights=weights,
-            exclude_image_id=query_image_id,
-            same_class_only=True
+        valid_results, search_stats = search_existing_images(
+            query_features, query_class, query_image_id, query_object_id, top_k,
+            weights=weights, ann_probes=ann_probes, cascade_size=cascade_size,
+            query_token=query_token, keep_scores=reweightable, live_scan=live_scan
         )
         
-        # ✅ FILTER OUT MISSING IMAGES & ADD FILENAME
-        valid_results = []
-        for obj in similar_objects:
-            image_info = image_manager.get_image(obj['image_id'])
-            if image_info:  # Only include if image file still exists
-                obj['filename'] = image_info['filename']
-                valid_results.append(obj)
-                if len(valid_results) >= top_k:  # Stop when we have enough valid results
-                    break
-        
-        return {
+        response = {
             'query_image_id': query_image_id,
             'query_object_id': query_object_id,
             'query_class': query_class,
             'similar_objects': valid_results
-        }, 200
+        }
+        if 'query_token' in search_stats:
+            # Send back with new weights to re-rank without a rescan
+            response['query_token'] = search_stats.pop('query_token')
+        response['candidates_evaluated'] = search_stats
+        return response, 200
+
+class SimilaritySearchBatch(Resource):
+    """Search for objects similar to many query objects in one pass"""
+    def post(self):
+        data = request.get_json()
+        queries = data.get('queries', [])  # [{query_image_id, query_object_id}, ...]
+        image_ids = data.get('image_ids', [])  # Every object of these images
+        top_k = data.get('top_k', 10)
+        weights = data.get('weights', None)
+        
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1:
+            return {'error': 'top_k must be a positive integer'}, 400
+        if not isinstance(queries, list) or not isinstance(image_ids, list) \
+                or not all(isinstance(image_id, str) for image_id in image_ids):
+            return {'error': 'queries must be a list and image_ids a list of strings'}, 400
+        for query in queries:
+            if not isinstance(query, dict):
+                return {'error': 'every query must be an object'}, 400
+            query_image_id = query.get('query_image_id')
+            if query_image_id is not None and not isinstance(query_image_id, str):
+                return {'error': 'query_image_id must be a string'}, 400
+            query_object_id = query.get('query_object_id')
+            if query_object_id is not None and (
+                    isinstance(query_object_id, bool) or not isinstance(query_object_id, int)
+                    or query_object_id < 0):
+                return {'error': 'query_object_id must be a non-negative integer'}, 400
+        
+        for image_id in image_ids:
+            for obj_idx, _ in enumerate(similarity_service.get_detections(image_id) or []):
+                queries.append({'query_image_id': image_id, 'query_object_id': obj_idx})
+        
+        if not queries:
+            return {'error': 'queries or image_ids required'}, 400
+        
+        valid_queries = []
+        errors = []
+        for query in queries:
+            query_image_id = query.get('query_image_id')
+            query_object_id = query.get('query_object_id')
+            if not query_image_id or query_object_id is None:
+                errors.append({**query, 'error': 'query_image_id and query_object_id required'})
+                continue
+            
+            detections = similarity_service.get_detections(query_image_id)
+            if not detections or query_object_id >= len(detections):
+                errors.append({**query, 'error': 'Detection not found'})
+                continue
+            
+            query_features = similarity_service.get_features(query_image_id, query_object_id)
+            if not query_features:
+                errors.append({**query, 'error': 'Features not found. Extract features first.'})
+                continue
+            
+            valid_queries.append({
+                'query_image_id': query_image_id,
+                'query_object_id': query_object_id,
+                'features': query_features,
+                'class': detections[query_object_id]['class'],
+                'exclude_image_id': query_image_id
+            })
+        
+        # ✅ ONE PASS - Q x N scoring per class partition
+        batch_results = similarity_service.find_similar_batch(
+            valid_queries, top_k=top_k, weights=weights, same_class_only=True
+        )
+        
+        results = []
+        for query, similar_objects in zip(valid_queries, batch_results):
+            valid_results = keep_existing_images(similar_objects, top_k)
+            if len(valid_results) < top_k and len(similar_objects) == top_k:
+                # Some results point at deleted files: widen this query alone
+                valid_results, _ = search_existing_images(
+                    query['features'], query['class'], query['query_image_id'],
+                    query['query_object_id'], top_k, weights=weights
+                )
+            results.append({
+                'query_image_id': query['query_image_id'],
+                'query_object_id': query['query_object_id'],
+                'query_class': query['class'],
+                'similar_objects': valid_results
+            })
+        
+        return {'results': results, 'errors': errors}, 200
 
 class FeatureVisualize(Resource):
     """Get formatted features for visualization"""
@@ -282,6 +539,42 @@ class FeatureVisualize(Resource):
         }, 200
 
 
+class DuplicateSearch(Resource):
+    """Start a near-duplicate self-join over the whole database"""
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        threshold = data.get('threshold', 0.95)  # Minimum visual similarity of a pair
+        classes = data.get('classes', None)  # Only these class partitions
+        same_image = data.get('same_image', False)  # Also pair objects of one image
+        
+        if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) \
+                or not 0.0 < threshold <= 1.0:
+            return {'error': 'threshold must be in (0, 1]'}, 400
+        if classes is not None and (not isinstance(classes, list)
+                                    or not all(isinstance(name, str) for name in classes)):
+            return {'error': 'classes must be a list of class names'}, 400
+        if not isinstance(same_image, bool):
+            return {'error': 'same_image must be a boolean'}, 400
+        
+        job = DuplicateJob(
+            duplicate_finder, threshold=threshold, class_names=classes, same_image=same_image
+        ).start()
+        duplicate_jobs[job.job_id] = job
+        while len(duplicate_jobs) > MAX_DUPLICATE_JOBS:
+            duplicate_jobs.pop(next(iter(duplicate_jobs)))
+        
+        return job.to_dict(), 202
+
+
+class DuplicateStatus(Resource):
+    """Progress (and clusters once done) of a near-duplicate job"""
+    def get(self, job_id):
+        job = duplicate_jobs.get(job_id)
+        if job is None:
+            return {'error': 'Job not found'}, 404
+        return job.to_dict(), 200
+
+
 class DatabaseStats(Resource):
     """Get database statistics"""
     def get(self):
@@ -512,12 +805,16 @@ api.add_resource(ImageUpload, '/api/images/upload')
 api.add_resource(ImageList, '/api/images')
 api.add_resource(ImageDetail, '/api/images/<string:image_id>')
 api.add_resource(ImageTransform, '/api/images/<string:image_id>/transform')
+api.add_resource(ImageNearDuplicates, '/api/images/<string:image_id>/near-duplicates')
 api.add_resource(ObjectDetect, '/api/detect')
 api.add_resource(ObjectDetectBatch, '/api/detect/batch')
 api.add_resource(FeatureExtract, '/api/features/extract')
 api.add_resource(FeatureExtractBatch, '/api/features/extract/batch')
 api.add_resource(SimilaritySearch, '/api/search/similar')
+api.add_resource(SimilaritySearchBatch, '/api/search/similar/batch')
 api.add_resource(FeatureVisualize, '/api/features/<string:image_id>/<int:object_id>')
+api.add_resource(DuplicateSearch, '/api/duplicates')
+api.add_resource(DuplicateStatus, '/api/duplicates/<string:job_id>')
 api.add_resource(DatabaseStats, '/api/stats')
 
 # 3D Model API routes
@@ -532,7 +829,38 @@ api.add_resource(Model3DStats, '/api/3d/stats')
 # Serve uploaded images
 @app.route('/api/images/file/<path:filename>')
 def serve_image(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """
+    Serve an uploaded image, or a resized derivative of it
+    
+    Query parameters (derivatives only):
+        w: Width in pixels (snapped up to THUMBNAIL_SIZES, never upscaled)
+        format: 'webp' or 'jpeg' (default THUMBNAIL_FORMAT)
+        q: Quality 1-100 (default THUMBNAIL_QUALITY)
+    """
+    if 'w' not in request.args:
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    
+    try:
+        width = int(request.args['w'])
+        quality = int(request.args['q']) if 'q' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'w and q must be integers'}), 400
+    if width < 1:
+        return jsonify({'error': 'w must be positive'}), 400
+    if quality is not None and not 1 <= quality <= 100:
+        return jsonify({'error': 'q must be between 1 and 100'}), 400
+    fmt = request.args.get('format', app.config['THUMBNAIL_FORMAT'])
+    if fmt not in ('webp', 'jpeg'):
+        return jsonify({'error': "format must be 'webp' or 'jpeg'"}), 400
+    
+    image_id = Path(filename).stem
+    image_info = image_manager.get_image(image_id)
+    if not image_info or image_info['filename'] != filename:
+        return jsonify({'error': 'Image not found'}), 404
+    thumbnail = image_manager.get_thumbnail(image_id, width, fmt=fmt, quality=quality)
+    if thumbnail is None:
+        return jsonify({'error': 'Image could not be decoded'}), 500
+    return send_from_directory(thumbnail.parent, thumbnail.name)
 
 
 # Serve 3D model files
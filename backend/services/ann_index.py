@@ -0,0 +1,375 @@
+"""
+Approximate Nearest-Neighbour Index for the CBIR System
+Inverted-file (IVF) indexes over HOG and colour-histogram descriptors,
+used to pick a candidate set that is then re-ranked exactly
+"""
+
+import threading
+
+import numpy as np
+from pathlib import Path
+
+
+def kmeans(vectors, n_clusters, iterations=10, seed=0):
+    """
+    Plain Lloyd's k-means on NumPy
+
+    Args:
+        vectors: (N, D) float32 array
+        n_clusters: Number of centroids
+        iterations: Number of assignment / update rounds
+        seed: Random seed for the initial centroids
+
+    Returns:
+        (n_clusters, D) float32 centroids
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        # Empty clusters keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+
+    return centroids.astype(np.float32)
+
+
+def nearest_centroids(vectors, centroids, n=1, block_size=4096):
+    """
+    Indices of the n nearest centroids (squared L2) for every vector
+
+    Works through vectors in blocks so the distance matrix stays bounded.
+    Returns shape (N,) when n == 1, else (N, n).
+    """
+    n = min(n, len(centroids))
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    result = np.empty((len(vectors), n), dtype=np.int64)
+
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        # ||v||^2 is constant per row, so it does not change the ranking
+        distances = centroid_norms[None, :] - 2.0 * block @ centroids.T
+        if n == 1:
+            result[start:start + len(block), 0] = np.argmin(distances, axis=1)
+        else:
+            result[start:start + len(block)] = np.argpartition(distances, n - 1, axis=1)[:, :n]
+
+    return result[:, 0] if n == 1 else result
+
+
+class IVFIndex:
+    """
+    Inverted-file index over one descriptor
+
+    Vectors are bucketed by their nearest k-means centroid. A query probes
+    the n_probe closest buckets and returns their labels; more probes means
+    higher recall and more candidates to re-rank.
+    """
+
+    def __init__(self, centroids=None):
+        self.centroids = None
+        self.lists = []
+        self.assignment = {}
+        if centroids is not None:
+            self.set_centroids(centroids)
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def set_centroids(self, centroids):
+        """Install centroids and drop all assignments"""
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.lists = [set() for _ in range(len(self.centroids))]
+        self.assignment = {}
+
+    def train(self, vectors, n_lists):
+        """Learn centroids from a sample of vectors"""
+        self.set_centroids(kmeans(vectors, n_lists))
+
+    def add(self, labels, vectors):
+        """Insert (or move) labels into their nearest bucket"""
+        if not self.is_trained() or len(labels) == 0:
+            return
+        for label, bucket in zip(labels, nearest_centroids(vectors, self.centroids)):
+            self.remove(label)
+            self.lists[bucket].add(int(label))
+            self.assignment[int(label)] = int(bucket)
+
+    def remove(self, label):
+        """Remove a label (no-op if absent)"""
+        bucket = self.assignment.pop(int(label), None)
+        if bucket is not None:
+            self.lists[bucket].discard(int(label))
+
+    def probe(self, query, n_probe):
+        """Labels stored in the n_probe buckets closest to the query"""
+        buckets = nearest_centroids(query[None, :], self.centroids, n_probe)[0]
+        labels = [label for bucket in np.atleast_1d(buckets) for label in self.lists[bucket]]
+        return np.array(labels, dtype=np.int64)
+
+
+class ANNIndex:
+    """
+    Candidate generator over a FeatureStore
+
+    Keeps one IVF index over unit-normalized HOG vectors and one over
+    square-rooted RGB histograms (Hellinger embedding, so L2 tracks the
+    histogram distance). Both are updated incrementally through the store's
+    row listener. Centroids are persisted next to the database; bucket
+    assignments are rebuilt from them on startup.
+
+    Training never runs inside a search: a background thread (start())
+    trains once the gallery reaches min_train_rows and retrains after it
+    quadrupled, holding the store lock only to copy descriptors and to
+    install the result. Until then searches stay exact.
+    """
+
+    DESCRIPTORS = {
+        'shape_hog': 'shape_hog.hog',
+        'color': 'color.hist_rgb'
+    }
+
+    def __init__(self, store, path, min_train_rows=2048, default_probes=16):
+        """
+        Args:
+            store: FeatureStore to index
+            path: File for persisted centroids (e.g. database/features.ann.npz)
+            min_train_rows: Below this many objects searches stay exact
+            default_probes: Buckets probed per descriptor when a request does not say
+        """
+        self.store = store
+        self.path = Path(path)
+        self.min_train_rows = min_train_rows
+        self.default_probes = default_probes
+        self.indexes = {name: IVFIndex() for name in self.DESCRIPTORS}
+        self.dims = {}
+        self.trained_rows = 0
+        # Rows the indexes cannot place (missing or odd-sized descriptor)
+        self.unindexed = set()
+        # Rows changed while a training run works outside the lock
+        self.dirty = None
+        self.training = threading.Lock()
+
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+        self._load()
+        store.add_listener(self._on_store_change)
+
+    # ------------------------------------------------------------------
+    # Descriptors
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _transform(name, vectors):
+        """Map raw descriptors into the space the index measures L2 in"""
+        if name == 'color':
+            return np.sqrt(np.maximum(vectors, 0.0))
+        # HOG vectors are stored (and encoded) unit-normalized already
+        return vectors
+
+    def _descriptors(self, name, rows, dim=None):
+        """Indexable vectors for rows, plus the mask of rows that have one"""
+        field = self.DESCRIPTORS[name]
+        dim = self.dims[name] if dim is None else dim
+        valid = self.store.lengths[field][rows] == dim
+        vectors = self.store.vectors[field][rows[valid], :dim]
+        return self._transform(name, vectors), valid
+
+    def _query_descriptor(self, name, query):
+        vector = query['vectors'].get(self.DESCRIPTORS[name])
+        if vector is None or len(vector) != self.dims.get(name):
+            return None
+        return self._transform(name, vector[None, :])[0]
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+
+    def is_trained(self):
+        return all(index.is_trained() for index in self.indexes.values())
+
+    def _index_rows(self, rows):
+        """(Re)assign rows to buckets of every descriptor index"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0 or not self.is_trained():
+            return
+        for name, index in self.indexes.items():
+            vectors, valid = self._descriptors(name, rows)
+            for row in rows[~valid]:
+                index.remove(row)
+            index.add(rows[valid], vectors)
+            self.unindexed.update(int(row) for row in rows[~valid])
+        indexed_everywhere = [
+            int(row) for row in rows
+            if all(int(row) in index.assignment for index in self.indexes.values())
+        ]
+        self.unindexed.difference_update(indexed_everywhere)
+
+    def _on_store_change(self, event, row):
+        if self.dirty is not None:
+            self.dirty.add(int(row))
+        if event == 'upsert':
+            self.wakeup.set()
+        if not self.is_trained():
+            return
+        if event == 'remove':
+            for index in self.indexes.values():
+                index.remove(row)
+            self.unindexed.discard(int(row))
+        elif event == 'upsert':
+            self._index_rows([row])
+
+    def train(self):
+        """
+        Learn centroids from the current gallery and index every row
+
+        k-means and the bucket assignment run on copies of the descriptors
+        without the store lock; rows changed in the meantime are re-indexed
+        when the new indexes are installed. A call made while another
+        training run is in progress returns at once.
+
+        Returns:
+            True when the index can be used
+        """
+        if not self.training.acquire(blocking=False):
+            return self.is_ready()
+        try:
+            return self._train()
+        finally:
+            self.training.release()
+
+    def _train(self):
+        with self.store.lock:
+            rows = self.store.live_rows()
+            n_lists = max(1, int(np.sqrt(len(rows))))
+            rng = np.random.default_rng(0)
+            sample = rows if len(rows) <= 64 * n_lists else \
+                np.sort(rng.choice(rows, 64 * n_lists, replace=False))
+
+            dims, samples, descriptors = {}, {}, {}
+            for name, field in self.DESCRIPTORS.items():
+                lengths = self.store.lengths[field][sample]
+                lengths = lengths[lengths > 0]
+                if len(lengths) == 0:
+                    return False
+                dims[name] = int(np.bincount(lengths).argmax())
+                samples[name] = self._descriptors(name, sample, dims[name])[0]
+                descriptors[name] = self._descriptors(name, rows, dims[name])
+            self.dirty = set()
+
+        indexes = {}
+        unindexed = set()
+        for name in self.DESCRIPTORS:
+            index = IVFIndex()
+            index.train(samples[name], n_lists)
+            vectors, valid = descriptors[name]
+            index.add(rows[valid], vectors)
+            indexes[name] = index
+            unindexed.update(int(row) for row in rows[~valid])
+
+        with self.store.lock:
+            self.dims = dims
+            self.indexes = indexes
+            self.trained_rows = len(rows)
+            self.unindexed = unindexed
+            dirty, self.dirty = self.dirty, None
+            for row in dirty:
+                for index in self.indexes.values():
+                    index.remove(row)
+                self.unindexed.discard(row)
+            self._index_rows([row for row in sorted(dirty) if self.store.alive[row]])
+            if not self.store.read_only:
+                self.save()
+            return True
+
+    def needs_training(self):
+        """Gallery big enough and index missing, or the gallery quadrupled since training"""
+        live = len(self.store.row_of)
+        return live >= self.min_train_rows and \
+            (not self.is_trained() or live > 4 * self.trained_rows)
+
+    def is_ready(self):
+        """True when searches may be pruned by the index"""
+        return self.is_trained() and len(self.store.row_of) >= self.min_train_rows
+
+    def _run(self):
+        while not self.stopped:
+            if self.needs_training():
+                self.train()
+            self.wakeup.wait(timeout=5.0)
+            self.wakeup.clear()
+
+    def start(self):
+        """Start the background training thread (idempotent)"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='ann-training', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    # ------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------
+
+    def candidates(self, query, n_probe=None):
+        """
+        Candidate rows for a query (union over descriptor indexes)
+
+        Args:
+            query: Encoded query (FeatureStore.encode)
+            n_probe: Buckets probed per descriptor (recall / latency knob)
+
+        Returns:
+            Sorted array of rows, or None when the exact scan should be used
+        """
+        n_probe = self.default_probes if n_probe is None else n_probe
+        if n_probe <= 0 or not self.is_ready():
+            # Not trained yet (the background thread is on it): exact scan
+            return None
+
+        found = []
+        for name, index in self.indexes.items():
+            descriptor = self._query_descriptor(name, query)
+            if descriptor is None:
+                # Query cannot be placed in this index: no safe pruning
+                return None
+            found.append(index.probe(descriptor, n_probe))
+        found.append(np.fromiter(self.unindexed, dtype=np.int64, count=len(self.unindexed)))
+        return np.unique(np.concatenate(found))
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self):
+        if not self.is_trained():
+            return
+        arrays = {'trained_rows': np.array(self.trained_rows)}
+        for name, index in self.indexes.items():
+            arrays[f'{name}.centroids'] = index.centroids
+            arrays[f'{name}.dim'] = np.array(self.dims[name])
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        tmp_path.replace(self.path)
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with np.load(self.path) as data:
+            self.trained_rows = int(data['trained_rows'])
+            for name, index in self.indexes.items():
+                index.set_centroids(data[f'{name}.centroids'])
+                self.dims[name] = int(data[f'{name}.dim'])
+        with self.store.lock:
+            self._index_rows(self.store.live_rows())
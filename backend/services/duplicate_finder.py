@@ -0,0 +1,248 @@
+"""
+Near-Duplicate Finder for the CBIR System
+Blocked all-pairs similarity self-join per class partition, grouping
+near-identical objects into clusters
+"""
+
+import argparse
+import json
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+class DuplicateFinder:
+    """
+    All-pairs self-join over the feature store
+
+    Each class partition is joined with itself in blocks of query rows: a
+    block is scored against its own rows in one call (only the upper
+    triangle is kept) and against every later row in another, with the
+    batch scorers of SimilaritySearchService. A block's score matrix is
+    bounded by BATCH_SCORE_ELEMENTS, and only pairs at or above the
+    threshold are kept (as union-find links), so memory does not grow with
+    the gallery squared. The store lock is held per block, so searches keep
+    running while a join is in progress.
+    """
+
+    def __init__(self, service):
+        """
+        Args:
+            service: SimilaritySearchService whose store and scorers are used
+        """
+        self.service = service
+        self.store = service.store
+
+    def _partitions(self, class_names=None):
+        """(class name, rows) per class partition to join"""
+        store = self.store
+        with store.lock:
+            names = class_names or sorted(set(store.class_names))
+            return [(name, store.rows_for_class(name)) for name in names]
+
+    def find_clusters(self, threshold=0.95, class_names=None, same_image=False, progress=None):
+        """
+        Clusters of near-duplicate objects
+
+        Args:
+            threshold: Minimum visual similarity (class default weights) for
+                two objects to be linked
+            class_names: Classes to join (all if None)
+            same_image: If True, also link objects of the same image
+            progress: Optional callback(dict) after every block with 'class',
+                'pairs_done', 'pairs_total' and 'fraction'
+
+        Returns:
+            List of clusters (dicts with 'class', 'objects', 'pairs',
+            'min_similarity', 'max_similarity'), largest first
+        """
+        partitions = self._partitions(class_names)
+        pairs_total = sum(len(rows) * (len(rows) - 1) // 2 for _, rows in partitions)
+        state = {'pairs_done': 0, 'pairs_total': pairs_total}
+
+        clusters = []
+        for class_name, rows in partitions:
+            if len(rows) > 1:
+                clusters += self._join_partition(
+                    class_name, rows, threshold, same_image, progress, state
+                )
+        clusters.sort(key=lambda cluster: (-len(cluster['objects']), -cluster['max_similarity']))
+        return clusters
+
+    def _join_partition(self, class_name, rows, threshold, same_image, progress, state):
+        store = self.store
+        weights = self.service._get_class_weights(class_name)
+        n = len(rows)
+        block = max(1, self.service.BATCH_SCORE_ELEMENTS // n)
+
+        parent = np.arange(n)
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        links = []
+        for start in range(0, n - 1, block):
+            stop = min(start + block, n - 1)
+            with store.lock:
+                alive = store.alive[rows]
+                members = np.array([i for i in range(start, stop) if alive[i]], dtype=np.int64)
+                queries = [store.encode(store.get(*store.keys[rows[i]])) for i in members]
+                # Rows tombstoned since the job started have no key
+                images = np.array([
+                    store.keys[row][0] if alive[start + i] else None
+                    for i, row in enumerate(rows[start:])
+                ], dtype=object)
+
+                # Query i only meets rows after it: the block's own rows (one
+                # square, upper triangle kept) and every row past the block
+                scored = []
+                if len(members):
+                    square = self.service._score_rows_batch(queries, rows[start:stop], weights)
+                    q, c = np.nonzero(square >= threshold)
+                    upper = start + c > members[q]
+                    q, c = q[upper], c[upper]
+                    scored.append((members[q], start + c, square[q, c]))
+                    if stop < n:
+                        tail = self.service._score_rows_batch(queries, rows[stop:], weights)
+                        q, c = np.nonzero(tail >= threshold)
+                        scored.append((members[q], stop + c, tail[q, c]))
+
+            for first, second, similarity in scored:
+                keep = alive[second]
+                if not same_image:
+                    keep &= images[second - start] != images[first - start]
+                for i, j, score in zip(first[keep], second[keep], similarity[keep]):
+                    links.append((int(i), int(j), float(score)))
+                    root_a, root_b = find(i), find(j)
+                    if root_a != root_b:
+                        parent[root_b] = root_a
+
+            # Pairs of the block's queries with every later row
+            state['pairs_done'] += sum(n - 1 - i for i in range(start, stop))
+            if progress is not None:
+                progress({
+                    'class': class_name,
+                    'pairs_done': state['pairs_done'],
+                    'pairs_total': state['pairs_total'],
+                    'fraction': state['pairs_done'] / max(1, state['pairs_total'])
+                })
+
+        grouped = {}
+        for a, b, similarity in links:
+            cluster = grouped.setdefault(find(a), {'members': set(), 'similarities': []})
+            cluster['members'].update((a, b))
+            cluster['similarities'].append(similarity)
+
+        clusters = []
+        with store.lock:
+            for cluster in grouped.values():
+                objects = [
+                    {'image_id': store.keys[rows[i]][0], 'object_id': store.keys[rows[i]][1]}
+                    for i in sorted(cluster['members']) if store.alive[rows[i]]
+                ]
+                if len(objects) < 2:
+                    continue
+                clusters.append({
+                    'class': class_name,
+                    'objects': objects,
+                    'pairs': len(cluster['similarities']),
+                    'min_similarity': min(cluster['similarities']),
+                    'max_similarity': max(cluster['similarities'])
+                })
+        return clusters
+
+
+class DuplicateJob:
+    """
+    Background run of DuplicateFinder with pollable progress
+
+    Usage:
+        job = DuplicateJob(finder, threshold=0.95)
+        job.start()
+        job.to_dict()  # {'job_id', 'status', 'progress', 'clusters', ...}
+    """
+
+    def __init__(self, finder, **options):
+        self.finder = finder
+        self.options = options
+        self.job_id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.progress = {'pairs_done': 0, 'pairs_total': 0, 'fraction': 0.0}
+        self.clusters = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def _run(self):
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            self.clusters = self.finder.find_clusters(progress=self._report, **self.options)
+            self.status = 'done'
+        except Exception as e:
+            self.error = str(e)
+            self.status = 'failed'
+        self.finished = time.time()
+
+    def _report(self, progress):
+        self.progress = progress
+
+    def start(self):
+        threading.Thread(target=self._run, name=f'duplicates-{self.job_id}', daemon=True).start()
+        return self
+
+    def to_dict(self):
+        elapsed = None
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'options': self.options,
+            'progress': self.progress,
+            'elapsed_seconds': elapsed,
+            'clusters': self.clusters,
+            'error': self.error
+        }
+
+
+def main():
+    """Command-line batch run: python -m services.duplicate_finder"""
+    from .similarity_search import SimilaritySearchService
+
+    parser = argparse.ArgumentParser(description='Find near-duplicate objects in the feature store')
+    parser.add_argument('--database', default='database/features.store')
+    parser.add_argument('--threshold', type=float, default=0.95)
+    parser.add_argument('--class', dest='class_names', action='append',
+                        help='Only join this class (repeatable)')
+    parser.add_argument('--same-image', action='store_true',
+                        help='Also link objects of the same image')
+    parser.add_argument('--output', help='Write clusters to this JSON file')
+    args = parser.parse_args()
+
+    # Read-only: never compacts or repairs the store under a running server
+    service = SimilaritySearchService(args.database, result_cache_size=0, read_only=True)
+    finder = DuplicateFinder(service)
+
+    def report(progress):
+        print(f"\r{progress['class']}: {progress['fraction'] * 100:5.1f}% "
+              f"({progress['pairs_done']}/{progress['pairs_total']} pairs)", end='', flush=True)
+
+    clusters = finder.find_clusters(
+        threshold=args.threshold, class_names=args.class_names,
+        same_image=args.same_image, progress=report
+    )
+    print(f"\n{len(clusters)} clusters, "
+          f"{sum(len(cluster['objects']) for cluster in clusters)} objects")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(clusters, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
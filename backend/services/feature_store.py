@@ -0,0 +1,988 @@
+"""
+Columnar Feature Store for the CBIR System
+Keeps every feature family as a contiguous float32 matrix (one row per
+detected object) instead of nested JSON lists
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+
+# Feature families produced by FeatureExtractionService.extract_all_features
+FAMILIES = (
+    'color',
+    'texture_tamura',
+    'texture_gabor',
+    'texture_lbp',
+    'shape_hu',
+    'shape_hog',
+    'shape_contour'
+)
+
+# Variable-length numeric fields, stored as zero-padded float32 matrices
+VECTOR_FIELDS = (
+    ('color', 'hist_rgb'),
+    ('color', 'hist_hsv'),
+    ('color', 'mean_rgb'),
+    ('color', 'std_rgb'),
+    ('texture_gabor', 'gabor_responses'),
+    ('texture_lbp', 'lbp_hist'),
+    ('shape_hu', 'hu_moments'),
+    ('shape_hog', 'hog'),
+    ('shape_contour', 'orientation_hist')
+)
+
+# Scalar statistics, stored together as one float32 matrix
+SCALAR_FIELDS = (
+    ('texture_tamura', 'coarseness'),
+    ('texture_tamura', 'contrast'),
+    ('texture_tamura', 'directionality'),
+    ('texture_lbp', 'lbp_mean'),
+    ('texture_lbp', 'lbp_std'),
+    ('shape_contour', 'main_orientation'),
+    ('shape_contour', 'orientation_variance')
+)
+
+# Vector fields compared by cosine similarity: stored unit-normalized, with
+# the original norm kept per row
+UNIT_NAMES = ('texture_gabor.gabor_responses', 'shape_hog.hog')
+
+# Histograms compared by chi-square; optionally also kept through an
+# explicit feature map so chi-square becomes (half) a squared L2 distance
+HISTOGRAM_NAMES = ('color.hist_rgb', 'texture_lbp.lbp_hist', 'shape_contour.orientation_hist')
+
+# Feature maps and the number of output dimensions per histogram bin
+HISTOGRAM_MAPS = {
+    'hellinger': 1,
+    'additive_chi2': 5
+}
+
+# Dominant colors compared per object (top N of color.dominant_colors)
+DOMINANT_COLORS = 5
+
+FAMILY_INDEX = {family: i for i, family in enumerate(FAMILIES)}
+VECTOR_NAMES = tuple(f'{family}.{field}' for family, field in VECTOR_FIELDS)
+SCALAR_NAMES = tuple(f'{family}.{field}' for family, field in SCALAR_FIELDS)
+SCALAR_INDEX = {name: i for i, name in enumerate(SCALAR_NAMES)}
+
+# 2: HOG / Gabor columns hold unit vectors plus a norm column
+STORE_VERSION = 2
+
+
+def histogram_feature_map(kind, histograms):
+    """
+    Explicit feature map for chi-square histogram comparison
+
+    Each map approximates a kernel k with k(x, x) = x, so the store's
+    chi-square 0.5 * sum((a - b)^2 / (a + b)) = 0.5 * (sum(a) + sum(b)) - sum(k(a, b))
+    becomes 0.5 * ||map(a) - map(b)||^2: one inner product plus per-row
+    sums, which BLAS, L2 indexes and quantizers handle.
+
+    - 'hellinger': sqrt(x), k = sqrt(a * b). Exact map, but gives the
+      Hellinger distance 0.5 * sum((sqrt(a) - sqrt(b))^2), between 0.5x and
+      1x chi-square.
+    - 'additive_chi2': sampled map of k = 2ab / (a + b), the kernel of
+      chi-square itself (Vedaldi & Zisserman, 3 samples with period 0.4),
+      5 dimensions per bin.
+
+    Args:
+        kind: 'hellinger' or 'additive_chi2'
+        histograms: (N, d) non-negative histograms
+
+    Returns:
+        (N, d * HISTOGRAM_MAPS[kind]) float32 array, bin-major (a prefix of
+        the bins maps to a prefix of the output)
+    """
+    x = np.maximum(np.asarray(histograms, dtype=np.float32), 0.0)
+    if kind == 'hellinger':
+        return np.sqrt(x)
+
+    interval = 0.4
+    positive = x > 0
+    log_x = np.log(np.where(positive, x, 1.0))
+    parts = [np.sqrt(x * interval)]
+    for j in (1, 2):
+        factor = np.sqrt(2.0 * x * interval / np.cosh(np.pi * j * interval))
+        parts.append(np.where(positive, factor * np.cos(j * interval * log_x), 0.0))
+        parts.append(np.where(positive, factor * np.sin(j * interval * log_x), 0.0))
+    return np.stack(parts, axis=2).reshape(len(x), -1).astype(np.float32)
+
+
+class FeatureStore:
+    """
+    Binary columnar storage for detections and object features
+
+    Rows are keyed by (image_id, object_id). Each vector field lives in its
+    own float32 matrix padded to the widest vector seen so far, with a
+    per-row length (-1 when the field is absent). Fields the schema does not
+    know about are kept per row as plain dicts; dominant colors are kept
+    there too and additionally as fixed-shape padded arrays (top 5 RGB
+    colors, their weights and a validity mask) for vectorized comparison.
+    HOG and Gabor vectors are stored unit-normalized next to their original
+    norms, so cosine similarity is a single matrix-vector product.
+
+    On disk the store is a directory holding one .npy file per column plus a
+    manifest.json with detections and metadata (the snapshot), and an
+    append-only mutation log next to it. Mutations are appended to the log
+    and fsync'd on commit(), so a write costs the same no matter how large
+    the gallery is. The log is replayed on startup and folded into a new
+    snapshot once it grows past the compaction threshold.
+
+    Mutations made inside ``with store.batch():`` are written as a single
+    log record when the outermost block exits, and undone if it raises.
+    """
+
+    def __init__(self, path, legacy_path=None, compact_min_ops=1000, compact_ratio=1.0,
+                 spill_dir=None, histogram_map=None, read_only=False):
+        """
+        Args:
+            path: Snapshot directory (e.g. database/features.store)
+            legacy_path: Optional features.json to import on first start
+            compact_min_ops: Never compact before the log holds this many operations
+            compact_ratio: Compact once the log holds more operations than
+                compact_ratio * number of stored objects
+            spill_dir: If set, vector columns are memory-mapped scratch files in
+                this folder instead of anonymous memory, so the OS can page
+                full-precision features out and RAM stays bounded
+            histogram_map: Optional HISTOGRAM_MAPS key; if set, every
+                histogram is also kept mapped through histogram_feature_map
+                (derived in memory, not persisted)
+            read_only: Open without ever writing: no crash recovery, log
+                repair, migration or compaction, and commit() / save()
+                raise. For tools running next to a live server
+        """
+        self.path = Path(path)
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self.log_path = self.path.with_suffix('.log')
+        self.legacy_path = Path(legacy_path) if legacy_path else None
+        self.compact_min_ops = compact_min_ops
+        self.compact_ratio = compact_ratio
+        if histogram_map is not None and histogram_map not in HISTOGRAM_MAPS:
+            raise ValueError(f'Unknown histogram map: {histogram_map}')
+        self.histogram_map = histogram_map
+        self.read_only = read_only
+        self.lock = threading.RLock()
+        self.listeners = []
+        self._local = threading.local()
+        self._log_ops = 0
+        # Outermost batch() blocks currently open, across threads
+        self._open_batches = 0
+        self._replaying = False
+        # Bumped by every mutation, so readers can tell cached results are stale
+        self.generation = 0
+        self._reset()
+        self._load()
+
+    # ------------------------------------------------------------------
+    # In-memory layout
+    # ------------------------------------------------------------------
+
+    def _reset(self, capacity=64):
+        """Drop all in-memory state"""
+        self.images = {}
+        self.metadata = {'created': datetime.now().isoformat()}
+        self.capacity = capacity
+        self.size = 0
+        self.keys = []
+        self.row_of = {}
+        self.image_row_sets = {}
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.class_codes = {}
+        self.class_names = []
+        self.row_class = np.full(capacity, -1, dtype=np.int32)
+        self.class_rows = {}
+        self._class_row_arrays = {}
+        # Detected class name (lowercase) -> image ids with such a detection
+        self.class_images = {}
+        self.families = np.zeros((capacity, len(FAMILIES)), dtype=bool)
+        self.vectors = {name: self._allocate((capacity, 0)) for name in VECTOR_NAMES}
+        self.lengths = {name: np.full(capacity, -1, dtype=np.int32) for name in VECTOR_NAMES}
+        self.scalars = np.zeros((capacity, len(SCALAR_NAMES)), dtype=np.float32)
+        self.scalar_mask = np.zeros((capacity, len(SCALAR_NAMES)), dtype=bool)
+        self.norms = {name: np.zeros(capacity, dtype=np.float32) for name in UNIT_NAMES}
+        mapped_names = HISTOGRAM_NAMES if self.histogram_map else ()
+        self.mapped = {name: self._allocate((capacity, 0)) for name in mapped_names}
+        self.histogram_sums = {name: np.zeros(capacity, dtype=np.float32) for name in mapped_names}
+        self.dominant_rgb = np.zeros((capacity, DOMINANT_COLORS, 3), dtype=np.float32)
+        self.dominant_weights = np.zeros((capacity, DOMINANT_COLORS), dtype=np.float32)
+        self.dominant_mask = np.zeros((capacity, DOMINANT_COLORS), dtype=bool)
+        self.extras = []
+
+    def _grow(self, min_capacity):
+        """Grow every column to hold at least min_capacity rows (amortized doubling)"""
+        if min_capacity <= self.capacity:
+            return
+        capacity = max(min_capacity, self.capacity * 2)
+
+        def grow(array, fill=0):
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:self.capacity] = array
+            return grown
+
+        self.alive = grow(self.alive)
+        self.row_class = grow(self.row_class, -1)
+        self.families = grow(self.families)
+        self.vectors = {name: self._grow_column(matrix, capacity) for name, matrix in self.vectors.items()}
+        self.lengths = {name: grow(lengths, -1) for name, lengths in self.lengths.items()}
+        self.scalars = grow(self.scalars)
+        self.scalar_mask = grow(self.scalar_mask)
+        self.norms = {name: grow(norms) for name, norms in self.norms.items()}
+        self.mapped = {name: self._grow_column(matrix, capacity) for name, matrix in self.mapped.items()}
+        self.histogram_sums = {name: grow(sums) for name, sums in self.histogram_sums.items()}
+        self.dominant_rgb = grow(self.dominant_rgb)
+        self.dominant_weights = grow(self.dominant_weights)
+        self.dominant_mask = grow(self.dominant_mask)
+        self.capacity = capacity
+
+    def _widen(self, name, width, columns=None):
+        """Widen a vector column so it can hold vectors of the given length"""
+        columns = self.vectors if columns is None else columns
+        matrix = columns[name]
+        if width <= matrix.shape[1]:
+            return
+        widened = self._allocate((self.capacity, width))
+        widened[:, :matrix.shape[1]] = matrix
+        columns[name] = widened
+
+    def _allocate(self, shape):
+        """Zeroed float32 vector column, file-backed when spilling is enabled"""
+        if self.spill_dir is None or 0 in shape:
+            return np.zeros(shape, dtype=np.float32)
+        # The scratch file disappears when the mapping is dropped
+        with tempfile.TemporaryFile(dir=self.spill_dir) as f:
+            return np.memmap(f, dtype=np.float32, mode='w+', shape=shape)
+
+    def _grow_column(self, matrix, capacity):
+        grown = self._allocate((capacity, matrix.shape[1]))
+        grown[:len(matrix)] = matrix
+        return grown
+
+    # ------------------------------------------------------------------
+    # Row encoding
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _as_vector(value):
+        """Convert a JSON list to a 1-D float32 array (None if not numeric)"""
+        if not isinstance(value, (list, tuple, np.ndarray)):
+            return None
+        try:
+            array = np.asarray(value, dtype=np.float32)
+        except (TypeError, ValueError):
+            return None
+        return array if array.ndim == 1 else None
+
+    @staticmethod
+    def encode_dominant_colors(colors):
+        """
+        Padded arrays for the top DOMINANT_COLORS dominant colors
+
+        Args:
+            colors: color.dominant_colors list ({'rgb': [r, g, b], 'percentage': p})
+
+        Returns:
+            Tuple of (5, 3) RGB array, (5,) weights (percentage / 100) and
+            (5,) validity mask; all-invalid when the list is missing or malformed
+        """
+        rgb = np.zeros((DOMINANT_COLORS, 3), dtype=np.float32)
+        weights = np.zeros(DOMINANT_COLORS, dtype=np.float32)
+        mask = np.zeros(DOMINANT_COLORS, dtype=bool)
+        if not isinstance(colors, list):
+            return rgb, weights, mask
+        try:
+            for i, color in enumerate(colors[:DOMINANT_COLORS]):
+                rgb[i] = color['rgb']
+                weights[i] = color['percentage'] / 100.0
+                mask[i] = True
+        except (TypeError, ValueError, KeyError, IndexError):
+            # Legacy layouts (e.g. plain RGB lists) are not comparable
+            mask[:] = False
+        return rgb, weights, mask
+
+    def encode(self, features):
+        """
+        Split a feature dict into columnar parts
+
+        Args:
+            features: Feature dict as returned by extract_all_features
+
+        Returns:
+            Dictionary with 'families', 'vectors' (HOG / Gabor unit-normalized),
+            'scalars', 'scalar_mask', 'norms' (original HOG / Gabor norms),
+            'mapped' (histograms through histogram_map, if enabled),
+            'dominant' (see encode_dominant_colors) and 'extras' entries
+        """
+        families = np.zeros(len(FAMILIES), dtype=bool)
+        vectors = {}
+        scalars = np.zeros(len(SCALAR_NAMES), dtype=np.float32)
+        scalar_mask = np.zeros(len(SCALAR_NAMES), dtype=bool)
+        extras = {}
+
+        for family, value in features.items():
+            if family not in FAMILY_INDEX or not isinstance(value, dict):
+                # Unknown family, keep it verbatim
+                extras[family] = value
+                continue
+
+            families[FAMILY_INDEX[family]] = True
+            rest = {}
+            for field, field_value in value.items():
+                name = f'{family}.{field}'
+                if name in self.vectors:
+                    vector = self._as_vector(field_value)
+                    if vector is not None:
+                        vectors[name] = vector
+                        continue
+                elif name in SCALAR_INDEX and isinstance(field_value, (int, float)) \
+                        and not isinstance(field_value, bool):
+                    scalars[SCALAR_INDEX[name]] = field_value
+                    scalar_mask[SCALAR_INDEX[name]] = True
+                    continue
+                rest[field] = field_value
+            if rest:
+                extras[family] = rest
+
+        # Cosine fields are kept as unit vectors plus their norm
+        norms = {}
+        for name in UNIT_NAMES:
+            vector = vectors.get(name)
+            if vector is not None:
+                norm = np.float32(np.linalg.norm(vector))
+                norms[name] = norm
+                if norm > 0:
+                    vectors[name] = vector / norm
+
+        # Mapped histograms (histogram_map mode)
+        mapped = {}
+        for name in self.mapped:
+            vector = vectors.get(name)
+            if vector is not None:
+                mapped[name] = histogram_feature_map(self.histogram_map, vector[None, :])[0]
+
+        color = features.get('color')
+        dominant = self.encode_dominant_colors(
+            color.get('dominant_colors') if isinstance(color, dict) else None
+        )
+
+        return {
+            'families': families,
+            'vectors': vectors,
+            'scalars': scalars,
+            'scalar_mask': scalar_mask,
+            'norms': norms,
+            'mapped': mapped,
+            'dominant': dominant,
+            'extras': extras
+        }
+
+    def _decode(self, row):
+        """Rebuild the original feature dict for a row"""
+        extras = self.extras[row] or {}
+        features = {}
+
+        for family in FAMILIES:
+            if not self.families[row, FAMILY_INDEX[family]]:
+                continue
+            features[family] = {}
+
+        for name in VECTOR_NAMES:
+            length = self.lengths[name][row]
+            if length >= 0:
+                family, field = name.split('.', 1)
+                vector = self.vectors[name][row, :length]
+                if name in self.norms:
+                    vector = vector * self.norms[name][row]
+                features[family][field] = vector.tolist()
+
+        for i, name in enumerate(SCALAR_NAMES):
+            if self.scalar_mask[row, i]:
+                family, field = name.split('.', 1)
+                features[family][field] = float(self.scalars[row, i])
+
+        for family, value in extras.items():
+            if family in features:
+                features[family].update(value)
+            else:
+                features[family] = value
+
+        return features
+
+    # ------------------------------------------------------------------
+    # Mutations
+    # ------------------------------------------------------------------
+
+    def _write_row(self, row, encoded):
+        """Write an encoded feature dict into a row"""
+        self.families[row] = encoded['families']
+        for name in VECTOR_NAMES:
+            vector = encoded['vectors'].get(name)
+            self.vectors[name][row] = 0.0
+            if vector is None:
+                self.lengths[name][row] = -1
+                continue
+            self._widen(name, len(vector))
+            self.vectors[name][row, :len(vector)] = vector
+            self.lengths[name][row] = len(vector)
+        self.scalars[row] = encoded['scalars']
+        self.scalar_mask[row] = encoded['scalar_mask']
+        for name in UNIT_NAMES:
+            self.norms[name][row] = encoded['norms'].get(name, 0.0)
+        for name in self.mapped:
+            self._write_mapped(row, name, encoded['mapped'].get(name))
+        self.dominant_rgb[row], self.dominant_weights[row], self.dominant_mask[row] = \
+            encoded['dominant']
+        self.extras[row] = encoded['extras'] or None
+        self._notify('upsert', row)
+
+    def _write_mapped(self, row, name, mapped):
+        """Write one mapped histogram (None clears it) and its bin sum"""
+        self.mapped[name][row] = 0.0
+        self.histogram_sums[name][row] = 0.0
+        if mapped is None:
+            return
+        self._widen(name, len(mapped), self.mapped)
+        self.mapped[name][row, :len(mapped)] = mapped
+        # Exact k(a, a) terms: the bin sum, for every map
+        length = self.lengths[name][row]
+        self.histogram_sums[name][row] = np.maximum(self.vectors[name][row, :length], 0.0).sum()
+
+    def _map_histograms(self, rows, block_size=65536):
+        """Derive the mapped histogram columns for stored rows in bulk"""
+        for name in self.mapped:
+            matrix = self.vectors[name]
+            self._widen(name, matrix.shape[1] * HISTOGRAM_MAPS[self.histogram_map], self.mapped)
+            for start in range(0, rows, block_size):
+                stop = min(start + block_size, rows)
+                block = matrix[start:stop]
+                mapped = histogram_feature_map(self.histogram_map, block)
+                self.mapped[name][start:stop, :mapped.shape[1]] = mapped
+                self.histogram_sums[name][start:stop] = np.maximum(block, 0.0).sum(axis=1)
+
+    def add_listener(self, callback):
+        """
+        Register callback(event, row) for row changes
+
+        event is 'upsert' after a row's features were written, 'remove'
+        before a row is tombstoned and 'relabel' after a row with features
+        moved to another class. Callbacks run under the store lock.
+        """
+        self.listeners.append(callback)
+
+    def _notify(self, event, row):
+        for callback in self.listeners:
+            callback(event, row)
+
+    def _clear_row(self, row):
+        """Tombstone a row (it is dropped on the next snapshot)"""
+        self._notify('remove', row)
+        key = self.keys[row]
+        del self.row_of[key]
+        self.image_row_sets[key[0]].discard(row)
+        self.keys[row] = None
+        self.extras[row] = None
+        self.alive[row] = False
+        self._set_row_class(row, -1)
+        self.families[row] = False
+        for name in VECTOR_NAMES:
+            self.vectors[name][row] = 0.0
+            self.lengths[name][row] = -1
+        self.scalars[row] = 0.0
+        self.scalar_mask[row] = False
+        for name in UNIT_NAMES:
+            self.norms[name][row] = 0.0
+        for name in self.mapped:
+            self._write_mapped(row, name, None)
+        self.dominant_mask[row] = False
+
+    def class_code(self, class_name, create=False):
+        """
+        Integer code of a (case-insensitive) class name
+
+        Returns -1 for classes that no row has been labelled with yet,
+        unless create is True.
+        """
+        name = class_name.lower()
+        code = self.class_codes.get(name)
+        if code is None:
+            if not create:
+                return -1
+            code = len(self.class_names)
+            self.class_codes[name] = code
+            self.class_names.append(name)
+        return code
+
+    def _label_row(self, row):
+        """Set the class code of a row from its image's detections"""
+        image_id, object_id = self.keys[row]
+        detections = self.images.get(image_id, {}).get('detections', [])
+        detection = detections[object_id] if object_id < len(detections) else {}
+        code = self.class_code(detection.get('class', 'unknown'), create=True)
+        self._set_row_class(row, code)
+
+    def _set_row_class(self, row, code):
+        """Move a row between class partitions (-1 removes it from all)"""
+        previous = self.row_class[row]
+        if previous == code:
+            return
+        if previous >= 0:
+            self.class_rows[previous].discard(row)
+            self._class_row_arrays.pop(previous, None)
+        if code >= 0:
+            self.class_rows.setdefault(code, set()).add(row)
+            self._class_row_arrays.pop(code, None)
+        self.row_class[row] = code
+        if previous >= 0 and code >= 0 and self.alive[row]:
+            self._notify('relabel', row)
+
+    def _index_detections(self, image_id, detections, add=True):
+        """Add an image to (or drop it from) the class -> images index"""
+        for name in {detection.get('class', 'unknown').lower() for detection in detections}:
+            if add:
+                self.class_images.setdefault(name, set()).add(image_id)
+                continue
+            image_ids = self.class_images.get(name)
+            if image_ids is not None:
+                image_ids.discard(image_id)
+                if not image_ids:
+                    del self.class_images[name]
+
+    def _ensure_image(self, image_id):
+        if image_id not in self.images:
+            self.images[image_id] = {'detections': []}
+        return self.images[image_id]
+
+    def set_detections(self, image_id, detections):
+        """Replace detections for an image"""
+        with self.lock:
+            undo = None
+            if self._in_batch():
+                if image_id in self.images:
+                    undo = [{'op': 'detections', 'image_id': image_id,
+                             'detections': self.images[image_id]['detections']}]
+                else:
+                    undo = [{'op': 'remove_image', 'image_id': image_id}]
+            self._record({'op': 'detections', 'image_id': image_id, 'detections': detections}, undo)
+            image = self._ensure_image(image_id)
+            self._index_detections(image_id, image['detections'], add=False)
+            image['detections'] = detections
+            self._index_detections(image_id, detections)
+            for row in self.image_rows(image_id):
+                self._label_row(row)
+
+    def put(self, image_id, object_id, features):
+        """Insert or overwrite the features of one object (None removes them, if any)"""
+        with self.lock:
+            key = (image_id, int(object_id))
+            if features is None and key not in self.row_of:
+                # Nothing to remove; never create an empty image entry
+                return
+            undo = None
+            if self._in_batch():
+                undo = [{'op': 'put', 'image_id': image_id, 'object_id': int(object_id),
+                         'features': self.get(image_id, object_id)}]
+                if image_id not in self.images:
+                    undo.append({'op': 'remove_image', 'image_id': image_id})
+            self._record({'op': 'put', 'image_id': image_id,
+                          'object_id': int(object_id), 'features': features}, undo)
+            if features is None:
+                self._clear_row(self.row_of[key])
+                return
+
+            self._ensure_image(image_id)
+            encoded = self.encode(features)
+            row = self.row_of.get(key)
+            if row is None:
+                row = self.size
+                self._grow(row + 1)
+                self.size += 1
+                self.keys.append(key)
+                self.extras.append(None)
+                self.row_of[key] = row
+                self.image_row_sets.setdefault(image_id, set()).add(row)
+                self.alive[row] = True
+                self._label_row(row)
+            self._write_row(row, encoded)
+
+    def get(self, image_id, object_id):
+        """Get the feature dict of one object (None if missing)"""
+        with self.lock:
+            row = self.row_of.get((image_id, int(object_id)))
+            if row is None:
+                return None
+            return self._decode(row)
+
+    def remove_image(self, image_id):
+        """Remove detections and all feature rows of an image"""
+        with self.lock:
+            if image_id not in self.images:
+                return False
+            undo = None
+            if self._in_batch():
+                undo = [{'op': 'detections', 'image_id': image_id,
+                         'detections': self.images[image_id]['detections']}]
+                undo += [
+                    {'op': 'put', 'image_id': image_id, 'object_id': self.keys[row][1],
+                     'features': self._decode(row)}
+                    for row in self.image_rows(image_id)
+                ]
+            self._record({'op': 'remove_image', 'image_id': image_id}, undo)
+            self._index_detections(image_id, self.images.pop(image_id)['detections'], add=False)
+            for row in self.image_rows(image_id):
+                self._clear_row(row)
+            self.image_row_sets.pop(image_id, None)
+            return True
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def image_rows(self, image_id):
+        """Row indices holding features of an image"""
+        return sorted(self.image_row_sets.get(image_id, ()))
+
+    def rows_for_class(self, class_name):
+        """
+        Sorted row indices labelled with a class (case-insensitive)
+
+        Served from the class -> rows partition, which is kept current on
+        every put / set_detections / remove_image, so no scan is needed.
+        """
+        code = self.class_code(class_name)
+        if code < 0:
+            return np.zeros(0, dtype=np.int64)
+        rows = self._class_row_arrays.get(code)
+        if rows is None:
+            rows = np.array(sorted(self.class_rows.get(code, ())), dtype=np.int64)
+            self._class_row_arrays[code] = rows
+        return rows
+
+    def images_with_class(self, class_name):
+        """
+        Image ids with at least one detection of a class (case-insensitive)
+
+        Served from the class -> images index kept by set_detections /
+        remove_image; covers images whose features were not extracted yet.
+        """
+        return set(self.class_images.get(class_name.lower(), ()))
+
+    def has_features(self, image_id):
+        """True if any object of the image has stored features"""
+        return bool(self.image_row_sets.get(image_id))
+
+    def live_rows(self):
+        """Indices of all rows that currently hold features"""
+        return np.flatnonzero(self.alive[:self.size])
+
+    def feature_count(self, image_id):
+        """Number of objects with extracted features in an image"""
+        return len(self.image_rows(image_id))
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _load(self):
+        """Load the snapshot, falling back to a one-time import of features.json"""
+        backup_path = self.path.with_name(self.path.name + '.old')
+        if not self.path.exists() and backup_path.exists() and not self.read_only:
+            # Crash during the snapshot swap: the previous snapshot is still valid
+            backup_path.rename(self.path)
+
+        self._migrated = False
+        if self.path.exists():
+            self._load_snapshot()
+        elif self.legacy_path and self.legacy_path.exists():
+            self._import_legacy()
+            if not self.read_only:
+                self.save()
+            return
+
+        self._replay_log()
+        if not self.read_only and (self._migrated or self._should_compact()):
+            # Migrated snapshots are rewritten once in the current layout
+            self.save()
+
+    def _load_snapshot(self):
+        with open(self.path / 'manifest.json', 'r') as f:
+            manifest = json.load(f)
+
+        rows = manifest['rows']
+        self._reset(capacity=max(64, rows))
+        self.images = manifest['images']
+        for image_id, image in self.images.items():
+            self._index_detections(image_id, image.get('detections', []))
+        self.metadata = manifest['metadata']
+        self.size = rows
+
+        image_ids = np.load(self.path / 'image_ids.npy')
+        object_ids = np.load(self.path / 'object_ids.npy')
+        self.keys = [(str(img), int(obj)) for img, obj in zip(image_ids, object_ids)]
+        self.row_of = {key: row for row, key in enumerate(self.keys)}
+        for row, (image_id, _) in enumerate(self.keys):
+            self.image_row_sets.setdefault(image_id, set()).add(row)
+        self.alive[:rows] = True
+        for row in range(rows):
+            self._label_row(row)
+
+        self.families[:rows] = np.load(self.path / 'families.npy')
+        self.scalars[:rows] = np.load(self.path / 'scalars.npy')
+        self.scalar_mask[:rows] = np.load(self.path / 'scalar_mask.npy')
+        for name in VECTOR_NAMES:
+            matrix = np.load(self.path / f'{name}.npy', mmap_mode='r')
+            self._widen(name, matrix.shape[1])
+            self.vectors[name][:rows, :matrix.shape[1]] = matrix
+            self.lengths[name][:rows] = np.load(self.path / f'{name}.len.npy')
+
+        self.extras = [None] * rows
+        for row, extras in manifest['extras'].items():
+            self.extras[int(row)] = extras
+
+        if manifest.get('version', 1) < 2:
+            self._migrate_unit_vectors(rows)
+        else:
+            for name in UNIT_NAMES:
+                self.norms[name][:rows] = np.load(self.path / f'{name}.norm.npy')
+        self._map_histograms(rows)
+
+        if (self.path / 'dominant_mask.npy').exists():
+            self.dominant_rgb[:rows] = np.load(self.path / 'dominant_rgb.npy')
+            self.dominant_weights[:rows] = np.load(self.path / 'dominant_weights.npy')
+            self.dominant_mask[:rows] = np.load(self.path / 'dominant_mask.npy')
+        else:
+            # Snapshot written before the padded columns existed
+            for row in range(rows):
+                color = (self.extras[row] or {}).get('color')
+                self.dominant_rgb[row], self.dominant_weights[row], self.dominant_mask[row] = \
+                    self.encode_dominant_colors(
+                        color.get('dominant_colors') if isinstance(color, dict) else None
+                    )
+
+    def _migrate_unit_vectors(self, rows, block_size=65536):
+        """One-time upgrade of a version 1 snapshot: normalize HOG / Gabor rows"""
+        for name in UNIT_NAMES:
+            matrix = self.vectors[name]
+            for start in range(0, rows, block_size):
+                block = matrix[start:min(start + block_size, rows)]
+                norms = np.linalg.norm(block, axis=1)
+                block /= np.where(norms > 0, norms, 1.0)[:, None]
+                self.norms[name][start:start + len(block)] = norms
+        self._migrated = True
+
+    def _import_legacy(self):
+        """Import a features.json database written by earlier versions"""
+        with open(self.legacy_path, 'r') as f:
+            database = json.load(f)
+
+        self.metadata = database.get('metadata', self.metadata)
+        for image_id, data in database.get('images', {}).items():
+            self.set_detections(image_id, data.get('detections', []))
+            for object_id, features in enumerate(data.get('features', [])):
+                if features:
+                    self.put(image_id, object_id, features)
+
+    def _batch_state(self):
+        """Per-thread pending log records, undo records and batch nesting depth"""
+        state = self._local
+        if not hasattr(state, 'pending'):
+            state.pending = []
+            state.undo = []
+            state.depth = 0
+        return state
+
+    def _in_batch(self):
+        return not self._replaying and self._batch_state().depth > 0
+
+    def _record(self, operation, undo=None):
+        """Queue a mutation for the write log (no-op while replaying)"""
+        self.generation += 1
+        if self._replaying:
+            return
+        state = self._batch_state()
+        state.pending.append(operation)
+        if undo is not None:
+            state.undo.append(undo)
+
+    def _apply(self, operation):
+        """Apply one logged mutation"""
+        op = operation['op']
+        if op == 'detections':
+            self.set_detections(operation['image_id'], operation['detections'])
+        elif op == 'put':
+            self.put(operation['image_id'], operation['object_id'], operation['features'])
+        elif op == 'remove_image':
+            self.remove_image(operation['image_id'])
+
+    def _replay_log(self):
+        """Re-apply mutations logged since the last snapshot"""
+        if not self.log_path.exists():
+            return
+
+        self._replaying = True
+        valid_bytes = 0
+        try:
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        batch = json.loads(line)
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        # Torn write at the tail (crash before fsync finished)
+                        break
+                    for operation in batch:
+                        self._apply(operation)
+                    self._log_ops += len(batch)
+                    valid_bytes += len(line)
+        finally:
+            self._replaying = False
+
+        # Drop the torn tail so new records are not appended onto it
+        if not self.read_only and valid_bytes < self.log_path.stat().st_size:
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(valid_bytes)
+
+    def _should_compact(self):
+        threshold = max(self.compact_min_ops, self.compact_ratio * len(self.row_of))
+        return self._log_ops >= threshold
+
+    def commit(self):
+        """
+        Append pending mutations to the write log as one fsync'd record
+
+        Each commit writes a single line, so a crash mid-write loses the
+        whole record instead of leaving half of it applied on replay.
+        Compacts the log into a fresh snapshot when it grows too large and
+        no batch() block is open: a snapshot would otherwise capture other
+        threads' uncommitted mutations.
+        """
+        state = self._batch_state()
+        if state.depth > 0:
+            # Deferred until the outermost batch() block exits
+            return
+
+        with self.lock:
+            if not state.pending:
+                return
+            if self.read_only:
+                raise RuntimeError(f'Feature store {self.path} is open read-only')
+            line = json.dumps(state.pending) + '\n'
+            with open(self.log_path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._log_ops += len(state.pending)
+            state.pending = []
+
+            if self._open_batches == 0 and self._should_compact():
+                self.save()
+
+    @contextmanager
+    def batch(self):
+        """
+        Group mutations into one atomic write
+
+        Everything mutated inside the block is appended to the log as a
+        single fsync'd record when the outermost block exits. If the block
+        raises, the in-memory changes are undone and nothing is persisted.
+        Blocks may be nested; only the outermost one commits.
+        """
+        state = self._batch_state()
+        if state.depth == 0:
+            with self.lock:
+                self._open_batches += 1
+        state.depth += 1
+        try:
+            yield self
+        except BaseException:
+            state.depth -= 1
+            if state.depth == 0:
+                with self.lock:
+                    self._open_batches -= 1
+                    self._rollback()
+            raise
+        else:
+            state.depth -= 1
+            if state.depth == 0:
+                with self.lock:
+                    self._open_batches -= 1
+                    state.undo = []
+                    self.commit()
+
+    def _rollback(self):
+        """Undo the mutations of the current thread's batch"""
+        with self.lock:
+            state = self._batch_state()
+            undo = state.undo
+            state.pending = []
+            state.undo = []
+            for operations in reversed(undo):
+                for operation in operations:
+                    self._apply(operation)
+            # Compaction waits for open batches, so neither the batch nor its
+            # undo ever reached disk
+            state.pending = []
+
+    def save(self):
+        """Write a compacted snapshot atomically (tmp dir + rename) and truncate the log"""
+        if self.read_only:
+            raise RuntimeError(f'Feature store {self.path} is open read-only')
+        with self.lock:
+            self.metadata['updated'] = datetime.now().isoformat()
+            rows = self.live_rows()
+
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            backup_path = self.path.with_name(self.path.name + '.old')
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            tmp_path.mkdir(parents=True)
+
+            keys = [self.keys[row] for row in rows]
+            np.save(tmp_path / 'image_ids.npy', np.array([k[0] for k in keys], dtype=str))
+            np.save(tmp_path / 'object_ids.npy', np.array([k[1] for k in keys], dtype=np.int32))
+            np.save(tmp_path / 'families.npy', self.families[rows])
+            np.save(tmp_path / 'scalars.npy', self.scalars[rows])
+            np.save(tmp_path / 'scalar_mask.npy', self.scalar_mask[rows])
+            np.save(tmp_path / 'dominant_rgb.npy', self.dominant_rgb[rows])
+            np.save(tmp_path / 'dominant_weights.npy', self.dominant_weights[rows])
+            np.save(tmp_path / 'dominant_mask.npy', self.dominant_mask[rows])
+            for name in VECTOR_NAMES:
+                np.save(tmp_path / f'{name}.npy', self.vectors[name][rows])
+                np.save(tmp_path / f'{name}.len.npy', self.lengths[name][rows])
+            for name in UNIT_NAMES:
+                np.save(tmp_path / f'{name}.norm.npy', self.norms[name][rows])
+
+            manifest = {
+                'version': STORE_VERSION,
+                'rows': len(rows),
+                'images': self.images,
+                'metadata': self.metadata,
+                'extras': {
+                    str(i): self.extras[row]
+                    for i, row in enumerate(rows) if self.extras[row]
+                }
+            }
+            with open(tmp_path / 'manifest.json', 'w') as f:
+                json.dump(manifest, f)
+
+            # Swap directories: current -> .old, tmp -> current
+            shutil.rmtree(backup_path, ignore_errors=True)
+            if self.path.exists():
+                self.path.rename(backup_path)
+            tmp_path.rename(self.path)
+            shutil.rmtree(backup_path, ignore_errors=True)
+
+            # Everything logged so far is now part of the snapshot
+            state = self._batch_state()
+            if state.depth == 0:
+                state.pending = []
+            self._log_ops = 0
+            if self.log_path.exists():
+                self.log_path.unlink()
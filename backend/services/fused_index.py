@@ -0,0 +1,177 @@
+"""
+Fused Descriptor Index for the CBIR System
+One dense vector per object concatenating every feature family, so a
+default-weight query is scored by a single matrix-vector product over
+its class partition
+"""
+
+import numpy as np
+
+from .feature_store import SCALAR_INDEX
+from .product_quantization import embed_block
+
+
+# Blocks of the fused vector: (family, field, mapping, share of the family
+# score). Mappings are those of the compressed descriptor
+# (product_quantization.embed_block): squared L2 per block tracks the
+# family metric, and the share is the part's weight inside its family score.
+FUSED_BLOCKS = (
+    ('color', 'color.hist_rgb', 'sqrt', 0.7),
+    ('color', 'color.mean_rgb', 'rgb', 0.1),
+    ('texture_tamura', 'texture_tamura.coarseness', ('scale', 10.0), 0.5),
+    ('texture_tamura', 'texture_tamura.contrast', ('scale', 100.0), 0.3),
+    ('texture_tamura', 'texture_tamura.directionality', ('scale', 5.0), 0.2),
+    ('texture_gabor', 'texture_gabor.gabor_responses', 'unit', 1.0),
+    ('texture_lbp', 'texture_lbp.lbp_hist', 'sqrt', 0.8),
+    ('texture_lbp', 'texture_lbp.lbp_mean', ('scale', 255.0), 0.1),
+    ('texture_lbp', 'texture_lbp.lbp_std', ('scale', 100.0), 0.1),
+    ('shape_hu', 'shape_hu.hu_moments', 'hu', 1.0),
+    ('shape_hog', 'shape_hog.hog', 'unit', 1.0),
+    ('shape_contour', 'shape_contour.orientation_hist', 'sqrt', 0.6),
+    ('shape_contour', 'shape_contour.main_orientation', 'angle', 0.25),
+    ('shape_contour', 'shape_contour.orientation_variance', ('scale', 1.0), 0.15)
+)
+
+
+class FusedDescriptorIndex:
+    """
+    Fused inner-product descriptors for every object in a FeatureStore
+
+    The fused score is minus half the class-weighted squared L2 distance
+    between fused vectors, up to a per-query constant:
+
+        -0.5 * sum_b w_b * ||q_b - x_b||^2 = <w * q, x> - 0.5 * sum_b w_b * ||x_b||^2 + const
+
+    Rows therefore hold the unweighted blocks followed by each block's
+    squared norm, and a class's weight profile is expanded once into a
+    per-dimension weight vector for the query plus -0.5 * w_b for the norm
+    columns: one matrix-vector product scores the per-class weighted
+    embedding, without storing a copy per class or rewriting rows when an
+    object changes class. The score is a ranking proxy (dominant colours
+    are left out, chi-square is replaced by Hellinger); the shortlist is
+    re-scored exactly.
+    """
+
+    def __init__(self, store, class_weights):
+        """
+        Args:
+            store: FeatureStore to index
+            class_weights: Callable(class_name) -> family weight dict
+        """
+        self.store = store
+        self.class_weights = class_weights
+        self.dims = None
+        self.built_rows = 0
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.weight_vectors = {}
+        store.add_listener(self._on_store_change)
+
+    def is_built(self):
+        return self.dims is not None
+
+    def _blocks(self, sources):
+        """Mapped blocks for FUSED_BLOCKS (sources(field, dim) -> matrix, valid mask)"""
+        blocks = []
+        for _, field, mapping, _ in FUSED_BLOCKS:
+            matrix, valid = sources(field, self.dims[field])
+            block = embed_block(mapping, matrix)
+            blocks.append(np.where(valid[:, None], block, 0.0).astype(np.float32))
+        return blocks
+
+    def _fuse_rows(self, rows):
+        """Fused vectors (len(rows), D + blocks) for stored rows (odd-sized blocks left 0)"""
+        def sources(field, dim):
+            if field in SCALAR_INDEX:
+                # Absent scalars read as 0, like in the exact scorer
+                return self.store.scalars[rows, SCALAR_INDEX[field]][:, None], \
+                    np.ones(len(rows), dtype=bool)
+            valid = self.store.lengths[field][rows] == dim
+            return self.store.vectors[field][rows, :dim], valid
+        blocks = self._blocks(sources)
+        norms = [np.einsum('ij,ij->i', block, block)[:, None] for block in blocks]
+        return np.hstack(blocks + norms)
+
+    def _fuse_query(self, query):
+        """Fused vector (D,) of an encoded query (without norm columns)"""
+        def sources(field, dim):
+            if field in SCALAR_INDEX:
+                index = SCALAR_INDEX[field]
+                return query['scalars'][None, index:index + 1], np.ones(1, dtype=bool)
+            vector = query['vectors'].get(field)
+            if vector is None or len(vector) != dim:
+                return np.zeros((1, dim), dtype=np.float32), np.zeros(1, dtype=bool)
+            return vector[None, :], np.ones(1, dtype=bool)
+        return np.hstack(self._blocks(sources))[0]
+
+    def _index_rows(self, rows, block_size=65536):
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        if rows.max() >= len(self.matrix):
+            capacity = max(self.store.capacity, rows.max() + 1)
+            grown = np.zeros((capacity, self.matrix.shape[1]), dtype=np.float32)
+            grown[:len(self.matrix)] = self.matrix
+            self.matrix = grown
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            self.matrix[block] = self._fuse_rows(block)
+
+    def _on_store_change(self, event, row):
+        if not self.is_built():
+            return
+        if event == 'remove':
+            if row < len(self.matrix):
+                self.matrix[row] = 0.0
+        elif event == 'upsert':
+            self._index_rows([row])
+
+    def build(self):
+        """Fix block sizes from the gallery and fuse every row"""
+        with self.store.lock:
+            rows = self.store.live_rows()
+            dims = {}
+            for _, field, _, _ in FUSED_BLOCKS:
+                if field in SCALAR_INDEX:
+                    dims[field] = 1
+                    continue
+                lengths = self.store.lengths[field][rows]
+                lengths = lengths[lengths > 0]
+                dims[field] = int(np.bincount(lengths).argmax()) if len(lengths) else 0
+            self.dims = dims
+            self.built_rows = len(rows)
+            width = len(self._fuse_query(self.store.encode({}))) + len(FUSED_BLOCKS)
+            self.matrix = np.zeros((self.store.capacity, width), dtype=np.float32)
+            self.weight_vectors = {}
+            self._index_rows(rows)
+
+    def weight_vector(self, class_name):
+        """Per-dimension query weights and norm-column weights of a class profile (cached)"""
+        key = (class_name or '').lower()
+        if key not in self.weight_vectors:
+            weights = self.class_weights(class_name)
+            block_weights = np.array([
+                weights.get(family, 0.0) * share for family, _, _, share in FUSED_BLOCKS
+            ], dtype=np.float32)
+            dims = self.matrix.shape[1] - len(FUSED_BLOCKS)
+            expanded = np.zeros(dims, dtype=np.float32)
+            start = 0
+            for (_, field, mapping, _), weight in zip(FUSED_BLOCKS, block_weights):
+                width = 2 if mapping == 'angle' else self.dims[field]
+                expanded[start:start + width] = weight
+                start += width
+            self.weight_vectors[key] = (expanded, -0.5 * block_weights)
+        return self.weight_vectors[key]
+
+    def score(self, query, class_name, rows):
+        """
+        Fused similarity of a query against rows with the class's default weights
+
+        Returns:
+            Array of scores aligned with rows (only meaningful for ranking)
+        """
+        if not self.is_built() or (self.built_rows == 0 and self.store.row_of):
+            # Block sizes come from the gallery, so an empty build is redone
+            self.build()
+        query_weights, norm_weights = self.weight_vector(class_name)
+        weighted_query = np.concatenate([self._fuse_query(query) * query_weights, norm_weights])
+        return self.matrix[rows] @ weighted_query
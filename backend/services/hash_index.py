@@ -0,0 +1,351 @@
+"""
+Image Hash Index for the CBIR System
+Persisted perceptual hashes and content digests of uploaded images, with a
+Hamming-radius index so duplicate checks on upload are lookups instead of
+a folder scan
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+HASH_VARIANTS = ('average', 'difference', 'perceptual')
+
+
+def image_hashes(image_path):
+    """
+    64-bit perceptual hashes of an image file, as 16 hex digits each
+
+    - average: 8x8 grey levels compared with their mean (aHash)
+    - difference: 9x8 grey levels, each pixel compared with its right
+      neighbour (dHash; robust to brightness and contrast changes)
+    - perceptual: 8x8 lowest frequencies of a 32x32 DCT compared with their
+      median (pHash; robust to re-encoding and mild edits)
+
+    Returns:
+        Dict variant -> hex string, or None if the file cannot be decoded
+    """
+    img = cv2.imread(str(image_path))
+    if img is None:
+        return None
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    img_small = cv2.cvtColor(cv2.resize(img, (8, 8)), cv2.COLOR_BGR2GRAY)
+    average = img_small > img_small.mean()
+
+    wide = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    difference = wide[:, 1:] > wide[:, :-1]
+
+    dct = cv2.dct(cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32))
+    low = dct[:8, :8]
+    # The DC term only carries overall brightness
+    perceptual = low > np.median(low.flatten()[1:])
+
+    return {
+        name: np.packbits(bits.flatten()).tobytes().hex()
+        for name, bits in (('average', average), ('difference', difference),
+                           ('perceptual', perceptual))
+    }
+
+
+class HammingIndex:
+    """
+    Multi-index hashing over 64-bit codes
+
+    Codes are split into `chunks` substrings, each with its own exact-match
+    table. Two codes within Hamming distance r agree within r // chunks bits
+    on at least one substring (pigeonhole), so a query only probes the
+    substrings' neighbours within that radius and verifies the candidates
+    with a full popcount. Lookups stay sub-linear for small radii, and
+    removal is a set discard.
+    """
+
+    def __init__(self, bits=64, chunks=4):
+        self.bits = bits
+        self.chunks = chunks
+        self.chunk_bits = bits // chunks
+        self.tables = [{} for _ in range(chunks)]
+        self.codes = {}
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _substrings(self, code):
+        mask = (1 << self.chunk_bits) - 1
+        return [(code >> (i * self.chunk_bits)) & mask for i in range(self.chunks)]
+
+    def _flip_masks(self, radius):
+        """Every chunk_bits-wide mask with at most radius bits set"""
+        if radius not in self._masks:
+            self._masks[radius] = [
+                sum(1 << bit for bit in combination)
+                for r in range(radius + 1)
+                for combination in itertools.combinations(range(self.chunk_bits), r)
+            ]
+        return self._masks[radius]
+
+    def add(self, key, code):
+        self.remove(key)
+        self.codes[key] = code
+        for table, substring in zip(self.tables, self._substrings(code)):
+            table.setdefault(substring, set()).add(key)
+
+    def remove(self, key):
+        code = self.codes.pop(key, None)
+        if code is None:
+            return
+        for table, substring in zip(self.tables, self._substrings(code)):
+            keys = table.get(substring)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del table[substring]
+
+    def query(self, code, radius):
+        """
+        Keys whose code is within Hamming distance radius
+
+        Returns:
+            List of (distance, key), closest first
+        """
+        candidates = set()
+        masks = self._flip_masks(min(radius // self.chunks, self.chunk_bits))
+        for table, substring in zip(self.tables, self._substrings(code)):
+            for mask in masks:
+                candidates.update(table.get(substring ^ mask, ()))
+        found = []
+        for key in candidates:
+            distance = bin(self.codes[key] ^ code).count('1')
+            if distance <= radius:
+                found.append((distance, key))
+        return sorted(found)
+
+    def query_batch(self, codes, radius):
+        """query() for many codes; returns one result list per code"""
+        return [self.query(code, radius) for code in codes]
+
+
+def content_digest(file_path, chunk_size=1 << 20):
+    """SHA-256 of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageHashIndex:
+    """
+    image_id -> perceptual hashes + content digest, persisted as JSON
+
+    A digest map finds byte-identical files and a HammingIndex over the
+    configured hash variant finds near-duplicates within a Hamming radius
+    (radius 0 only matches identical hashes). Entries remember the file
+    size and mtime they were computed from, so sync() only rehashes files
+    that changed.
+    """
+
+    def __init__(self, path, variant='average', radius=0):
+        """
+        Args:
+            path: JSON file holding the index (e.g. database/image_hashes.json)
+            variant: Hash used for near-duplicates ('average', 'difference'
+                or 'perceptual')
+            radius: Largest Hamming distance (of 64 bits) counted as a duplicate
+        """
+        if variant not in HASH_VARIANTS:
+            raise ValueError(f'Unknown hash variant: {variant}')
+        self.path = Path(path)
+        self.variant = variant
+        self.radius = radius
+        self.entries = {}
+        self.by_digest = {}
+        self.hamming = HammingIndex()
+        self.lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f).get('images', {})
+        except (OSError, ValueError):
+            return
+        for image_id, entry in entries.items():
+            self._insert(image_id, entry)
+
+    def save(self):
+        """Persist atomically (tmp file + rename)"""
+        with self.lock:
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({'images': self.entries}, f)
+            tmp_path.replace(self.path)
+
+    def code_for(self, entry):
+        """
+        Integer code of an index entry's configured hash variant, for
+        Hamming lookups (e.g. a HammingIndex over one upload batch)
+
+        Returns:
+            int, or None if the file could not be decoded
+        """
+        value = (entry.get('hashes') or {}).get(self.variant)
+        return int(value, 16) if value else None
+
+    def _insert(self, image_id, entry):
+        self._discard(image_id)
+        self.entries[image_id] = entry
+        code = self.code_for(entry)
+        if code is not None:
+            self.hamming.add(image_id, code)
+        self.by_digest.setdefault(entry['digest'], set()).add(image_id)
+
+    def _discard(self, image_id):
+        entry = self.entries.pop(image_id, None)
+        if entry is None:
+            return
+        self.hamming.remove(image_id)
+        ids = self.by_digest.get(entry['digest'])
+        if ids is not None:
+            ids.discard(image_id)
+            if not ids:
+                del self.by_digest[entry['digest']]
+
+    @staticmethod
+    def compute(file_path):
+        """Index entry of a file: perceptual hashes, digest, size and mtime"""
+        stat = os.stat(file_path)
+        return {
+            'hashes': image_hashes(file_path),
+            'digest': content_digest(file_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime
+        }
+
+    def add(self, image_id, file_path, entry=None, persist=True):
+        """Index (or re-index) an image file"""
+        entry = entry or self.compute(file_path)
+        with self.lock:
+            self._insert(image_id, entry)
+            if persist:
+                self.save()
+        return entry
+
+    def remove(self, image_id, persist=True):
+        with self.lock:
+            if image_id in self.entries:
+                self._discard(image_id)
+                if persist:
+                    self.save()
+
+    def find(self, entry, exclude=None, radius=None):
+        """
+        Image id holding the same (or nearly the same) content as entry, or None
+
+        An identical digest wins; otherwise the closest image whose hash is
+        within the Hamming radius (re-encoded, resized or lightly edited
+        copy) is reported.
+        """
+        return self.find_batch([entry], exclude, radius)[0]
+
+    def find_batch(self, entries, exclude=None, radius=None):
+        """find() for many entries (e.g. one bulk upload); one id or None per entry"""
+        radius = self.radius if radius is None else radius
+        results = []
+        with self.lock:
+            codes = [self.code_for(entry) for entry in entries]
+            matches = self.hamming.query_batch(
+                [code for code in codes if code is not None], radius
+            )
+            matches = iter(matches)
+            for entry, code in zip(entries, codes):
+                found = [image_id for image_id in sorted(self.by_digest.get(entry['digest'], ()))
+                         if image_id != exclude]
+                near = next(matches) if code is not None else []
+                found += [image_id for _, image_id in near if image_id != exclude]
+                results.append(found[0] if found else None)
+        return results
+
+    def near_duplicates(self, image_id, radius=None):
+        """
+        Stored images within the Hamming radius of a stored image
+
+        Returns:
+            List of {'image_id', 'distance'}, closest first
+        """
+        radius = self.radius if radius is None else radius
+        with self.lock:
+            code = self.code_for(self.entries.get(image_id, {}))
+            if code is None:
+                return []
+            return [
+                {'image_id': other, 'distance': distance}
+                for distance, other in self.hamming.query(code, radius) if other != image_id
+            ]
+
+    def sync(self, files):
+        """
+        Bring the index in line with the current files
+
+        Args:
+            files: Dict image_id -> file path of every image that exists
+
+        Returns:
+            Number of files (re)hashed
+        """
+        hashed = 0
+        with self.lock:
+            for image_id in set(self.entries) - set(files):
+                self._discard(image_id)
+            changed = len(self.entries) != len(files)
+            for image_id, file_path in files.items():
+                entry = self.entries.get(image_id)
+                stat = os.stat(file_path)
+                if entry and 'hashes' in entry and entry.get('size') == stat.st_size and \
+                        entry.get('mtime') == stat.st_mtime:
+                    continue
+                self._insert(image_id, self.compute(file_path))
+                hashed += 1
+            if hashed or changed:
+                self.save()
+        return hashed
+
+    def rebuild(self, files):
+        """Drop every entry and hash all files again"""
+        with self.lock:
+            self.entries, self.by_digest, self.hamming = {}, {}, HammingIndex()
+            return self.sync(files)
+
+
+def main():
+    """Rebuild the index for a folder filled out of band: python -m services.hash_index"""
+    from .image_manager import IMAGE_EXTENSIONS
+
+    parser = argparse.ArgumentParser(description='Rebuild the image hash index')
+    parser.add_argument('--uploads', default='uploads')
+    parser.add_argument('--index', default='database/image_hashes.json')
+    args = parser.parse_args()
+
+    files = {
+        path.stem: path for path in Path(args.uploads).iterdir()
+        if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS
+    }
+    index = ImageHashIndex(args.index)
+    hashed = index.rebuild(files)
+    duplicates = sum(len(ids) - 1 for ids in index.by_digest.values())
+    print(f'{hashed} images hashed, {duplicates} exact duplicates in {args.uploads}')
+
+
+if __name__ == '__main__':
+    main()
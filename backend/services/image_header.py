@@ -0,0 +1,105 @@
+"""
+Image Header Reader for the CBIR System
+Width and height of JPEG, PNG, GIF and BMP files parsed from their headers,
+so catalog entries never decode pixels
+"""
+
+import struct
+
+# JPEG start-of-frame markers (all but DHT, JPG and DAC in 0xC0-0xCF)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD9)}
+# EXIF orientations with the image stored rotated by 90 degrees
+EXIF_TRANSPOSED = {5, 6, 7, 8}
+
+
+def _exif_orientation(segment):
+    """EXIF orientation tag of an APP1 segment body, or None"""
+    if not segment.startswith(b'Exif\x00\x00'):
+        return None
+    tiff = segment[6:]
+    if tiff[:2] == b'II':
+        order = '<'
+    elif tiff[:2] == b'MM':
+        order = '>'
+    else:
+        return None
+    try:
+        (ifd_offset,) = struct.unpack_from(order + 'I', tiff, 4)
+        (count,) = struct.unpack_from(order + 'H', tiff, ifd_offset)
+        for i in range(count):
+            tag, _, _, value = struct.unpack_from(order + 'HHI2s', tiff, ifd_offset + 2 + 12 * i)
+            if tag == 0x0112:
+                return struct.unpack(order + 'H', value)[0]
+    except struct.error:
+        return None
+    return None
+
+
+def _jpeg_size(f):
+    orientation = None
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        # Fill bytes before a marker
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS or marker == 0x00:
+            continue
+        if marker in (0xD9, 0xDA):
+            # End of image / start of scan before any frame header
+            return None
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if marker in JPEG_SOF_MARKERS:
+            header = f.read(5)
+            if len(header) < 5:
+                return None
+            height, width = struct.unpack('>xHH', header)
+            if orientation in EXIF_TRANSPOSED:
+                # Decoders apply the orientation, so report the displayed size
+                width, height = height, width
+            return width, height
+        if marker == 0xE1 and orientation is None:
+            orientation = _exif_orientation(f.read(length - 2))
+        else:
+            f.seek(length - 2, 1)
+
+
+def read_image_size(path):
+    """
+    (width, height) of an image file from its header
+
+    Only the first bytes (JPEG: the segments up to the frame header) are
+    read. JPEG sizes follow the EXIF orientation, like cv2.imread.
+
+    Returns:
+        (width, height), or None for other formats or malformed headers
+    """
+    with open(path, 'rb') as f:
+        head = f.read(26)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:2] == b'BM' and len(head) >= 26:
+            (header_size,) = struct.unpack('<I', head[14:18])
+            if header_size == 12:
+                return struct.unpack('<HH', head[18:22])
+            width, height = struct.unpack('<ii', head[18:26])
+            # Negative height marks a top-down bitmap
+            return abs(width), abs(height)
+        if head[:2] == b'\xff\xd8':
+            return _jpeg_size(f)
+    return None
@@ -1,6 +1,11 @@
 # /home/muhammed/Documents/SmartGallery/backend/services/image_manager.py
 
 import os
+import base64
+import bisect
+import hashlib
+import json
+import threading
 import uuid
 from pathlib import Path
 from werkzeug.utils import secure_filename
@@ -8,158 +13,414 @@ import cv2
 import numpy as np
 from datetime import datetime
 
+from .hash_index import ImageHashIndex, HammingIndex
+from .image_header import read_image_size
+from .thumbnail_cache import ThumbnailCache
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+
+
 class ImageManager:
     """Service for managing image files"""
     
-    def __init__(self, upload_folder):
+    def __init__(self, upload_folder, similarity_service=None, catalog_path=None,
+                 hash_index_path=None, duplicate_hash='average', duplicate_radius=0,
+                 thumbnail_folder=None, thumbnail_sizes=(128, 256, 512, 1024),
+                 thumbnail_format='webp', thumbnail_quality=None, pregenerate_thumbnails=()):
+        """
+        Args:
+            upload_folder: Folder holding uploaded images
+            similarity_service: SimilaritySearchService whose entries are
+                removed together with deleted images
+            catalog_path: JSON sidecar persisting the image catalog
+                (default: .catalog.json in upload_folder)
+            hash_index_path: JSON file of the duplicate-detection hash index
+                (default: .hashes.json in upload_folder)
+            duplicate_hash: Hash compared for near-duplicate uploads
+                ('average', 'difference' or 'perceptual')
+            duplicate_radius: Largest Hamming distance (of 64 bits) at which
+                an upload counts as a duplicate (0 = identical hash)
+            thumbnail_folder: Cache folder of resized derivatives
+                (default: .thumbnails in upload_folder)
+            thumbnail_sizes: Widths derivatives are generated at
+            thumbnail_format: Default derivative format ('webp' or 'jpeg')
+            thumbnail_quality: Default quality per format, e.g. {'webp': 80}
+            pregenerate_thumbnails: Widths generated right at upload (others
+                are generated on first request)
+        """
         self.upload_folder = Path(upload_folder)
         self.upload_folder.mkdir(parents=True, exist_ok=True)
-
-    def _compute_image_hash(self, image_path):
-        """Compute perceptual hash of image for duplicate detection"""
-        img = cv2.imread(str(image_path))
-        if img is None:
-            return None
-        
-        # Resize to small size for quick comparison
-        img_small = cv2.resize(img, (8, 8))
-        img_gray = cv2.cvtColor(img_small, cv2.COLOR_BGR2GRAY)
+        self.similarity_service = similarity_service
+        self.catalog_path = Path(catalog_path) if catalog_path else \
+            self.upload_folder / '.catalog.json'
+        # image_id -> {filename, ext, width, height, size, mtime}
+        self.catalog = {}
+        self.lock = threading.RLock()
+        # Bumped on every catalog change; with the instance id it tags listings (ETag)
+        self.version = 0
+        self.instance_id = uuid.uuid4().hex[:8]
+        # (mtime, image_id) of every image in upload order, rebuilt after changes
+        self._order = []
+        self._order_version = -1
+        self._load_catalog()
+        self.hash_index = ImageHashIndex(
+            hash_index_path or self.upload_folder / '.hashes.json',
+            variant=duplicate_hash, radius=duplicate_radius
+        )
+        # Hashes only files that are new or changed since the index was saved
+        self.hash_index.sync(self._catalog_files())
+        self.thumbnails = ThumbnailCache(
+            thumbnail_folder or self.upload_folder / '.thumbnails',
+            sizes=thumbnail_sizes, default_format=thumbnail_format, quality=thumbnail_quality
+        )
+        self.pregenerate_thumbnails = tuple(pregenerate_thumbnails)
+    
+    # ------------------------------------------------------------------
+    # Catalog
+    # ------------------------------------------------------------------
+    
+    def _read_dimensions(self, filepath):
+        """(width, height) of an image file from its header, (0, 0) if unreadable"""
+        try:
+            size = read_image_size(filepath)
+        except OSError:
+            size = None
+        if size is not None:
+            return int(size[0]), int(size[1])
+        # Unknown or malformed header: let the decoder decide
+        img = cv2.imread(str(filepath))
+        height, width = img.shape[:2] if img is not None else (0, 0)
+        return int(width), int(height)
+    
+    def _catalog_entry(self, filepath, width=None, height=None):
+        """Catalog entry of a file (dimensions read from it unless given)"""
+        if width is None or height is None:
+            width, height = self._read_dimensions(filepath)
+        stat = filepath.stat()
+        return {
+            'filename': filepath.name,
+            'ext': filepath.suffix.lower().lstrip('.'),
+            'width': int(width),
+            'height': int(height),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime
+        }
+    
+    def _load_catalog(self):
+        """
+        Load the sidecar and reconcile it with the upload folder
         
-        # Compute average hash
-        avg = img_gray.mean()
-        hash_bits = (img_gray > avg).flatten()
+        Only a directory listing and a stat per file: known files whose size
+        and mtime still match are not opened. New or changed files are read
+        once, vanished ones dropped.
+        """
+        stored = {}
+        if self.catalog_path.exists():
+            try:
+                with open(self.catalog_path) as f:
+                    stored = json.load(f).get('images', {})
+            except (OSError, ValueError):
+                stored = {}
         
-        # Convert to hex string
-        hash_bytes = np.packbits(hash_bits)
-        import hashlib
-        return hashlib.md5(hash_bytes.tobytes()).hexdigest()
-
-    def _find_duplicate(self, new_image_path):
-        """Check if image already exists in database"""
-        new_hash = self._compute_image_hash(new_image_path)
-        if not new_hash:
-            return None
+        catalog = {}
+        with os.scandir(self.upload_folder) as entries:
+            for entry in entries:
+                filepath = Path(entry.path)
+                if not entry.is_file() or filepath.suffix.lower() not in IMAGE_EXTENSIONS:
+                    continue
+                image_id = filepath.stem
+                known = stored.get(image_id)
+                stat = entry.stat()
+                if known and known.get('filename') == filepath.name and \
+                        known.get('size') == stat.st_size and known.get('mtime') == stat.st_mtime:
+                    catalog[image_id] = known
+                else:
+                    catalog[image_id] = self._catalog_entry(filepath)
         
-        # Check all existing images
-        for filepath in self.upload_folder.glob('*'):
-            if (filepath.is_file() and 
-                filepath != Path(new_image_path) and 
-                filepath.suffix.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']):
-                existing_hash = self._compute_image_hash(filepath)
-                if existing_hash == new_hash:
-                    # Found duplicate
-                    return {
-                        'image_id': filepath.stem,
-                        'filename': filepath.name
-                    }
-        return None
+        with self.lock:
+            self.catalog = catalog
+            self.version += 1
+            if catalog != stored:
+                self._save_catalog()
     
+    def _save_catalog(self):
+        """Persist the catalog atomically (tmp file + rename)"""
+        tmp_path = self.catalog_path.with_name(self.catalog_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'images': self.catalog}, f)
+        tmp_path.replace(self.catalog_path)
+    
+    def _add_to_catalog(self, image_id, filepath, width=None, height=None, persist=True):
+        with self.lock:
+            self.catalog[image_id] = self._catalog_entry(filepath, width, height)
+            self.version += 1
+            if persist:
+                self._save_catalog()
+            return self.catalog[image_id]
+    
+    def _remove_from_catalog(self, image_id):
+        with self.lock:
+            if self.catalog.pop(image_id, None) is not None:
+                self.version += 1
+                self._save_catalog()
+    
+    def _catalog_files(self):
+        """image_id -> path of every catalogued file"""
+        with self.lock:
+            return {
+                image_id: self.upload_folder / entry['filename']
+                for image_id, entry in self.catalog.items()
+            }
+    
+    def rebuild_hash_index(self):
+        """Rehash every image (for folders populated out of band); returns the count"""
+        self._load_catalog()
+        return self.hash_index.rebuild(self._catalog_files())
+    
+    def _image_info(self, image_id, entry):
+        return {
+            'image_id': image_id,
+            'filename': entry['filename'],
+            'width': entry['width'],
+            'height': entry['height'],
+            'uploaded_at': datetime.fromtimestamp(entry['mtime']).isoformat(),
+            'url': f'/api/images/file/{entry["filename"]}'
+        }
+
     def save_image(self, file):
         """Save uploaded image file (with duplicate detection)"""
-        filename = secure_filename(file.filename)
-        image_id = str(uuid.uuid4())
-        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'jpg'
-        new_filename = f"{image_id}.{ext}"
-        filepath = self.upload_folder / new_filename
+        return self.save_images([file])[0]
+    
+    def save_images(self, files):
+        """
+        Save uploaded image files with one batched duplicate check
         
-        # Save temporarily
-        file.save(str(filepath))
+        Every file is hashed once and all of them are looked up in the hash
+        index together; files of the same batch are also checked against
+        each other. Duplicates are dropped and reported with the existing
+        image's info.
         
-        # ✅ CHECK FOR DUPLICATES
-        duplicate = self._find_duplicate(filepath)
-        if duplicate:
-            # Remove the temporary file
-            filepath.unlink()
-            
-            # Return existing image info with duplicate flag
-            existing_img = cv2.imread(str(self.upload_folder / duplicate['filename']))
-            height, width = existing_img.shape[:2] if existing_img is not None else (0, 0)
+        Returns:
+            List of upload results, aligned with files
+        """
+        uploads = []
+        for file in files:
+            filename = secure_filename(file.filename)
+            image_id = str(uuid.uuid4())
+            ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'jpg'
+            new_filename = f"{image_id}.{ext}"
+            filepath = self.upload_folder / new_filename
             
-            return {
-                'image_id': duplicate['image_id'],
-                'filename': duplicate['filename'],
-                'original_filename': filename,
-                'path': str(self.upload_folder / duplicate['filename']),
-                'width': int(width),
-                'height': int(height),
-                'uploaded_at': datetime.now().isoformat(),
-                'duplicate': True,  # ← Flag indicating it's a duplicate
-                'message': 'This image already exists in the database'
-            }
+            # Save temporarily
+            file.save(str(filepath))
+            uploads.append((image_id, filename, filepath, self.hash_index.compute(filepath)))
         
-        # Not a duplicate, keep the new file
-        img = cv2.imread(str(filepath))
-        height, width = img.shape[:2] if img is not None else (0, 0)
+        # ✅ CHECK FOR DUPLICATES - Batched index lookup, only new files are hashed
+        matches = self.hash_index.find_batch([upload[3] for upload in uploads])
+        batch_hamming = HammingIndex()
+        batch_digests = {}
         
-        return {
-            'image_id': image_id,
-            'filename': new_filename,
-            'original_filename': filename,
-            'path': str(filepath),
-            'width': int(width),
-            'height': int(height),
-            'uploaded_at': datetime.now().isoformat(),
-            'duplicate': False
-        }
-    
-    def get_all_images(self):
-        """Get list of all images"""
-        images = []
-        for filepath in self.upload_folder.glob('*'):
-            if filepath.is_file() and filepath.suffix.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
-                image_id = filepath.stem
-                img = cv2.imread(str(filepath))
-                height, width = img.shape[:2] if img is not None else (0, 0)
+        results = []
+        with self.lock:
+            for (image_id, filename, filepath, hash_entry), match in zip(uploads, matches):
+                if match is None:
+                    # Same image twice in one upload
+                    match = batch_digests.get(hash_entry['digest'])
+                    code = self.hash_index.code_for(hash_entry)
+                    if match is None and code is not None:
+                        near = batch_hamming.query(code, self.hash_index.radius)
+                        match = near[0][1] if near else None
+                
+                duplicate = self.catalog.get(match) if match else None
+                if duplicate is not None:
+                    # Remove the temporary file
+                    filepath.unlink()
+                    results.append({
+                        'image_id': match,
+                        'filename': duplicate['filename'],
+                        'original_filename': filename,
+                        'path': str(self.upload_folder / duplicate['filename']),
+                        'width': int(duplicate['width']),
+                        'height': int(duplicate['height']),
+                        'uploaded_at': datetime.now().isoformat(),
+                        'duplicate': True,  # ← Flag indicating it's a duplicate
+                        'message': 'This image already exists in the database'
+                    })
+                    continue
                 
-                images.append({
+                # Not a duplicate, keep the new file
+                entry = self._add_to_catalog(image_id, filepath, persist=False)
+                self.hash_index.add(image_id, filepath, hash_entry, persist=False)
+                batch_digests[hash_entry['digest']] = image_id
+                code = self.hash_index.code_for(hash_entry)
+                if code is not None:
+                    batch_hamming.add(image_id, code)
+                
+                results.append({
                     'image_id': image_id,
                     'filename': filepath.name,
-                    'width': int(width),
-                    'height': int(height),
-                    'url': f'/api/images/file/{filepath.name}'
+                    'original_filename': filename,
+                    'path': str(filepath),
+                    'width': int(entry['width']),
+                    'height': int(entry['height']),
+                    'uploaded_at': datetime.now().isoformat(),
+                    'duplicate': False
                 })
-        return images
+            
+            self._save_catalog()
+            self.hash_index.save()
+        
+        for result in results:
+            if not result['duplicate']:
+                self._pregenerate(result['image_id'])
+        return results
+    
+    def get_thumbnail(self, image_id, width, fmt=None, quality=None):
+        """
+        Path of a resized derivative of an image (generated on first use)
+        
+        Returns:
+            Path, or None if the image does not exist or cannot be decoded
+        """
+        entry = self.catalog.get(image_id)
+        if entry is None:
+            return None
+        return self.thumbnails.get(
+            image_id, self.upload_folder / entry['filename'], width,
+            fmt=fmt, quality=quality, source_width=entry['width']
+        )
+    
+    def _pregenerate(self, image_id):
+        for width in self.pregenerate_thumbnails:
+            self.get_thumbnail(image_id, width)
+    
+    def find_near_duplicates(self, image_id, radius=None):
+        """
+        Stored images whose hash is within the Hamming radius of an image's
+        
+        Returns:
+            List of {'image_id', 'distance', 'filename'}, closest first
+        """
+        return [
+            {**match, 'filename': self.catalog[match['image_id']]['filename']}
+            for match in self.hash_index.near_duplicates(image_id, radius)
+            if match['image_id'] in self.catalog
+        ]
+    
+    def _upload_order(self):
+        """(mtime, image_id) of all images, oldest first (cached per catalog version)"""
+        with self.lock:
+            if self._order_version != self.version:
+                self._order = sorted((entry['mtime'], image_id) for image_id, entry in self.catalog.items())
+                self._order_version = self.version
+            return self._order
+    
+    @staticmethod
+    def encode_cursor(key):
+        """Opaque page cursor for a (mtime, image_id) sort key"""
+        return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip('=')
+    
+    @staticmethod
+    def decode_cursor(cursor):
+        """Sort key of a cursor; raises ValueError if it is malformed"""
+        try:
+            mtime, image_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            return float(mtime), str(image_id)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+    
+    def list_images(self, limit=50, cursor=None, newest_first=True, class_name=None, has_features=None):
+        """
+        One page of the gallery in upload order
+        
+        The cursor is the sort key of the last image of the previous page, so
+        pages stay consistent while images are added or deleted.
+        
+        Args:
+            limit: Page size
+            cursor: next_cursor of the previous page (None for the first page)
+            newest_first: Sort by upload time descending (else ascending)
+            class_name: Only images with a detection of this class (from the
+                feature store's class -> images index)
+            has_features: If set, only images with (True) / without (False)
+                extracted features
+            
+        Returns:
+            Dict with 'images', 'next_cursor' (None on the last page) and
+            'total' (images matching the filters)
+        """
+        store_filter = class_name is not None or has_features is not None
+        if store_filter and self.similarity_service is None:
+            raise ValueError('Filters need the similarity service')
+        
+        with self.lock:
+            if class_name is not None:
+                # Only the class's images are sorted, not the whole catalog
+                order = sorted(
+                    (self.catalog[image_id]['mtime'], image_id)
+                    for image_id in self.similarity_service.get_images_with_class(class_name)
+                    if image_id in self.catalog
+                )
+            else:
+                order = self._upload_order()
+            if has_features is not None:
+                order = [key for key in order
+                         if self.similarity_service.has_features(key[1]) == has_features]
+            
+            if newest_first:
+                end = bisect.bisect_left(order, self.decode_cursor(cursor)) if cursor else len(order)
+                page = order[max(0, end - limit):end][::-1]
+                more = end - limit > 0
+            else:
+                start = bisect.bisect_right(order, self.decode_cursor(cursor)) if cursor else 0
+                page = order[start:start + limit]
+                more = start + limit < len(order)
+            
+            return {
+                'images': [self._image_info(image_id, self.catalog[image_id]) for _, image_id in page],
+                'next_cursor': self.encode_cursor(page[-1]) if more and page else None,
+                'total': len(order)
+            }
+    
+    def listing_tag(self, *params, features=False):
+        """
+        Validator of a listing: changes whenever the catalog (or, with
+        features=True, the feature store) changes. Used as the ETag.
+        """
+        state = [self.instance_id, self.version]
+        if features and self.similarity_service is not None:
+            state.append(self.similarity_service.store.generation)
+        return hashlib.sha1(json.dumps(state + list(params)).encode()).hexdigest()
     
     def get_image(self, image_id):
-        """Get single image info"""
-        for filepath in self.upload_folder.glob(f'{image_id}.*'):
-            if filepath.is_file():
-                img = cv2.imread(str(filepath))
-                height, width = img.shape[:2] if img is not None else (0, 0)
-                
-                return {
-                    'image_id': image_id,
-                    'filename': filepath.name,
-                    'width': int(width),
-                    'height': int(height),
-                    'url': f'/api/images/file/{filepath.name}'
-                }
-        return None
+        """Get single image info (catalog lookup)"""
+        entry = self.catalog.get(image_id)
+        if entry is None:
+            return None
+        return self._image_info(image_id, entry)
     
     def get_image_path(self, image_id):
         """Get full path to image file"""
-        for filepath in self.upload_folder.glob(f'{image_id}.*'):
-            if filepath.is_file():
-                return str(filepath)
-        return None
+        entry = self.catalog.get(image_id)
+        if entry is None:
+            return None
+        return str(self.upload_folder / entry['filename'])
     
     def delete_image(self, image_id):
         """Delete an image and its database entries"""
-        from services.similarity_search import SimilaritySearchService
-        from pathlib import Path
-        
         # Delete physical file
         deleted = False
         for filepath in self.upload_folder.glob(f'{image_id}.*'):
             if filepath.is_file():
                 filepath.unlink()
                 deleted = True
+        self._remove_from_catalog(image_id)
+        self.hash_index.remove(image_id)
+        self.thumbnails.invalidate(image_id)
         
         # Delete from features database
-        if deleted:
-            db_path = Path(__file__).parent.parent / 'database' / 'features.json'
-            similarity_service = SimilaritySearchService(str(db_path))
-            similarity_service.delete_image_data(image_id)
+        if deleted and self.similarity_service is not None:
+            self.similarity_service.delete_image_data(image_id)
         
         return deleted
     
@@ -266,6 +527,9 @@ class ImageManager:
         cv2.imwrite(str(new_path), img)
         
         height, width = img.shape[:2]
+        self._add_to_catalog(new_id, new_path, width, height)
+        self.hash_index.add(new_id, new_path)
+        self._pregenerate(new_id)
         
         return {
             'image_id': new_id,
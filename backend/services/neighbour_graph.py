@@ -0,0 +1,299 @@
+"""
+Neighbour Graph for the CBIR System
+Precomputed top-K neighbour lists of every stored object, kept current by a
+background thread, so "more like this" searches become a lookup
+"""
+
+import threading
+
+import numpy as np
+
+
+class NeighbourGraph:
+    """
+    Top-K neighbour lists under each class's default weights
+
+    For every row the graph keeps its K best same-class neighbours (objects
+    of its own image excluded, like the search endpoint does) with their
+    visual similarity, plus the lowest similarity over all its candidates.
+    That minimum and the best neighbour are the range the search normalizes
+    scores with, so a lookup ranks exactly like a live scan.
+
+    Changes arrive through the store listener and only mark work:
+    - an added / rewritten / relabelled row is queued; the background thread
+      scores it against its class partition (its own list) and merges it
+      into the lists of the rows it beats (similarity is symmetric). Only
+      lists built before the row was queued are merged into; later ones
+      already met it in their own scan
+    - a removed row is dropped from the lists holding it; the rest of such a
+      list is still the exact top of the remaining candidates. Rows whose
+      minimum was the removed row, or whose list ran low, are queued again
+
+    A class with queued rows is answered by live scans until it is caught up.
+    The graph lives in memory and is rebuilt in the background on startup.
+    """
+
+    def __init__(self, service, k=50, batch_size=64):
+        """
+        Args:
+            service: SimilaritySearchService whose store and scorers are used
+            k: Neighbours kept per object (largest top_k a lookup can answer)
+            batch_size: Queued rows scored per background step (holds the
+                store lock for one (batch x class partition) score matrix)
+        """
+        self.service = service
+        self.store = service.store
+        self.k = k
+        self.batch_size = batch_size
+
+        self.neighbours = np.full((0, k), -1, dtype=np.int32)
+        self.similarity = np.full((0, k), -np.inf, dtype=np.float32)
+        self.min_similarity = np.zeros(0, dtype=np.float32)
+        self.min_row = np.full(0, -1, dtype=np.int32)
+        self.ready = np.zeros(0, dtype=bool)
+        # Sequence number of each row's last full scan (_set_list)
+        self.built = np.zeros(0, dtype=np.int64)
+        self.sequence = 0
+        # class code -> queued rows; inserted rows (-> sequence number when
+        # queued) are also merged into others' lists
+        self.pending = {}
+        self.inserted = {}
+
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+        with self.store.lock:
+            self._grow()
+            for row in self.store.live_rows():
+                self._queue(int(row), inserted=True)
+        self.store.add_listener(self._on_store_change)
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+
+    def _grow(self):
+        capacity = self.store.capacity
+        if capacity <= len(self.ready):
+            return
+        extra = capacity - len(self.ready)
+        self.neighbours = np.vstack([self.neighbours, np.full((extra, self.k), -1, dtype=np.int32)])
+        self.similarity = np.vstack([
+            self.similarity, np.full((extra, self.k), -np.inf, dtype=np.float32)
+        ])
+        self.min_similarity = np.concatenate([self.min_similarity, np.zeros(extra, dtype=np.float32)])
+        self.min_row = np.concatenate([self.min_row, np.full(extra, -1, dtype=np.int32)])
+        self.ready = np.concatenate([self.ready, np.zeros(extra, dtype=bool)])
+        self.built = np.concatenate([self.built, np.zeros(extra, dtype=np.int64)])
+
+    def _queue(self, row, inserted=False):
+        code = int(self.store.row_class[row])
+        if code >= 0:
+            self.pending.setdefault(code, set()).add(row)
+            if inserted:
+                self.sequence += 1
+                self.inserted[row] = self.sequence
+        self.wakeup.set()
+
+    def _unqueue(self, row):
+        for rows in self.pending.values():
+            rows.discard(row)
+        self.inserted.pop(row, None)
+
+    def _clear(self, row):
+        """Forget a row's own list"""
+        self.ready[row] = False
+        self.neighbours[row] = -1
+        self.similarity[row] = -np.inf
+        self.min_row[row] = -1
+
+    def _purge(self, row):
+        """Drop a row from every list holding it (its current features may be gone)"""
+        size = self.store.size
+        holders = np.flatnonzero((self.neighbours[:size] == row).any(axis=1))
+        if len(holders):
+            hit = self.neighbours[holders] == row
+            self.neighbours[holders] = np.where(hit, -1, self.neighbours[holders])
+            self.similarity[holders] = np.where(hit, -np.inf, self.similarity[holders])
+            self._sort_lists(holders)
+            # Low lists are refilled before they stop answering typical top_k
+            low = holders[(self.neighbours[holders] >= 0).sum(axis=1) < self.k // 2]
+            for holder in low:
+                self._queue(int(holder))
+        # The range of rows whose minimum was this row is unknown now
+        for holder in np.flatnonzero(self.min_row[:size] == row):
+            self._queue(int(holder))
+
+    def _sort_lists(self, rows):
+        """Order lists best first, ties by row (empty slots last)"""
+        neighbours = self.neighbours[rows]
+        similarity = self.similarity[rows]
+        tie_rows = np.where(neighbours >= 0, neighbours, np.iinfo(np.int32).max)
+        # Ranked like the search: on clipped scores
+        order = np.lexsort((tie_rows, -np.clip(similarity, 0.0, 1.0)), axis=-1)
+        self.neighbours[rows] = np.take_along_axis(neighbours, order, axis=1)
+        self.similarity[rows] = np.take_along_axis(similarity, order, axis=1)
+
+    def _on_store_change(self, event, row):
+        self._grow()
+        if self.ready[row]:
+            # Only rows that were scored can appear in other lists
+            self._purge(row)
+        self._unqueue(row)
+        self._clear(row)
+        if event in ('upsert', 'relabel'):
+            self._queue(row, inserted=True)
+
+    def is_current(self, class_name):
+        """True when no row of the class waits for the background thread"""
+        code = self.store.class_code(class_name)
+        return code >= 0 and not self.pending.get(code)
+
+    def _next_batch(self):
+        """Up to batch_size queued rows of one class (and the class code)"""
+        for code, rows in self.pending.items():
+            if rows:
+                limit = max(1, min(
+                    self.batch_size,
+                    self.service.BATCH_SCORE_ELEMENTS // max(1, len(self.store.rows_for_class(
+                        self.store.class_names[code]
+                    )))
+                ))
+                batch = sorted(rows)[:limit]
+                rows.difference_update(batch)
+                return code, np.array(batch, dtype=np.int64)
+        return None, None
+
+    def step(self):
+        """
+        Score one batch of queued rows
+
+        Returns:
+            False when nothing was queued
+        """
+        store = self.store
+        with store.lock:
+            code, batch = self._next_batch()
+            if batch is None:
+                return False
+            class_name = store.class_names[code]
+            rows = store.rows_for_class(class_name)
+            weights = self.service._get_class_weights(class_name)
+            encoded = [store.encode(store.get(*store.keys[row])) for row in batch]
+            visual = self.service._score_rows_batch(encoded, rows, weights)
+
+            queued = np.fromiter(self.pending[code], dtype=np.int64, count=len(self.pending[code]))
+            merge_into = rows[self.ready[rows] & ~np.isin(rows, batch) & ~np.isin(rows, queued)]
+            position = np.searchsorted(rows, merge_into)
+
+            for row, scores in zip(batch, visual):
+                own = np.isin(rows, store.image_rows(store.keys[row][0]))
+                self._set_list(row, rows[~own], scores[~own])
+                if row not in self.inserted:
+                    # Refreshed list only: the others already know this row
+                    continue
+                inserted = self.inserted.pop(row)
+                # Symmetric similarity: the new row is a candidate of every other
+                # row whose list was built without it
+                others = ~np.isin(merge_into, rows[own]) & (self.built[merge_into] < inserted)
+                self._merge(row, merge_into[others], scores[position[others]])
+            return True
+
+    def _set_list(self, row, candidates, scores):
+        """Own top-K and minimum of a row from its full candidate scores"""
+        self._clear(row)
+        self.min_similarity[row] = 0.0
+        if len(candidates):
+            final = np.clip(scores, 0.0, 1.0).astype(np.float64)
+            best = self.service._select_top_k(final, self.k, -np.inf)
+            self.neighbours[row, :len(best)] = candidates[best]
+            self.similarity[row, :len(best)] = scores[best]
+            lowest = int(np.argmin(final))
+            self.min_similarity[row] = scores[lowest]
+            self.min_row[row] = candidates[lowest]
+        self.ready[row] = True
+        self.sequence += 1
+        self.built[row] = self.sequence
+
+    def _merge(self, row, targets, scores):
+        """Offer row with the given similarities to the lists of targets"""
+        # A list never holds a row twice
+        fresh = ~(self.neighbours[targets] == row).any(axis=1)
+        targets, scores = targets[fresh], scores[fresh]
+        final = np.clip(scores, 0.0, 1.0)
+        lower = final < np.clip(self.min_similarity[targets], 0.0, 1.0)
+        self.min_similarity[targets[lower]] = scores[lower]
+        self.min_row[targets[lower]] = row
+
+        worst = np.clip(self.similarity[targets, -1], 0.0, 1.0)
+        full = self.neighbours[targets, -1] >= 0
+        enters = ~full | (final > worst) | ((final == worst) & (row < self.neighbours[targets, -1]))
+        targets, scores = targets[enters], scores[enters]
+        if len(targets) == 0:
+            return
+        self.neighbours[targets, -1] = row
+        self.similarity[targets, -1] = scores
+        self._sort_lists(targets)
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(timeout=1.0)
+            self.wakeup.clear()
+            while not self.stopped and self.step():
+                pass
+
+    def start(self):
+        """Start the background thread (idempotent)"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='neighbour-graph', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    # ------------------------------------------------------------------
+    # Lookup
+    # ------------------------------------------------------------------
+
+    def lookup(self, row, class_name, top_k):
+        """
+        Precomputed candidates of a stored row
+
+        Returns:
+            (rows, visual_similarity, score_range) for SimilaritySearchService
+            ranking, rows in candidate order; None when the class is not caught
+            up or the list cannot answer top_k
+        """
+        if not self.is_current(class_name) or row >= len(self.ready) or not self.ready[row] \
+                or self.store.row_class[row] != self.store.class_code(class_name):
+            return None
+        valid = self.neighbours[row] >= 0
+        neighbours = self.neighbours[row, valid].astype(np.int64)
+        similarity = self.similarity[row, valid]
+
+        if len(neighbours) < top_k:
+            # Only enough if the list holds every candidate of the row
+            rows = self.store.rows_for_class(class_name)
+            own = np.isin(rows, self.store.image_rows(self.store.keys[row][0]))
+            if len(neighbours) < len(rows) - own.sum():
+                return None
+        if len(neighbours) == 0:
+            return neighbours, similarity, None
+
+        order = np.argsort(neighbours)
+        score_range = (
+            float(np.clip(self.min_similarity[row], 0.0, 1.0)),
+            float(np.clip(similarity[0], 0.0, 1.0))
+        )
+        return neighbours[order], similarity[order], score_range
+
+    def get_statistics(self):
+        """Queue length and answered rows for /api/stats"""
+        with self.store.lock:
+            return {
+                'neighbours': self.k,
+                'ready': int(self.ready[:self.store.size].sum()),
+                'queued': sum(len(rows) for rows in self.pending.values())
+            }
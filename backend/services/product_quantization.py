@@ -0,0 +1,393 @@
+"""
+Product Quantization for the CBIR System
+Compresses each object's concatenated descriptor into a few dozen bytes and
+scores queries with asymmetric distance tables (ADC)
+"""
+
+import threading
+
+import numpy as np
+from pathlib import Path
+
+from .ann_index import kmeans, nearest_centroids
+from .feature_store import SCALAR_INDEX
+
+
+# Blocks concatenated into the compressed descriptor: (source field, mapping,
+# weight). Mappings make squared L2 roughly track each family metric, and the
+# weights mirror the default family weights times the share of each part in
+# its family score, so L2 over the whole descriptor approximates the
+# weighted similarity used for the final ranking.
+EMBEDDING_BLOCKS = (
+    ('color.hist_rgb', 'sqrt', 0.25 * 0.7),
+    ('color.mean_rgb', 'rgb', 0.25 * 0.1),
+    ('texture_tamura.coarseness', ('scale', 10.0), 0.15 * 0.5),
+    ('texture_tamura.contrast', ('scale', 100.0), 0.15 * 0.3),
+    ('texture_tamura.directionality', ('scale', 5.0), 0.15 * 0.2),
+    ('texture_gabor.gabor_responses', 'unit', 0.15),
+    ('texture_lbp.lbp_hist', 'sqrt', 0.10 * 0.8),
+    ('texture_lbp.lbp_mean', ('scale', 255.0), 0.10 * 0.1),
+    ('texture_lbp.lbp_std', ('scale', 100.0), 0.10 * 0.1),
+    ('shape_hu.hu_moments', 'hu', 0.10),
+    ('shape_hog.hog', 'unit', 0.15),
+    ('shape_contour.orientation_hist', 'sqrt', 0.10 * 0.6),
+    ('shape_contour.main_orientation', 'angle', 0.10 * 0.25),
+    ('shape_contour.orientation_variance', ('scale', 1.0), 0.10 * 0.15)
+)
+
+
+def embed_block(mapping, matrix):
+    """Map one block (N, d) into the compressed descriptor space"""
+    if mapping == 'sqrt':
+        # Hellinger embedding: L2 on square roots tracks histogram distances
+        return np.sqrt(np.maximum(matrix, 0.0))
+    if mapping == 'unit':
+        # Cosine similarity becomes 1 - L2^2 / 2 on unit vectors
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms > 0, norms, 1.0)
+    if mapping == 'rgb':
+        return matrix / 441.67
+    if mapping == 'hu':
+        # Imported here: similarity_search imports this module
+        from .similarity_search import SimilaritySearchService
+        # Log-transformed Hu moments span roughly 0-20
+        weights = np.sqrt(SimilaritySearchService.HU_MOMENT_WEIGHTS[:matrix.shape[1]])
+        return matrix * weights / 10.0
+    if mapping == 'angle':
+        # Orientations wrap at 180 degrees
+        radians = np.deg2rad(matrix[:, :1]) * 2.0
+        return np.hstack([np.cos(radians), np.sin(radians)]) / 2.0
+    _, divisor = mapping
+    return matrix / divisor
+
+
+class ProductQuantizer:
+    """
+    Product quantizer with 256 centroids per subspace (one byte per code)
+
+    The descriptor is split into n_subspaces equal slices, each quantized
+    with its own k-means codebook.
+    """
+
+    def __init__(self, n_subspaces=32, n_centroids=256):
+        self.n_subspaces = n_subspaces
+        self.n_centroids = n_centroids
+        self.codebooks = None
+
+    def is_trained(self):
+        return self.codebooks is not None
+
+    def _split(self, vectors):
+        """(N, D) -> (n_subspaces, N, D / n_subspaces)"""
+        n, dim = vectors.shape
+        return vectors.reshape(n, self.n_subspaces, dim // self.n_subspaces).transpose(1, 0, 2)
+
+    def train(self, vectors):
+        """Learn one codebook per subspace"""
+        subspaces = self._split(vectors)
+        n_centroids = min(self.n_centroids, len(vectors))
+        self.codebooks = np.stack([
+            kmeans(subspace, n_centroids, seed=i) for i, subspace in enumerate(subspaces)
+        ])
+
+    def encode(self, vectors):
+        """Quantize vectors to (N, n_subspaces) uint8 codes"""
+        codes = np.empty((len(vectors), self.n_subspaces), dtype=np.uint8)
+        for i, subspace in enumerate(self._split(vectors)):
+            codes[:, i] = nearest_centroids(subspace, self.codebooks[i])
+        return codes
+
+    def distance_tables(self, query):
+        """(n_subspaces, n_centroids) squared distances from query slices to centroids"""
+        slices = query.reshape(self.n_subspaces, -1)
+        return np.sum((self.codebooks - slices[:, None, :]) ** 2, axis=2)
+
+    def adc(self, tables, codes, block_size=65536):
+        """Asymmetric distances: sum of table lookups per code"""
+        distances = np.empty(len(codes), dtype=np.float32)
+        subspace_ids = np.arange(self.n_subspaces)[None, :]
+        for start in range(0, len(codes), block_size):
+            block = codes[start:start + block_size]
+            distances[start:start + len(block)] = tables[subspace_ids, block].sum(axis=1)
+        return distances
+
+
+class CompressedFeatureIndex:
+    """
+    PQ codes for every object in a FeatureStore
+
+    Searches compute ADC distances over the compact codes to shortlist
+    candidates; only the shortlist is scored on the full-precision features.
+    Codebooks are persisted next to the database and codes are rebuilt from
+    the store on startup. Codes follow the store through its row listener.
+
+    Like ANNIndex, training never runs inside a search: a background thread
+    (start()) trains once the gallery reaches min_train_rows and retrains
+    after it quadrupled, holding the store lock only to copy descriptors and
+    to install the result. Until then searches skip the PQ stage.
+    """
+
+    def __init__(self, store, path, n_subspaces=32, min_train_rows=4096):
+        """
+        Args:
+            store: FeatureStore to compress
+            path: File for persisted codebooks (e.g. database/features.pq.npz)
+            n_subspaces: Bytes per object code
+            min_train_rows: Below this many objects searches skip the PQ stage
+        """
+        self.store = store
+        self.path = Path(path)
+        self.min_train_rows = min_train_rows
+        self.quantizer = ProductQuantizer(n_subspaces)
+        self.dims = {}
+        self.trained_rows = 0
+        self.codes = np.zeros((0, n_subspaces), dtype=np.uint8)
+        self.encoded = np.zeros(0, dtype=bool)
+        # Rows changed while a training run works outside the lock
+        self.dirty = None
+        self.training = threading.Lock()
+
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+        self._load()
+        store.add_listener(self._on_store_change)
+
+    # ------------------------------------------------------------------
+    # Descriptors
+    # ------------------------------------------------------------------
+
+    def _padded_dim(self, dim):
+        m = self.quantizer.n_subspaces
+        return -(-dim // m) * m
+
+    def _embed(self, sources, dims=None):
+        """
+        Concatenate weighted blocks into descriptors
+
+        Args:
+            sources: Callable(field, dim) -> (N, dim) matrix and (N,) validity mask
+            dims: Block sizes (default: the trained ones)
+        """
+        dims = self.dims if dims is None else dims
+        blocks = []
+        for field, mapping, weight in EMBEDDING_BLOCKS:
+            matrix, valid = sources(field, dims[field])
+            block = embed_block(mapping, matrix) * np.float32(np.sqrt(weight))
+            blocks.append(np.where(valid[:, None], block, 0.0).astype(np.float32))
+        matrix = np.hstack(blocks)
+        padded = np.zeros((len(matrix), self._padded_dim(matrix.shape[1])), dtype=np.float32)
+        padded[:, :matrix.shape[1]] = matrix
+        return padded
+
+    def embed_rows(self, rows, dims=None):
+        """Concatenated descriptors (len(rows), D) for stored rows"""
+        def sources(field, dim):
+            if field in SCALAR_INDEX:
+                # Absent scalars read as 0, like in the exact scorer
+                values = self.store.scalars[rows, SCALAR_INDEX[field]][:, None]
+                return values, np.ones(len(rows), dtype=bool)
+            valid = self.store.lengths[field][rows] == dim
+            return self.store.vectors[field][rows, :dim], valid
+        return self._embed(sources, dims)
+
+    def embed_query(self, query):
+        """Concatenated descriptor (D,) for an encoded query"""
+        def sources(field, dim):
+            if field in SCALAR_INDEX:
+                return query['scalars'][None, SCALAR_INDEX[field]:SCALAR_INDEX[field] + 1], \
+                    np.ones(1, dtype=bool)
+            vector = query['vectors'].get(field)
+            if vector is None or len(vector) != dim:
+                return np.zeros((1, dim), dtype=np.float32), np.zeros(1, dtype=bool)
+            return vector[None, :], np.ones(1, dtype=bool)
+        return self._embed(sources)[0]
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+
+    def is_trained(self):
+        return self.quantizer.is_trained()
+
+    def _encode_rows(self, rows, block_size=65536):
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0 or not self.is_trained():
+            return
+        if rows.max() >= len(self.codes):
+            capacity = max(self.store.capacity, rows.max() + 1)
+            codes = np.zeros((capacity, self.quantizer.n_subspaces), dtype=np.uint8)
+            codes[:len(self.codes)] = self.codes
+            encoded = np.zeros(capacity, dtype=bool)
+            encoded[:len(self.encoded)] = self.encoded
+            self.codes, self.encoded = codes, encoded
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            self.codes[block] = self.quantizer.encode(self.embed_rows(block))
+            self.encoded[block] = True
+
+    def _on_store_change(self, event, row):
+        if self.dirty is not None:
+            self.dirty.add(int(row))
+        if event == 'upsert':
+            self.wakeup.set()
+        if not self.is_trained():
+            return
+        if event == 'remove':
+            if row < len(self.encoded):
+                self.encoded[row] = False
+        elif event == 'upsert':
+            self._encode_rows([row])
+
+    def train(self, block_size=65536):
+        """
+        Learn codebooks from a sample of the gallery and encode every row
+
+        k-means and the encoding run without the store lock, on descriptors
+        copied block by block; rows changed in the meantime are re-encoded
+        when the new codes are installed. A call made while another training
+        run is in progress returns at once.
+
+        Returns:
+            True when the index can be used
+        """
+        if not self.training.acquire(blocking=False):
+            return self.is_ready()
+        try:
+            return self._train(block_size)
+        finally:
+            self.training.release()
+
+    def _train(self, block_size):
+        with self.store.lock:
+            rows = self.store.live_rows()
+            if len(rows) == 0:
+                return False
+            rng = np.random.default_rng(0)
+            sample = rows if len(rows) <= 50000 else np.sort(rng.choice(rows, 50000, replace=False))
+
+            dims = {}
+            for field, _, _ in EMBEDDING_BLOCKS:
+                if field in SCALAR_INDEX:
+                    dims[field] = 1
+                    continue
+                lengths = self.store.lengths[field][sample]
+                lengths = lengths[lengths > 0]
+                dims[field] = int(np.bincount(lengths).argmax()) if len(lengths) else 0
+            sample_vectors = self.embed_rows(sample, dims)
+            self.dirty = set()
+
+        quantizer = ProductQuantizer(self.quantizer.n_subspaces, self.quantizer.n_centroids)
+        quantizer.train(sample_vectors)
+        codes = np.zeros((rows[-1] + 1, quantizer.n_subspaces), dtype=np.uint8)
+        encoded = np.zeros(rows[-1] + 1, dtype=bool)
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            with self.store.lock:
+                vectors = self.embed_rows(block, dims)
+            codes[block] = quantizer.encode(vectors)
+            encoded[block] = True
+
+        with self.store.lock:
+            self.quantizer = quantizer
+            self.dims = dims
+            self.trained_rows = len(rows)
+            self.codes, self.encoded = codes, encoded
+            dirty, self.dirty = self.dirty, None
+            dirty = np.array(sorted(dirty), dtype=np.int64)
+            self.encoded[dirty[dirty < len(self.encoded)]] = False
+            self._encode_rows(dirty[self.store.alive[dirty]])
+            if not self.store.read_only:
+                self.save()
+            return True
+
+    def needs_training(self):
+        """Gallery big enough and no codebooks, or the gallery quadrupled since training"""
+        live = len(self.store.row_of)
+        return live >= self.min_train_rows and \
+            (not self.is_trained() or live > 4 * self.trained_rows)
+
+    def is_ready(self):
+        """True when searches may be shortlisted on the codes"""
+        return self.is_trained() and len(self.store.row_of) >= self.min_train_rows
+
+    def _run(self):
+        while not self.stopped:
+            if self.needs_training():
+                self.train()
+            self.wakeup.wait(timeout=5.0)
+            self.wakeup.clear()
+
+    def start(self):
+        """Start the background training thread (idempotent)"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='pq-training', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    # ------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------
+
+    def shortlist(self, query, rows, keep):
+        """
+        Keep the rows whose compressed descriptors are closest to the query
+
+        Args:
+            query: Encoded query (FeatureStore.encode)
+            rows: Candidate rows
+            keep: Shortlist size
+
+        Returns:
+            Sorted array of rows, or None when the PQ stage does not apply
+        """
+        if len(rows) <= keep or not self.is_ready():
+            # Not trained yet (the background thread is on it): no shortlist
+            return None
+
+        tables = self.quantizer.distance_tables(self.embed_query(query))
+        distances = self.quantizer.adc(tables, self.codes[rows])
+        # Rows without a code (never encoded) are always kept
+        distances[~self.encoded[rows]] = -np.inf
+        best = np.argpartition(distances, keep - 1)[:keep]
+        return np.sort(rows[best])
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self):
+        if not self.is_trained():
+            return
+        arrays = {
+            'trained_rows': np.array(self.trained_rows),
+            'codebooks': self.quantizer.codebooks,
+            'fields': np.array([field for field, _, _ in EMBEDDING_BLOCKS]),
+            'dims': np.array([self.dims[field] for field, _, _ in EMBEDDING_BLOCKS])
+        }
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        tmp_path.replace(self.path)
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with np.load(self.path) as data:
+            codebooks = data['codebooks']
+            if codebooks.shape[0] != self.quantizer.n_subspaces:
+                # Saved with a different code size: retrain on demand
+                return
+            dims = {str(field): int(dim) for field, dim in zip(data['fields'], data['dims'])}
+            if set(dims) != {field for field, _, _ in EMBEDDING_BLOCKS}:
+                # Saved with a different descriptor layout: retrain on demand
+                return
+            self.quantizer.codebooks = codebooks
+            self.trained_rows = int(data['trained_rows'])
+            self.dims = dims
+        with self.store.lock:
+            self._encode_rows(self.store.live_rows())
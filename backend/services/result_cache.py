@@ -0,0 +1,90 @@
+"""
+Search Result Cache for the CBIR System
+Small LRU + TTL cache for similarity search results, invalidated by the
+feature store's generation counter
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SearchResultCache:
+    """
+    LRU cache of search results with a time-to-live
+
+    Entries are only valid for the database generation they were computed
+    at: as soon as the generation moves (any write to the feature store),
+    the whole cache is dropped on the next access.
+    """
+
+    def __init__(self, max_entries=256, ttl=300.0):
+        """
+        Args:
+            max_entries: Cached queries kept (0 disables the cache)
+            ttl: Seconds an entry stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _sync(self, generation):
+        """Drop everything computed at another generation"""
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        """
+        Cached value for key, or None
+
+        Args:
+            key: Hashable query key
+            generation: Current database generation
+        """
+        if self.max_entries <= 0:
+            return None
+        with self.lock:
+            self._sync(generation)
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, generation):
+        """Store a value computed at the given database generation"""
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self._sync(generation)
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_statistics(self):
+        """Hit/miss counters for /api/stats"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl
+            }
@@ -1,68 +1,188 @@
 # /home/muhammed/Documents/SmartGallery/backend/services/similarity_search.py
 
-import json
 import numpy as np
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime
 from sklearn.preprocessing import normalize
 
+from .feature_store import FeatureStore, FAMILY_INDEX, SCALAR_INDEX
+from .ann_index import ANNIndex
+from .product_quantization import CompressedFeatureIndex
+from .result_cache import SearchResultCache
+from .fused_index import FusedDescriptorIndex
+from .neighbour_graph import NeighbourGraph
+
 class SimilaritySearchService:
     """Service for similarity search and feature database management"""
     
-    def __init__(self, database_path):
-        self.database_path = Path(database_path)
-        self.database = self._load_database()
+    # Weight used for a feature family when the weights dict does not name it
+    FALLBACK_WEIGHTS = {
+        'color': 0.3,
+        'texture_tamura': 0.2,
+        'texture_gabor': 0.2,
+        'texture_lbp': 0.10,
+        'shape_hu': 0.15,
+        'shape_hog': 0.15,
+        'shape_contour': 0.10
+    }
+    
+    # Earlier (more significant) Hu moments weigh more
+    HU_MOMENT_WEIGHTS = np.array([1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4], dtype=np.float32)
+    
+    # Upper bound on elements of intermediate (queries x candidates [x dims])
+    # arrays in batch search
+    BATCH_SCORE_ELEMENTS = 1 << 24
+    
+    # Below this many candidates per shard, sharding costs more than it saves
+    SHARD_MIN_ROWS = 4096
     
-    def _load_database(self):
-        """Load feature database from JSON"""
-        if self.database_path.exists():
-            with open(self.database_path, 'r') as f:
-                return json.load(f)
-        return {'images': {}, 'metadata': {'created': datetime.now().isoformat()}}
+    def __init__(self, database_path, ann_index=False, ann_min_rows=2048, ann_probes=16,
+                 pq_index=False, pq_min_rows=4096, pq_shortlist=1000, pq_bytes=32,
+                 feature_spill_dir=None, cascade_size=0, result_cache_size=256,
+                 result_cache_ttl=300.0, histogram_embedding=None, fused_index=False,
+                 fused_shortlist=500, score_cache_size=32, search_shards=1,
+                 search_workers=None, neighbour_graph=False, graph_neighbours=50,
+                 read_only=False):
+        """
+        Args:
+            database_path: Feature store directory (e.g. database/features.store).
+                A features.json next to it is imported on first start.
+            ann_index: If True, prune candidates with an approximate
+                nearest-neighbour index before exact scoring
+            ann_min_rows: Gallery size (objects) from which the index is used
+            ann_probes: Default number of index buckets probed per query
+            pq_index: If True, shortlist candidates on product-quantized codes
+                before scoring them on full-precision features
+            pq_min_rows: Gallery size (objects) from which the PQ stage is used
+            pq_shortlist: Candidates kept for exact scoring after the PQ stage
+            pq_bytes: Code size per object
+            feature_spill_dir: Scratch folder for disk-backed feature columns
+                (keeps full-precision features out of resident memory)
+            cascade_size: Default number of candidates the cheap first stage
+                keeps for full scoring (0 disables the cascade)
+            result_cache_size: Searches kept in the result cache (0 disables it)
+            result_cache_ttl: Seconds a cached search result stays valid
+            histogram_embedding: None for exact chi-square, or 'hellinger' /
+                'additive_chi2' to score histograms as inner products of
+                explicitly mapped histograms (approximate, see README)
+            fused_index: If True, default-weight queries rank candidates with
+                one matrix-vector product over fused per-object descriptors
+                and only re-score the best fused_shortlist exactly
+            fused_shortlist: Candidates kept for exact scoring after the fused stage
+            score_cache_size: Searches whose per-family score vectors are kept
+                for re-weighting by query token (0 disables it)
+            search_shards: Slices the full-precision scoring stage is split
+                into (1 = single-threaded); each slice keeps its own top-k
+            search_workers: Threads scoring shards (None = search_shards)
+            neighbour_graph: If True, a background thread keeps the top
+                graph_neighbours of every stored object, and default-weight
+                searches of stored objects are answered from them
+            graph_neighbours: Neighbours kept per object
+            read_only: Open the feature store read-only (batch tools next
+                to a running server); writes raise
+        """
+        self.database_path = Path(database_path)
+        self.store = FeatureStore(
+            self.database_path,
+            legacy_path=self.database_path.with_suffix('.json'),
+            spill_dir=feature_spill_dir,
+            histogram_map=histogram_embedding,
+            read_only=read_only
+        )
+        self.ann_index = None
+        if ann_index:
+            self.ann_index = ANNIndex(
+                self.store,
+                self.database_path.with_suffix('.ann.npz'),
+                min_train_rows=ann_min_rows,
+                default_probes=ann_probes
+            )
+            self.ann_index.start()
+        self.pq_index = None
+        self.pq_shortlist = pq_shortlist
+        self.cascade_size = cascade_size
+        self.result_cache = SearchResultCache(result_cache_size, result_cache_ttl)
+        # Per-family score vectors by query token (same generation/TTL rules)
+        self.score_cache = SearchResultCache(score_cache_size, result_cache_ttl)
+        self.fused_index = None
+        self.fused_shortlist = fused_shortlist
+        if fused_index:
+            self.fused_index = FusedDescriptorIndex(self.store, self._get_class_weights)
+        self.search_shards = max(1, search_shards)
+        self.shard_pool = None
+        if self.search_shards > 1:
+            # NumPy releases the GIL in the heavy kernels, so threads share the
+            # feature matrices without copying them into worker processes
+            self.shard_pool = ThreadPoolExecutor(
+                max_workers=search_workers or self.search_shards,
+                thread_name_prefix='search-shard'
+            )
+        self.neighbour_graph = None
+        if neighbour_graph:
+            self.neighbour_graph = NeighbourGraph(self, k=graph_neighbours)
+            self.neighbour_graph.start()
+        if pq_index:
+            self.pq_index = CompressedFeatureIndex(
+                self.store,
+                self.database_path.with_suffix('.pq.npz'),
+                n_subspaces=pq_bytes,
+                min_train_rows=pq_min_rows
+            )
+            self.pq_index.start()
     
     def _save_database(self):
-        """Save feature database to JSON"""
-        self.database['metadata']['updated'] = datetime.now().isoformat()
-        with open(self.database_path, 'w') as f:
-            json.dump(self.database, f, indent=2)
+        """Persist pending changes to the feature store's write log"""
+        self.store.commit()
+    
+    def batch(self):
+        """
+        Transaction context for bulk writes
+
+        Usage:
+            with similarity_service.batch():
+                similarity_service.save_detections(...)
+                similarity_service.save_features(...)
+
+        All mutations are persisted once, atomically, when the block exits.
+        """
+        return self.store.batch()
     
     def save_detections(self, image_id, detections):
         """Save object detections for an image"""
-        if image_id not in self.database['images']:
-            self.database['images'][image_id] = {'detections': [], 'features': []}
-        
-        self.database['images'][image_id]['detections'] = detections
+        self.store.set_detections(image_id, detections)
         self._save_database()
     
     def get_detections(self, image_id):
         """Get detections for an image"""
-        if image_id in self.database['images']:
-            return self.database['images'][image_id].get('detections', [])
+        if image_id in self.store.images:
+            return self.store.images[image_id].get('detections', [])
         return None
     
+    def get_images_with_class(self, class_name):
+        """Image ids with a detection of a class (index lookup)"""
+        with self.store.lock:
+            return self.store.images_with_class(class_name)
+    
+    def has_features(self, image_id):
+        """True if features were extracted for any object of the image"""
+        return self.store.has_features(image_id)
+    
     def save_features(self, image_id, object_id, features):
         """Save extracted features for an object"""
-        if image_id not in self.database['images']:
-            self.database['images'][image_id] = {'detections': [], 'features': []}
-        
-        # Ensure features list is long enough
-        while len(self.database['images'][image_id]['features']) <= object_id:
-            self.database['images'][image_id]['features'].append(None)
-        
-        self.database['images'][image_id]['features'][object_id] = features
+        self.store.put(image_id, object_id, features)
         self._save_database()
     
     def get_features(self, image_id, object_id):
         """Get features for a specific object"""
-        if image_id in self.database['images']:
-            features_list = self.database['images'][image_id].get('features', [])
-            if object_id < len(features_list):
-                return features_list[object_id]
-        return None
+        return self.store.get(image_id, object_id)
     
     def find_similar(self, query_features, query_class, top_k=10, weights=None, 
                  exclude_image_id=None, same_class_only=True, class_weight=0.8,
-                 normalize_scores=True):
+                 normalize_scores=True, ann_probes=None, cascade_size=None,
+                 stats=None, query_key=None, query_token=None, keep_scores=False,
+                 live_scan=False):
         """
         Find similar objects based on feature similarity with advanced normalization
         
@@ -75,81 +195,357 @@ class SimilaritySearchService:
             same_class_only: If True, only return objects of same class (RECOMMENDED)
             class_weight: Weight for class matching bonus (0.0 to 1.0)
             normalize_scores: If True, apply score normalization for better distribution
+            ann_probes: Index buckets probed per descriptor when the ANN index is
+                enabled (higher = better recall, slower); 0 forces an exact scan
+            cascade_size: Candidates kept by the cheap first stage (mean colour,
+                RGB histogram, Hu moments) for full scoring; 0 disables the
+                cascade, None uses the service default
+            stats: Optional dict, filled with the number of candidates each
+                search stage evaluated (left empty on a cache hit)
+            query_key: Optional (image_id, object_id) of the stored query
+                object; enables the result cache for this search
+            query_token: Token of an earlier keep_scores search of the same
+                query (same query_key, class and exclusion); if its score
+                vectors are still cached, they are only recombined with the
+                new weights (no scan)
+            keep_scores: If True, cache this search's per-family score
+                vectors and put their token in stats['query_token']. The
+                weight-dependent stages (fused, cascade) are skipped so the
+                vectors cover every candidate
+            live_scan: If True, never answer from the neighbour graph
             
         Returns:
             List of similar objects with scores
         """
         # Get class-specific weights if not provided
+        default_weights = weights is None
         if weights is None:
             weights = self._get_class_weights(query_class)
-        
-        similarities = []
-        
-        for image_id, data in self.database['images'].items():
+        if cascade_size is None:
+            cascade_size = self.cascade_size
+        stats = {} if stats is None else stats
+        
+        store = self.store
+        with store.lock:
+            # ✅ RE-WEIGHTING - Recombine cached family scores, no scan
+            if query_token is not None:
+                entry = self.score_cache.get(query_token, store.generation)
+                search = (query_key and tuple(query_key), query_class, exclude_image_id)
+                if entry is not None and entry['search'] == search:
+                    stats['reweighted'] = len(entry['rows'])
+                    stats['query_token'] = query_token
+                    visual_similarity = self._combine_family_scores(
+                        entry['scores'], entry['present'], weights
+                    )
+                    return self._rank_candidates(
+                        entry['rows'], visual_similarity, entry['same_class'], query_class,
+                        top_k, entry['same_class_only'], class_weight, normalize_scores
+                    )
+            
+            # ✅ RESULT CACHE - Same stored query, same options, same database
+            cache_key = None
+            if query_key is not None and not keep_scores:
+                cache_key = (
+                    tuple(query_key), query_class, top_k,
+                    json.dumps(weights, sort_keys=True), exclude_image_id,
+                    same_class_only, class_weight, normalize_scores,
+                    ann_probes, cascade_size
+                )
+                cached = self.result_cache.get(cache_key, store.generation)
+                if cached is not None:
+                    return [dict(result) for result in cached]
+            
+            # ✅ NEIGHBOUR GRAPH - Stored query, default weights: a lookup
+            if self.neighbour_graph is not None and default_weights and not live_scan \
+                    and not keep_scores and same_class_only and query_key is not None \
+                    and exclude_image_id == query_key[0]:
+                row = store.row_of.get((query_key[0], int(query_key[1])))
+                found = None if row is None else \
+                    self.neighbour_graph.lookup(row, query_class, top_k)
+                if found is not None:
+                    rows, visual_similarity, score_range = found
+                    stats['graph'] = len(rows)
+                    similarities = self._rank_candidates(
+                        rows, visual_similarity, np.ones(len(rows), dtype=bool), query_class,
+                        top_k, same_class_only, class_weight, normalize_scores, score_range
+                    )
+                    if cache_key is not None:
+                        self.result_cache.put(
+                            cache_key, [dict(result) for result in similarities], store.generation
+                        )
+                    return similarities
+            
+            # ✅ CLASS FILTERING - Only touch the query class partition
+            if same_class_only:
+                rows = store.rows_for_class(query_class)
+            else:
+                rows = store.live_rows()
+            
             # Skip excluded image
-            if image_id == exclude_image_id:
-                continue
+            if exclude_image_id is not None:
+                rows = rows[~np.isin(rows, store.image_rows(exclude_image_id))]
             
-            features_list = data.get('features', [])
-            detections = data.get('detections', [])
+            # ✅ ANN PRE-FILTER - Only re-rank the index's candidate set
+            query = store.encode(query_features)
+            if self.ann_index is not None:
+                candidates = self.ann_index.candidates(query, ann_probes)
+                if candidates is not None:
+                    rows = rows[np.isin(rows, candidates)]
             
-            for obj_idx, target_features in enumerate(features_list):
-                if not target_features:
-                    continue
-                
-                # Get detection info
-                detection_info = detections[obj_idx] if obj_idx < len(detections) else {}
-                target_class = detection_info.get('class', 'unknown')
-                
-                # ✅ CLASS FILTERING - Only compare same classes!
-                if same_class_only and target_class.lower() != query_class.lower():
-                    continue  # Skip different classes entirely
-                
-                # Compute visual similarity
-                visual_similarity = self._compute_similarity(
-                    query_features, 
-                    target_features, 
-                    weights
+            # ✅ PQ SHORTLIST - Rank on compressed codes, score only the closest
+            if self.pq_index is not None:
+                shortlist = self.pq_index.shortlist(query, rows, max(self.pq_shortlist, top_k))
+                if shortlist is not None:
+                    stats['pq'] = len(rows)
+                    rows = shortlist
+            
+            # ✅ FUSED STAGE - Default weights: one matvec over fused descriptors
+            keep = max(self.fused_shortlist, top_k)
+            if self.fused_index is not None and default_weights and not keep_scores \
+                    and len(rows) > keep:
+                stats['fused'] = len(rows)
+                fused_similarity = self.fused_index.score(query, query_class, rows)
+                rows = np.sort(rows[np.argpartition(-fused_similarity, keep - 1)[:keep]])
+            
+            # ✅ CASCADE - Cheap vectorized signals pick who gets the full score
+            keep = max(cascade_size, top_k)
+            if cascade_size > 0 and not keep_scores and len(rows) > keep:
+                stats['coarse'] = len(rows)
+                coarse_similarity = self._coarse_score_rows(query, rows, weights)
+                rows = np.sort(rows[np.argpartition(-coarse_similarity, keep - 1)[:keep]])
+            
+            stats['full'] = len(rows)
+            
+            same_class = store.row_class[rows] == store.class_code(query_class)
+            
+            # ✅ SHARDED SCORING - Score slices in parallel, merge per-shard top-k
+            if not keep_scores and self._use_shards(len(rows)):
+                rows, visual_similarity, same_class, score_range = self._score_shards(
+                    query, rows, weights, same_class, top_k, same_class_only, class_weight
                 )
+                similarities = self._rank_candidates(
+                    rows, visual_similarity, same_class, query_class, top_k,
+                    same_class_only, class_weight, normalize_scores, score_range
+                )
+                if cache_key is not None:
+                    self.result_cache.put(
+                        cache_key, [dict(result) for result in similarities], store.generation
+                    )
+                return similarities
+            
+            # Compute visual similarity for all candidates at once
+            scores, present = self._family_scores(query, rows)
+            visual_similarity = self._combine_family_scores(scores, present, weights)
+            if keep_scores:
+                stats['query_token'] = uuid.uuid4().hex
+                self.score_cache.put(stats['query_token'], {
+                    'rows': rows,
+                    'scores': scores,
+                    'present': present,
+                    'same_class': same_class,
+                    'same_class_only': same_class_only,
+                    'search': (query_key and tuple(query_key), query_class, exclude_image_id)
+                }, store.generation)
+            similarities = self._rank_candidates(
+                rows, visual_similarity, same_class, query_class, top_k,
+                same_class_only, class_weight, normalize_scores
+            )
+            
+            if cache_key is not None:
+                self.result_cache.put(
+                    cache_key, [dict(result) for result in similarities], store.generation
+                )
+        
+        return similarities
+    
+    def find_similar_batch(self, queries, top_k=10, weights=None, same_class_only=True,
+                           class_weight=0.8, normalize_scores=True):
+        """
+        Find similar objects for many query objects in one pass
+        
+        Queries are grouped by class so each group scans its class partition
+        once, and every feature family is scored as a (queries x candidates)
+        matrix. Results match find_similar with the ANN/PQ/cascade stages off.
+        
+        Args:
+            queries: List of dicts with 'features', 'class' and optionally
+                'exclude_image_id' (usually the query's own image)
+            top_k: Number of results per query
+            weights: Optional dict of feature weights (class profile if None)
+            same_class_only: If True, only return objects of the query's class
+            class_weight: Weight for class matching bonus (0.0 to 1.0)
+            normalize_scores: If True, apply score normalization per query
+            
+        Returns:
+            List of result lists, aligned with queries
+        """
+        results = [[] for _ in queries]
+        
+        groups = {}
+        for i, query in enumerate(queries):
+            key = query['class'] if same_class_only or weights is None else None
+            groups.setdefault(key, []).append(i)
+        
+        store = self.store
+        with store.lock:
+            all_rows = None if same_class_only else store.live_rows()
+            for query_class, members in groups.items():
+                # ✅ CLASS FILTERING - One partition scan per class
+                rows = store.rows_for_class(query_class) if same_class_only else all_rows
+                if len(rows) == 0:
+                    continue
+                group_weights = weights
+                if group_weights is None:
+                    group_weights = self._get_class_weights(query_class)
                 
-                # ✅ CLASS BONUS - If not filtering, give bonus for same class
-                if not same_class_only:
-                    if target_class.lower() == query_class.lower():
-                        # Same class: boost similarity
-                        final_similarity = visual_similarity * (1 - class_weight) + class_weight
-                    else:
-                        # Different class: reduce similarity
-                        final_similarity = visual_similarity * (1 - class_weight)
-                else:
-                    # Already filtered by class, no need for bonus
-                    final_similarity = visual_similarity
-                
-                # ✅ FIX: Clamp to [0, 1] range before storing
-                final_similarity = max(0.0, min(1.0, final_similarity))
-                visual_similarity = max(0.0, min(1.0, visual_similarity))
-                
-                similarities.append({
-                    'image_id': image_id,
-                    'object_id': obj_idx,
-                    'similarity': final_similarity,
-                    'visual_similarity': visual_similarity,
-                    'class': target_class,
-                    'confidence': detection_info.get('confidence', 0.0),
-                    'bbox': detection_info.get('bbox', [])
-                })
+                # Bound the (queries x candidates) score matrix
+                block = max(1, self.BATCH_SCORE_ELEMENTS // len(rows))
+                for start in range(0, len(members), block):
+                    block_members = members[start:start + block]
+                    encoded = [store.encode(queries[i]['features']) for i in block_members]
+                    visual = self._score_rows_batch(encoded, rows, group_weights)
+                    
+                    for i, visual_similarity in zip(block_members, visual):
+                        query = queries[i]
+                        keep = np.ones(len(rows), dtype=bool)
+                        if query.get('exclude_image_id') is not None:
+                            keep = ~np.isin(rows, store.image_rows(query['exclude_image_id']))
+                        same_class = store.row_class[rows[keep]] == store.class_code(query['class'])
+                        results[i] = self._rank_candidates(
+                            rows[keep], visual_similarity[keep], same_class, query['class'],
+                            top_k, same_class_only, class_weight, normalize_scores
+                        )
+        
+        return results
+    
+    def _use_shards(self, n_rows):
+        return self.shard_pool is not None and n_rows >= 2 * self.SHARD_MIN_ROWS
+    
+    def _score_shards(self, query, rows, weights, same_class, top_k, same_class_only,
+                      class_weight):
+        """
+        Full scoring stage split into contiguous shards of rows
+        
+        Each shard is scored in the thread pool and keeps only its top_k by
+        final similarity (min-max normalization is monotonic, so the global
+        top_k is among them) plus its score range for the normalization.
+        
+        Returns:
+            (rows, visual_similarity, same_class, (min, max)) of the merged
+            shard top-k lists, still in candidate order
+        """
+        n_shards = min(self.search_shards, len(rows) // self.SHARD_MIN_ROWS)
+        bounds = np.linspace(0, len(rows), n_shards + 1).astype(np.int64)
+        
+        def score_shard(start, stop):
+            visual = self._score_rows(query, rows[start:stop], weights)
+            final, _ = self._final_similarity(
+                visual, same_class[start:stop], same_class_only, class_weight
+            )
+            best = np.sort(self._select_top_k(final.astype(np.float64), top_k, -np.inf))
+            return start + best, visual[best], final.min(), final.max()
+        
+        shards = list(self.shard_pool.map(score_shard, bounds[:-1], bounds[1:]))
+        keep = np.concatenate([shard[0] for shard in shards])
+        visual_similarity = np.concatenate([shard[1] for shard in shards])
+        score_range = (
+            float(min(shard[2] for shard in shards)),
+            float(max(shard[3] for shard in shards))
+        )
+        return rows[keep], visual_similarity, same_class[keep], score_range
+    
+    def _final_similarity(self, visual_similarity, same_class, same_class_only, class_weight):
+        """Class bonus and clipping; returns (final, clipped visual) similarities"""
+        # ✅ CLASS BONUS - If not filtering, give bonus for same class
+        if not same_class_only:
+            final_similarity = np.where(
+                same_class,
+                visual_similarity * (1 - class_weight) + class_weight,  # Same class: boost
+                visual_similarity * (1 - class_weight)                  # Different class: reduce
+            )
+        else:
+            # Already filtered by class, no need for bonus
+            final_similarity = visual_similarity
+        
+        # ✅ FIX: Clamp to [0, 1] range before storing
+        final_similarity = np.clip(final_similarity, 0.0, 1.0)
+        visual_similarity = np.clip(visual_similarity, 0.0, 1.0)
+        return final_similarity, visual_similarity
+    
+    def _rank_candidates(self, rows, visual_similarity, same_class, query_class, top_k,
+                         same_class_only, class_weight, normalize_scores, score_range=None):
+        """
+        Turn candidate visual similarities into the final ranked results
+        
+        Applies the class bonus, normalization, class threshold and top-k
+        selection, and builds result dicts for the survivors only.
+        
+        Args:
+            score_range: (min, max) final similarity over the whole candidate
+                set when rows are only its per-shard top-k (see _score_shards)
+        
+        Returns:
+            List of result dicts, best first
+        """
+        store = self.store
+        final_similarity, visual_similarity = self._final_similarity(
+            visual_similarity, same_class, same_class_only, class_weight
+        )
         
         # ✅ SCORE NORMALIZATION - Better distribution
-        if normalize_scores and len(similarities) > 1:
-            similarities = self._normalize_similarity_scores(similarities)
+        scores = final_similarity.astype(np.float64)
+        if normalize_scores and (len(scores) > 1 or score_range is not None):
+            scores = self._normalize_similarity_scores(scores, score_range)
         
-        # ✅ APPLY CLASS-SPECIFIC THRESHOLD
-        min_threshold = self._get_class_threshold(query_class)
-        similarities = [s for s in similarities if s['similarity'] >= min_threshold]
+        # ✅ RANKING - Threshold and select top_k before building results
+        best = self._select_top_k(scores, top_k, self._get_class_threshold(query_class))
         
-        # Sort by similarity (descending)
-        similarities.sort(key=lambda x: x['similarity'], reverse=True)
+        similarities = []
+        for i in best:
+            image_id, obj_idx = store.keys[rows[i]]
+            detections = store.images[image_id].get('detections', [])
+            detection_info = detections[obj_idx] if obj_idx < len(detections) else {}
+            
+            similarities.append({
+                'image_id': image_id,
+                'object_id': obj_idx,
+                'similarity': float(scores[i]),
+                'visual_similarity': float(visual_similarity[i]),
+                'class': detection_info.get('class', 'unknown'),
+                'confidence': detection_info.get('confidence', 0.0),
+                'bbox': detection_info.get('bbox', [])
+            })
         
-        return similarities[:top_k]
+        return similarities
+    
+    def _select_top_k(self, scores, top_k, min_threshold):
+        """
+        Indices of the top_k scores at or above min_threshold, best first
+        
+        Uses a partial selection (argpartition) instead of a full sort; ties
+        keep candidate order, like a stable sort would.
+        
+        Args:
+            scores: Array of final similarities
+            top_k: Number of results to return
+            min_threshold: Class-specific minimum similarity
+            
+        Returns:
+            Array of indices into scores
+        """
+        # ✅ APPLY CLASS-SPECIFIC THRESHOLD
+        survivors = np.flatnonzero(scores >= min_threshold)
+        if top_k <= 0 or len(survivors) == 0:
+            return survivors[:0]
+        
+        if len(survivors) > top_k:
+            kth = np.partition(scores[survivors], len(survivors) - top_k)[len(survivors) - top_k]
+            # Everything strictly better than the k-th score, plus ties in candidate order
+            survivors = survivors[scores[survivors] >= kth]
+        
+        # Sort by similarity (descending), ties by candidate order
+        order = np.lexsort((survivors, -scores[survivors]))
+        return survivors[order][:top_k]
 
     def _get_class_weights(self, class_name):
         """
@@ -353,24 +749,32 @@ class SimilaritySearchService:
         
         return thresholds.get(class_name, 0.25)
 
-    def _normalize_similarity_scores(self, similarities):
+    def _normalize_similarity_scores(self, scores, score_range=None):
         """
         Normalize similarity scores for better distribution
         Uses min-max scaling with adaptive range compression
-        """
-        if len(similarities) <= 1:
-            return similarities
         
-        # Extract scores
-        scores = np.array([s['similarity'] for s in similarities])
+        Args:
+            scores: Array of similarity scores
+            score_range: Optional (min, max) to scale with instead of the
+                range of scores (scores are a subset of the candidates)
+            
+        Returns:
+            Array of normalized scores (same order)
+        """
+        if len(scores) <= 1 and score_range is None:
+            return scores
         
         # Find min and max
-        min_score = scores.min()
-        max_score = scores.max()
+        if score_range is None:
+            min_score = scores.min()
+            max_score = scores.max()
+        else:
+            min_score, max_score = score_range
         
         # Avoid division by zero
         if max_score - min_score < 0.01:
-            return similarities
+            return scores
         
         # Apply min-max normalization with range expansion
         # Map [min, max] to [0.3, 1.0] for better visual distinction
@@ -380,333 +784,494 @@ class SimilaritySearchService:
         # y = x^0.8 makes middle values more distinct
         normalized_scores = np.power(normalized_scores, 0.8)
         
-        # Update similarities with normalized scores
-        for i, similarity in enumerate(similarities):
-            similarity['similarity'] = float(normalized_scores[i])
-            # Keep visual_similarity as the original unmodified score
-        
-        return similarities
+        # visual_similarity keeps the original unmodified score
+        return normalized_scores
         
-    def _compute_similarity(self, features1, features2, weights):
-        """
-        Compute weighted similarity between two feature sets
-        Gracefully handles missing features by adjusting weights dynamically
-        """
-        total_similarity = 0.0
-        total_weight = 0.0
-        
-        # Color similarity
-        if 'color' in features1 and 'color' in features2:
-            sim = self._color_similarity(features1['color'], features2['color'])
-            w = weights.get('color', 0.3)
-            total_similarity += sim * w
-            total_weight += w
-        
-        # Tamura texture similarity
-        if 'texture_tamura' in features1 and 'texture_tamura' in features2:
-            sim = self._tamura_similarity(features1['texture_tamura'], features2['texture_tamura'])
-            w = weights.get('texture_tamura', 0.2)
-            total_similarity += sim * w
-            total_weight += w
-        
-        # Gabor texture similarity
-        if 'texture_gabor' in features1 and 'texture_gabor' in features2:
-            sim = self._gabor_similarity(features1['texture_gabor'], features2['texture_gabor'])
-            w = weights.get('texture_gabor', 0.2)
-            total_similarity += sim * w
-            total_weight += w
-        
-        # LBP texture similarity
-        if 'texture_lbp' in features1 and 'texture_lbp' in features2:
-            sim = self._lbp_similarity(features1['texture_lbp'], features2['texture_lbp'])
-            w = weights.get('texture_lbp', 0.10)
-            total_similarity += sim * w
-            total_weight += w
-        
-        # Hu moments similarity
-        if 'shape_hu' in features1 and 'shape_hu' in features2:
-            sim = self._hu_similarity(features1['shape_hu'], features2['shape_hu'])
-            w = weights.get('shape_hu', 0.15)
-            total_similarity += sim * w
-            total_weight += w
-        
-        # HOG similarity
-        if 'shape_hog' in features1 and 'shape_hog' in features2:
-            sim = self._hog_similarity(features1['shape_hog'], features2['shape_hog'])
-            w = weights.get('shape_hog', 0.15)
-            total_similarity += sim * w
-            total_weight += w
-        
-        # Contour orientation similarity
-        if 'shape_contour' in features1 and 'shape_contour' in features2:
-            sim = self._contour_similarity(features1['shape_contour'], features2['shape_contour'])
-            w = weights.get('shape_contour', 0.10)
-            total_similarity += sim * w
-            total_weight += w
+    def _score_rows(self, query, rows, weights):
+        """
+        Weighted visual similarity of one query against many stored rows
         
-        # Normalize by actual weight sum (handles missing features)
-        if total_weight > 0:
-            return total_similarity / total_weight
+        Every family term is computed for all rows at once on the store's
+        float32 matrices; families missing on either side are left out of the
+        weighted average (test_similarity_scoring.py checks this against a
+        per-pair reference implementation).
         
-        # Fallback: if no features matched, return 0
-        return 0.0
-    
-    def _color_similarity(self, color1, color2):
+        Args:
+            query: Encoded query features (FeatureStore.encode)
+            rows: Array of store row indices to score
+            weights: Dict of feature family weights
+            
+        Returns:
+            Array of visual similarities aligned with rows
         """
-        Compute color similarity using multiple metrics
-        Combines histogram comparison + dominant color matching
+        scores, present = self._family_scores(query, rows)
+        return self._combine_family_scores(scores, present, weights)
+    
+    def _family_scores(self, query, rows):
         """
-        # 1. RGB Histogram comparison (Chi-Square distance)
-        hist1 = np.array(color1.get('hist_rgb', []))
-        hist2 = np.array(color2.get('hist_rgb', []))
-        
-        hist_sim = 0.0
-        if len(hist1) > 0 and len(hist2) > 0:
-            # Chi-Square distance (more discriminative than intersection)
-            epsilon = 1e-10
-            chi_square = 0.5 * np.sum(
-                ((hist1 - hist2) ** 2) / (hist1 + hist2 + epsilon)
-            )
-            # Convert distance to similarity (0=identical, higher=different)
-            hist_sim = 1.0 / (1.0 + chi_square)
+        Unweighted similarity vector of every feature family
         
-        # 2. Dominant color comparison
-        dom_sim = self._dominant_color_similarity(color1, color2)
-        
-        # 3. Mean color distance
-        mean1 = np.array(color1.get('mean_rgb', [0, 0, 0]))
-        mean2 = np.array(color2.get('mean_rgb', [0, 0, 0]))
-        mean_distance = np.linalg.norm(mean1 - mean2) / 441.67  # Normalize by max RGB distance (sqrt(255^2 * 3))
-        mean_sim = 1.0 - mean_distance
+        Returns:
+            (scores, present): scores[i] is the array for FAMILIES[i] (None
+            when no row can be compared on it), present is the (rows, families)
+            mask of families available on both sides
+        """
+        scorers = {
+            'color': self._color_similarity_rows,
+            'texture_tamura': self._tamura_similarity_rows,
+            'texture_gabor': lambda q, r: self._cosine_rows(q, 'texture_gabor.gabor_responses', r),
+            'texture_lbp': self._lbp_similarity_rows,
+            'shape_hu': self._hu_similarity_rows,
+            'shape_hog': lambda q, r: self._cosine_rows(q, 'shape_hog.hog', r),
+            'shape_contour': self._contour_similarity_rows
+        }
         
-        # Combine (70% histogram, 20% dominant colors, 10% mean)
-        final_sim = 0.7 * hist_sim + 0.2 * dom_sim + 0.1 * mean_sim
+        present = self.store.families[rows] & query['families'][None, :]
+        scores = [None] * len(FAMILY_INDEX)
+        for family, scorer in scorers.items():
+            index = FAMILY_INDEX[family]
+            if present[:, index].any():
+                scores[index] = scorer(query, rows)
+        return scores, present
+    
+    def _combine_family_scores(self, scores, present, weights):
+        """Weighted average of family score vectors (see _family_scores)"""
+        total_similarity = np.zeros(len(present), dtype=np.float32)
+        total_weight = np.zeros(len(present), dtype=np.float32)
         
-        return float(max(0.0, min(1.0, final_sim)))
-
-    def _dominant_color_similarity(self, color1, color2):
-        """
-        Compare dominant colors using weighted color distance
-        Considers both color values and their percentages
-        """
-        dom1 = color1.get('dominant_colors', [])
-        dom2 = color2.get('dominant_colors', [])
-        
-        if not dom1 or not dom2:
-            return 0.0
-        
-        # Extract top 5 dominant colors
-        colors1 = []
-        weights1 = []
-        for c in dom1[:5]:
-            colors1.append(c['rgb'])
-            weights1.append(c['percentage'] / 100.0)
-        
-        colors2 = []
-        weights2 = []
-        for c in dom2[:5]:
-            colors2.append(c['rgb'])
-            weights2.append(c['percentage'] / 100.0)
-        
-        colors1 = np.array(colors1)
-        weights1 = np.array(weights1)
-        colors2 = np.array(colors2)
-        weights2 = np.array(weights2)
-        
-        # Compute weighted minimum color distance
-        total_distance = 0.0
-        for i, (c1, w1) in enumerate(zip(colors1, weights1)):
-            # Find closest color in second set
-            min_dist = float('inf')
-            for c2 in colors2:
-                # Euclidean distance in RGB space
-                dist = np.linalg.norm(c1 - c2) / 441.67  # Normalize
-                min_dist = min(min_dist, dist)
-            total_distance += w1 * min_dist
-        
-        # Reverse: do the same from colors2 to colors1
-        for i, (c2, w2) in enumerate(zip(colors2, weights2)):
-            min_dist = float('inf')
-            for c1 in colors1:
-                dist = np.linalg.norm(c2 - c1) / 441.67
-                min_dist = min(min_dist, dist)
-            total_distance += w2 * min_dist
-        
-        # Average bidirectional distance
-        total_distance /= 2.0
-        
-        similarity = 1.0 - total_distance
-        return float(max(0.0, similarity))
-    
-    def _tamura_similarity(self, tamura1, tamura2):
-        """
-        Compute Tamura feature similarity with normalization
-        Tamura features have different scales, so normalize them
-        """
-        # Extract features
-        coarse1 = tamura1.get('coarseness', 0)
-        contrast1 = tamura1.get('contrast', 0)
-        directionality1 = tamura1.get('directionality', 0)
-        
-        coarse2 = tamura2.get('coarseness', 0)
-        contrast2 = tamura2.get('contrast', 0)
-        directionality2 = tamura2.get('directionality', 0)
-        
-        # Compute individual similarities with appropriate scaling
-        # Coarseness: typically 0-10
-        coarse_sim = 1.0 - min(abs(coarse1 - coarse2) / 10.0, 1.0)
-        
-        # Contrast: typically 0-100
-        contrast_sim = 1.0 - min(abs(contrast1 - contrast2) / 100.0, 1.0)
-        
-        # Directionality: typically 0-5 (entropy-based)
-        dir_sim = 1.0 - min(abs(directionality1 - directionality2) / 5.0, 1.0)
-        
-        # Weighted combination (coarseness is most important)
-        final_sim = 0.5 * coarse_sim + 0.3 * contrast_sim + 0.2 * dir_sim
+        for family, index in FAMILY_INDEX.items():
+            if scores[index] is None:
+                continue
+            w = weights.get(family, self.FALLBACK_WEIGHTS[family])
+            total_similarity += np.where(
+                present[:, index], scores[index] * w, 0.0
+            ).astype(np.float32)
+            total_weight += present[:, index] * np.float32(w)
         
-        return float(max(0.0, min(1.0, final_sim)))
+        # Normalize by actual weight sum (handles missing features)
+        return np.divide(
+            total_similarity, total_weight,
+            out=np.zeros(len(present), dtype=np.float32),
+            where=total_weight > 0
+        )
     
-    def _gabor_similarity(self, gabor1, gabor2):
-        """Compute Gabor feature similarity"""
-        features1 = np.array(gabor1.get('gabor_responses', []))
-        features2 = np.array(gabor2.get('gabor_responses', []))
+    def _coarse_score_rows(self, query, rows, weights):
+        """
+        Cheap first-stage similarity for the search cascade
         
-        if len(features1) == 0 or len(features2) == 0:
-            return 0.0
+        Uses only signals that are a single vectorized pass over the store
+        (RGB histogram, mean colour and Hu moments), weighted like their
+        families in the full score. Only used to rank candidates, never
+        returned to the caller.
         
-        # Cosine similarity
-        if np.linalg.norm(features1) > 0 and np.linalg.norm(features2) > 0:
-            features1 = features1 / np.linalg.norm(features1)
-            features2 = features2 / np.linalg.norm(features2)
-            similarity = np.dot(features1, features2)
-            return float(max(0, similarity))
-        return 0.0
+        Args:
+            query: Encoded query features (FeatureStore.encode)
+            rows: Array of store row indices to score
+            weights: Dict of feature family weights
+            
+        Returns:
+            Array of coarse similarities aligned with rows
+        """
+        families = self.store.families[rows]
+        total_similarity = np.zeros(len(rows), dtype=np.float32)
+        total_weight = np.zeros(len(rows), dtype=np.float32)
+        
+        index = FAMILY_INDEX['color']
+        if query['families'][index]:
+            hist_sim = self._chi_square_rows(query, 'color.hist_rgb', rows)
+            mean_sim = self._mean_color_similarity_rows(query, rows)
+            # Hist / mean shares of _color_similarity, dominant colours left out
+            color_sim = (0.7 * hist_sim + 0.1 * mean_sim) / 0.8
+            w = np.float32(weights.get('color', self.FALLBACK_WEIGHTS['color']))
+            present = families[:, index]
+            total_similarity += np.where(present, color_sim * w, 0.0).astype(np.float32)
+            total_weight += present * w
+        
+        index = FAMILY_INDEX['shape_hu']
+        if query['families'][index]:
+            w = np.float32(weights.get('shape_hu', self.FALLBACK_WEIGHTS['shape_hu']))
+            present = families[:, index]
+            hu_sim = self._hu_similarity_rows(query, rows)
+            total_similarity += np.where(present, hu_sim * w, 0.0).astype(np.float32)
+            total_weight += present * w
+        
+        return np.divide(
+            total_similarity, total_weight,
+            out=np.zeros(len(rows), dtype=np.float32),
+            where=total_weight > 0
+        )
     
-    def _hu_similarity(self, hu1, hu2):
+    def _matching_vectors(self, query, name, rows):
         """
-        Compute Hu moments similarity with improved distance metric
-        Hu moments are log-transformed, so use absolute difference
+        Query vector, stored vectors and validity mask for one vector field
+        
+        Rows are valid when they hold a non-empty vector of the query's length.
+        Returns (None, None, None) when the query vector is missing or empty.
         """
-        moments1 = np.array(hu1.get('hu_moments', []))
-        moments2 = np.array(hu2.get('hu_moments', []))
+        q = query['vectors'].get(name)
+        if q is None or len(q) == 0:
+            return None, None, None
+        matrix = self.store.vectors[name]
+        if len(q) > matrix.shape[1]:
+            return q, np.zeros((len(rows), len(q)), dtype=np.float32), np.zeros(len(rows), dtype=bool)
+        valid = self.store.lengths[name][rows] == len(q)
+        return q, matrix[rows, :len(q)], valid
+    
+    def _chi_square_rows(self, query, name, rows):
+        """Chi-Square histogram similarity 1 / (1 + chi2) against many rows"""
+        q, matrix, valid = self._matching_vectors(query, name, rows)
+        if q is None or not valid.any():
+            return np.zeros(len(rows), dtype=np.float32)
+        if name in query['mapped']:
+            # ✅ EMBEDDED MODE - chi2 = 0.5 * (sum(a) + sum(b)) - <map(a), map(b)>
+            mapped = query['mapped'][name]
+            inner = self.store.mapped[name][rows, :len(mapped)] @ mapped
+            sums = np.maximum(q, 0.0).sum() + self.store.histogram_sums[name][rows]
+            chi_square = np.maximum(0.5 * sums - inner, 0.0)
+            return np.where(valid, 1.0 / (1.0 + chi_square), 0.0)
+        epsilon = 1e-10
+        chi_square = 0.5 * np.sum(((matrix - q) ** 2) / (matrix + q + epsilon), axis=1)
+        return np.where(valid, 1.0 / (1.0 + chi_square), 0.0)
+    
+    def _cosine_rows(self, query, name, rows):
+        """
+        Cosine similarity (clamped at 0) against many rows
         
-        if len(moments1) == 0 or len(moments2) == 0:
-            return 0.0
+        name must be one of the store's unit-normalized fields (HOG, Gabor),
+        so the similarity is a single matrix-vector product.
+        """
+        q, matrix, valid = self._matching_vectors(query, name, rows)
+        if q is None or not valid.any() or query['norms'].get(name, 0.0) == 0:
+            return np.zeros(len(rows), dtype=np.float32)
+        valid &= self.store.norms[name][rows] > 0
+        return np.where(valid, np.maximum(matrix @ q, 0.0), 0.0)
+    
+    def _scalar_rows(self, query, name, rows):
+        """Query scalar and stored scalars (absent values read as 0)"""
+        index = SCALAR_INDEX[name]
+        return query['scalars'][index], self.store.scalars[rows, index]
+    
+    def _color_similarity_rows(self, query, rows):
+        """Color similarity: 70% RGB histogram, 20% dominant colors, 10% mean color"""
+        hist_sim = self._chi_square_rows(query, 'color.hist_rgb', rows)
+        dom_sim = self._dominant_color_similarity_rows(query, rows)
+        mean_sim = self._mean_color_similarity_rows(query, rows)
         
-        # Hu moments can have very different scales, so normalize each moment
-        # Use weighted distance where earlier moments (more significant) have higher weight
-        weights = np.array([1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4])  # 7 Hu moments
+        final_sim = 0.7 * hist_sim + 0.2 * dom_sim + 0.1 * mean_sim
+        return np.clip(final_sim, 0.0, 1.0)
+    
+    def _mean_color_similarity_rows(self, query, rows):
+        """Mean color distance term of the color similarity (missing means read as [0, 0, 0])"""
+        q = query['vectors'].get('color.mean_rgb')
+        q = np.zeros(3, dtype=np.float32) if q is None else q
+        matrix = self.store.vectors['color.mean_rgb']
+        stored = np.zeros((len(rows), len(q)), dtype=np.float32)
+        width = min(len(q), matrix.shape[1])
+        stored[:, :width] = matrix[rows, :width]
+        return 1.0 - np.linalg.norm(stored - q, axis=1) / 441.67
+    
+    def _dominant_color_similarity_rows(self, query, rows, block_size=65536):
+        """
+        Dominant color similarity (bidirectional weighted min color distance)
         
-        # Absolute difference (since Hu moments are log-transformed)
-        abs_diff = np.abs(moments1 - moments2)
+        Works on the store's padded (rows, 5, 3) dominant colors: all pairwise
+        color distances are computed at once, padded slots are masked out of
+        the min, and the bidirectional weighted min-distance is averaged.
+        """
+        query_rgb, query_weights, query_mask = query['dominant']
+        similarity = np.zeros(len(rows), dtype=np.float32)
+        if not query_mask.any() or len(rows) == 0:
+            return similarity
+        query_rgb, query_weights = query_rgb[query_mask], query_weights[query_mask]
+        
+        # Blocks of rows bound the (rows, 5, 5, 3) difference array
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            stored_rgb = self.store.dominant_rgb[block]
+            stored_weights = self.store.dominant_weights[block]
+            stored_mask = self.store.dominant_mask[block]
+            present = stored_mask.any(axis=1)
+            
+            # (rows, query colors, stored colors) normalized Euclidean distances
+            distances = np.linalg.norm(
+                query_rgb[None, :, None, :] - stored_rgb[:, None, :, :], axis=3
+            ) / 441.67
+            distances = np.where(stored_mask[:, None, :], distances, np.inf)
+            
+            # Query -> stored: closest stored color for every query color
+            forward_min = np.where(present[:, None], distances.min(axis=2), 0.0)
+            forward = forward_min @ query_weights
+            # Stored -> query: closest query color for every stored color
+            reverse_min = np.where(stored_mask, distances.min(axis=1), 0.0)
+            reverse = np.sum(reverse_min * stored_weights, axis=1)
+            
+            # Average bidirectional distance
+            total_distance = (forward + reverse) / 2.0
+            similarity[start:start + len(block)] = np.where(
+                present, np.maximum(1.0 - total_distance, 0.0), 0.0
+            )
+        return similarity
+    
+    def _tamura_similarity_rows(self, query, rows):
+        """Tamura similarity: scaled coarseness, contrast and directionality differences"""
+        coarse1, coarse2 = self._scalar_rows(query, 'texture_tamura.coarseness', rows)
+        contrast1, contrast2 = self._scalar_rows(query, 'texture_tamura.contrast', rows)
+        dir1, dir2 = self._scalar_rows(query, 'texture_tamura.directionality', rows)
         
-        # Weighted Euclidean distance
-        weighted_distance = np.sqrt(np.sum(weights * (abs_diff ** 2)))
+        coarse_sim = 1.0 - np.minimum(np.abs(coarse1 - coarse2) / 10.0, 1.0)
+        contrast_sim = 1.0 - np.minimum(np.abs(contrast1 - contrast2) / 100.0, 1.0)
+        dir_sim = 1.0 - np.minimum(np.abs(dir1 - dir2) / 5.0, 1.0)
         
-        # Convert to similarity with adaptive scaling
-        # Scale factor based on empirical observation (Hu moments typically range 0-20 after log transform)
+        final_sim = 0.5 * coarse_sim + 0.3 * contrast_sim + 0.2 * dir_sim
+        return np.clip(final_sim, 0.0, 1.0)
+    
+    def _hu_similarity_rows(self, query, rows):
+        """Hu moment similarity: weighted distance of the log-transformed moments"""
+        q, matrix, valid = self._matching_vectors(query, 'shape_hu.hu_moments', rows)
+        if q is None or len(q) != len(self.HU_MOMENT_WEIGHTS) or not valid.any():
+            return np.zeros(len(rows), dtype=np.float32)
+        weighted_distance = np.sqrt(((matrix - q) ** 2) @ self.HU_MOMENT_WEIGHTS)
         similarity = 1.0 / (1.0 + weighted_distance / 10.0)
+        return np.where(valid, np.clip(similarity, 0.0, 1.0), 0.0)
+    
+    def _lbp_similarity_rows(self, query, rows):
+        """LBP similarity: 80% histogram Chi-Square, 20% mean / std"""
+        q, _, valid = self._matching_vectors(query, 'texture_lbp.lbp_hist', rows)
+        if q is None or not valid.any():
+            return np.zeros(len(rows), dtype=np.float32)
+        similarity = self._chi_square_rows(query, 'texture_lbp.lbp_hist', rows)
+        
+        mean1, mean2 = self._scalar_rows(query, 'texture_lbp.lbp_mean', rows)
+        std1, std2 = self._scalar_rows(query, 'texture_lbp.lbp_std', rows)
+        mean_diff = np.abs(mean1 - mean2) / 255.0
+        std_diff = np.abs(std1 - std2) / 100.0
+        mean_std_sim = 1.0 - (mean_diff + std_diff) / 2.0
         
-        return float(max(0.0, min(1.0, similarity)))
+        final_sim = 0.8 * similarity + 0.2 * mean_std_sim
+        return np.where(valid, np.clip(final_sim, 0.0, 1.0), 0.0)
     
-    def _hog_similarity(self, hog1, hog2):
-        """Compute HOG feature similarity"""
-        features1 = np.array(hog1.get('hog', []))
-        features2 = np.array(hog2.get('hog', []))
+    def _contour_similarity_rows(self, query, rows):
+        """Contour similarity: 60% orientation histogram, 25% main angle, 15% variance"""
+        q, _, valid = self._matching_vectors(query, 'shape_contour.orientation_hist', rows)
+        if q is None or not valid.any():
+            return np.zeros(len(rows), dtype=np.float32)
+        hist_sim = self._chi_square_rows(query, 'shape_contour.orientation_hist', rows)
         
-        if len(features1) == 0 or len(features2) == 0:
-            return 0.0
+        # Angular difference (wrap around at 180 degrees)
+        main1, main2 = self._scalar_rows(query, 'shape_contour.main_orientation', rows)
+        angle_diff = np.abs(main1 - main2)
+        angle_diff = np.where(angle_diff > 90, 180 - angle_diff, angle_diff)
+        angle_sim = 1.0 - (angle_diff / 90.0)
         
-        # Cosine similarity
-        if np.linalg.norm(features1) > 0 and np.linalg.norm(features2) > 0:
-            features1 = features1 / np.linalg.norm(features1)
-            features2 = features2 / np.linalg.norm(features2)
-            similarity = np.dot(features1, features2)
-            return float(max(0, similarity))
-        return 0.0
-    
-    def _lbp_similarity(self, lbp1, lbp2):
-        """
-        Compute LBP texture similarity using Chi-Square distance
-        More discriminative than simple histogram intersection
+        var1, var2 = self._scalar_rows(query, 'shape_contour.orientation_variance', rows)
+        var_sim = 1.0 / (1.0 + np.abs(var1 - var2))
+        
+        final_sim = 0.6 * hist_sim + 0.25 * angle_sim + 0.15 * var_sim
+        return np.where(valid, np.clip(final_sim, 0.0, 1.0), 0.0)
+        
+    def _score_rows_batch(self, queries, rows, weights):
         """
-        hist1 = np.array(lbp1.get('lbp_hist', []))
-        hist2 = np.array(lbp2.get('lbp_hist', []))
+        (queries x rows) version of _score_rows
         
-        if len(hist1) == 0 or len(hist2) == 0:
-            return 0.0
+        Args:
+            queries: List of encoded queries (FeatureStore.encode)
+            rows: Array of store row indices to score
+            weights: Dict of feature family weights (shared by all queries)
+            
+        Returns:
+            (len(queries), len(rows)) array of visual similarities
+        """
+        shape = (len(queries), len(rows))
+        total_similarity = np.zeros(shape, dtype=np.float32)
+        total_weight = np.zeros(shape, dtype=np.float32)
+        families = self.store.families[rows]
+        query_families = np.array([query['families'] for query in queries])
+        
+        scorers = {
+            'color': self._color_similarity_batch,
+            'texture_tamura': self._tamura_similarity_batch,
+            'texture_gabor': lambda q, r: self._cosine_batch(q, 'texture_gabor.gabor_responses', r),
+            'texture_lbp': self._lbp_similarity_batch,
+            'shape_hu': self._hu_similarity_batch,
+            'shape_hog': lambda q, r: self._cosine_batch(q, 'shape_hog.hog', r),
+            'shape_contour': self._contour_similarity_batch
+        }
         
-        # Chi-Square distance for texture patterns
-        epsilon = 1e-10
-        chi_square = 0.5 * np.sum(
-            ((hist1 - hist2) ** 2) / (hist1 + hist2 + epsilon)
+        for family, scorer in scorers.items():
+            index = FAMILY_INDEX[family]
+            present = query_families[:, index, None] & families[None, :, index]
+            if not present.any():
+                continue
+            w = np.float32(weights.get(family, self.FALLBACK_WEIGHTS[family]))
+            total_similarity += np.where(present, scorer(queries, rows) * w, 0.0).astype(np.float32)
+            total_weight += present * w
+        
+        return np.divide(
+            total_similarity, total_weight,
+            out=np.zeros(shape, dtype=np.float32),
+            where=total_weight > 0
         )
+    
+    def _matching_vector_groups(self, queries, name, rows):
+        """
+        Batch counterpart of _matching_vectors
         
-        # Convert to similarity
-        similarity = 1.0 / (1.0 + chi_square)
+        Groups queries by vector length and yields, for each group, the query
+        indices, the (group, length) query matrix, the stored vectors and the
+        rows' validity mask. Queries without the vector are not yielded.
+        """
+        by_length = {}
+        for i, query in enumerate(queries):
+            q = query['vectors'].get(name)
+            if q is not None and len(q) > 0:
+                by_length.setdefault(len(q), []).append(i)
+        
+        matrix = self.store.vectors[name]
+        for length, members in by_length.items():
+            if length > matrix.shape[1]:
+                continue
+            group = np.stack([queries[i]['vectors'][name] for i in members])
+            valid = self.store.lengths[name][rows] == length
+            yield np.array(members), group, matrix[rows, :length], valid
+    
+    def _scalar_batch(self, queries, name, rows):
+        """Query scalars as a column and stored scalars as a row (for broadcasting)"""
+        index = SCALAR_INDEX[name]
+        column = np.array([query['scalars'][index] for query in queries], dtype=np.float32)
+        return column[:, None], self.store.scalars[rows, index][None, :]
+    
+    def _chi_square_batch(self, queries, name, rows):
+        """Batch _chi_square_rows, computed in bounded blocks of rows (or as inner products)"""
+        result = np.zeros((len(queries), len(rows)), dtype=np.float32)
+        epsilon = 1e-10
+        for members, group, stored, valid in self._matching_vector_groups(queries, name, rows):
+            if name in queries[members[0]]['mapped']:
+                # ✅ EMBEDDED MODE - One matrix product per query group
+                mapped = np.stack([queries[i]['mapped'][name] for i in members])
+                inner = mapped @ self.store.mapped[name][rows, :mapped.shape[1]].T
+                sums = np.maximum(group, 0.0).sum(axis=1)[:, None] \
+                    + self.store.histogram_sums[name][rows][None, :]
+                chi_square = np.maximum(0.5 * sums - inner, 0.0)
+                result[members] = np.where(valid[None, :], 1.0 / (1.0 + chi_square), 0.0)
+                continue
+            block = max(1, self.BATCH_SCORE_ELEMENTS // (len(members) * group.shape[1]))
+            for start in range(0, len(rows), block):
+                part = stored[start:start + block][None, :, :]
+                chi_square = 0.5 * np.sum(
+                    ((part - group[:, None, :]) ** 2) / (part + group[:, None, :] + epsilon), axis=2
+                )
+                result[members, start:start + block] = np.where(
+                    valid[start:start + block], 1.0 / (1.0 + chi_square), 0.0
+                )
+        return result
+    
+    def _cosine_batch(self, queries, name, rows):
+        """Batch _cosine_rows (unit-normalized fields) as one matrix product per query group"""
+        result = np.zeros((len(queries), len(rows)), dtype=np.float32)
+        valid_norm = self.store.norms[name][rows] > 0
+        for members, group, stored, valid in self._matching_vector_groups(queries, name, rows):
+            query_valid = np.array([queries[i]['norms'].get(name, 0.0) > 0 for i in members])
+            mask = query_valid[:, None] & (valid & valid_norm)[None, :]
+            result[members] = np.where(mask, np.maximum(group @ stored.T, 0.0), 0.0)
+        return result
+    
+    def _color_similarity_batch(self, queries, rows):
+        """Batch _color_similarity_rows"""
+        hist_sim = self._chi_square_batch(queries, 'color.hist_rgb', rows)
+        # Dominant colours have no matrix form yet: one vectorized pass per query
+        dom_sim = np.stack([self._dominant_color_similarity_rows(query, rows) for query in queries])
+        
+        # Float64 keeps the expanded distance accurate for near-identical colours
+        matrix = self.store.vectors['color.mean_rgb']
+        width = min(3, matrix.shape[1])
+        stored = np.zeros((len(rows), 3), dtype=np.float64)
+        stored[:, :width] = matrix[rows, :width]
+        means = np.zeros((len(queries), 3), dtype=np.float64)
+        for i, query in enumerate(queries):
+            q = query['vectors'].get('color.mean_rgb')
+            if q is not None:
+                means[i, :min(3, len(q))] = q[:3]
+        distances = np.sqrt(np.maximum(
+            np.sum(means ** 2, axis=1)[:, None] + np.sum(stored ** 2, axis=1)[None, :]
+            - 2.0 * means @ stored.T, 0.0
+        ))
+        mean_sim = 1.0 - distances / 441.67
         
-        # Also consider mean and std for texture roughness
-        mean1 = lbp1.get('lbp_mean', 0)
-        mean2 = lbp2.get('lbp_mean', 0)
-        std1 = lbp1.get('lbp_std', 0)
-        std2 = lbp2.get('lbp_std', 0)
+        final_sim = 0.7 * hist_sim + 0.2 * dom_sim + 0.1 * mean_sim
+        return np.clip(final_sim, 0.0, 1.0)
+    
+    def _tamura_similarity_batch(self, queries, rows):
+        """Batch _tamura_similarity_rows"""
+        coarse1, coarse2 = self._scalar_batch(queries, 'texture_tamura.coarseness', rows)
+        contrast1, contrast2 = self._scalar_batch(queries, 'texture_tamura.contrast', rows)
+        dir1, dir2 = self._scalar_batch(queries, 'texture_tamura.directionality', rows)
         
-        # Normalize mean and std differences
-        mean_diff = abs(mean1 - mean2) / 255.0  # Normalize by max LBP value
-        std_diff = abs(std1 - std2) / 100.0  # Approximate normalization
+        coarse_sim = 1.0 - np.minimum(np.abs(coarse1 - coarse2) / 10.0, 1.0)
+        contrast_sim = 1.0 - np.minimum(np.abs(contrast1 - contrast2) / 100.0, 1.0)
+        dir_sim = 1.0 - np.minimum(np.abs(dir1 - dir2) / 5.0, 1.0)
         
+        final_sim = 0.5 * coarse_sim + 0.3 * contrast_sim + 0.2 * dir_sim
+        return np.clip(final_sim, 0.0, 1.0)
+    
+    def _hu_similarity_batch(self, queries, rows):
+        """Batch _hu_similarity_rows (weighted distances through one matrix product)"""
+        result = np.zeros((len(queries), len(rows)), dtype=np.float32)
+        w = self.HU_MOMENT_WEIGHTS.astype(np.float64)
+        for members, group, stored, valid in self._matching_vector_groups(
+                queries, 'shape_hu.hu_moments', rows):
+            if group.shape[1] != len(w):
+                continue
+            # Float64 keeps the expanded distance accurate for near-identical shapes
+            group, stored = group.astype(np.float64), stored.astype(np.float64)
+            squared = (
+                (group ** 2) @ w
+            )[:, None] + ((stored ** 2) @ w)[None, :] - 2.0 * (group * w) @ stored.T
+            weighted_distance = np.sqrt(np.maximum(squared, 0.0))
+            similarity = 1.0 / (1.0 + weighted_distance / 10.0)
+            result[members] = np.where(valid[None, :], np.clip(similarity, 0.0, 1.0), 0.0)
+        return result
+    
+    def _histogram_valid_batch(self, queries, name, rows):
+        """(queries x rows) mask of pairs whose histograms can be compared"""
+        valid = np.zeros((len(queries), len(rows)), dtype=bool)
+        for members, _, _, rows_valid in self._matching_vector_groups(queries, name, rows):
+            valid[members] = rows_valid[None, :]
+        return valid
+    
+    def _lbp_similarity_batch(self, queries, rows):
+        """Batch _lbp_similarity_rows"""
+        valid = self._histogram_valid_batch(queries, 'texture_lbp.lbp_hist', rows)
+        similarity = self._chi_square_batch(queries, 'texture_lbp.lbp_hist', rows)
+        
+        mean1, mean2 = self._scalar_batch(queries, 'texture_lbp.lbp_mean', rows)
+        std1, std2 = self._scalar_batch(queries, 'texture_lbp.lbp_std', rows)
+        mean_diff = np.abs(mean1 - mean2) / 255.0
+        std_diff = np.abs(std1 - std2) / 100.0
         mean_std_sim = 1.0 - (mean_diff + std_diff) / 2.0
         
-        # Combine: 80% histogram, 20% mean/std
         final_sim = 0.8 * similarity + 0.2 * mean_std_sim
-        
-        return float(max(0.0, min(1.0, final_sim)))
-
-    def _contour_similarity(self, contour1, contour2):
-        """
-        Compute contour orientation similarity
-        Uses both histogram and orientation statistics
-        """
-        hist1 = np.array(contour1.get('orientation_hist', []))
-        hist2 = np.array(contour2.get('orientation_hist', []))
-        
-        if len(hist1) == 0 or len(hist2) == 0:
-            return 0.0
-        
-        # Chi-Square distance for orientation histogram
-        epsilon = 1e-10
-        chi_square = 0.5 * np.sum(
-            ((hist1 - hist2) ** 2) / (hist1 + hist2 + epsilon)
-        )
-        hist_sim = 1.0 / (1.0 + chi_square)
-        
-        # Compare main orientation angles
-        main1 = contour1.get('main_orientation', 0)
-        main2 = contour2.get('main_orientation', 0)
+        return np.where(valid, np.clip(final_sim, 0.0, 1.0), 0.0)
+    
+    def _contour_similarity_batch(self, queries, rows):
+        """Batch _contour_similarity_rows"""
+        valid = self._histogram_valid_batch(queries, 'shape_contour.orientation_hist', rows)
+        hist_sim = self._chi_square_batch(queries, 'shape_contour.orientation_hist', rows)
         
         # Angular difference (wrap around at 180 degrees)
-        angle_diff = abs(main1 - main2)
-        if angle_diff > 90:  # Wrap around
-            angle_diff = 180 - angle_diff
-        
-        angle_sim = 1.0 - (angle_diff / 90.0)  # Normalize to [0, 1]
+        main1, main2 = self._scalar_batch(queries, 'shape_contour.main_orientation', rows)
+        angle_diff = np.abs(main1 - main2)
+        angle_diff = np.where(angle_diff > 90, 180 - angle_diff, angle_diff)
+        angle_sim = 1.0 - (angle_diff / 90.0)
         
-        # Compare orientation variance (how spread out the orientations are)
-        var1 = contour1.get('orientation_variance', 0)
-        var2 = contour2.get('orientation_variance', 0)
-        var_diff = abs(var1 - var2)
-        var_sim = 1.0 / (1.0 + var_diff)
+        var1, var2 = self._scalar_batch(queries, 'shape_contour.orientation_variance', rows)
+        var_sim = 1.0 / (1.0 + np.abs(var1 - var2))
         
-        # Combine: 60% histogram, 25% main angle, 15% variance
         final_sim = 0.6 * hist_sim + 0.25 * angle_sim + 0.15 * var_sim
-        
-        return float(max(0.0, min(1.0, final_sim)))
-
+        return np.where(valid, np.clip(final_sim, 0.0, 1.0), 0.0)
+    
     def delete_image_data(self, image_id):
         """Delete all data for an image from the database"""
-        if image_id in self.database['images']:
-            del self.database['images'][image_id]
+        if self.store.remove_image(image_id):
             self._save_database()
             return True
         return False
@@ -722,13 +1287,13 @@ class SimilaritySearchService:
             List of cleaned up image IDs
         """
         orphaned_ids = []
-        for image_id in list(self.database['images'].keys()):
+        for image_id in list(self.store.images.keys()):
             if image_id not in existing_image_ids:
                 orphaned_ids.append(image_id)
         
         # Remove orphaned entries
         for image_id in orphaned_ids:
-            del self.database['images'][image_id]
+            self.store.remove_image(image_id)
         
         if orphaned_ids:
             self._save_database()
@@ -737,19 +1302,16 @@ class SimilaritySearchService:
     
     def get_statistics(self):
         """Get database statistics"""
-        total_images = len(self.database['images'])
+        total_images = len(self.store.images)
         total_objects = sum(
             len(data.get('detections', []))
-            for data in self.database['images'].values()
-        )
-        total_features = sum(
-            len([f for f in data.get('features', []) if f is not None])
-            for data in self.database['images'].values()
+            for data in self.store.images.values()
         )
+        total_features = len(self.store.row_of)
         
         # Class distribution
         class_counts = {}
-        for data in self.database['images'].values():
+        for data in self.store.images.values():
             for detection in data.get('detections', []):
                 class_name = detection.get('class', 'unknown')
                 class_counts[class_name] = class_counts.get(class_name, 0) + 1
@@ -758,5 +1320,9 @@ class SimilaritySearchService:
             'total_images': total_images,
             'total_objects': total_objects,
             'total_features_extracted': total_features,
-            'class_distribution': class_counts
+            'class_distribution': class_counts,
+            'search_cache': self.result_cache.get_statistics(),
+            'score_cache': self.score_cache.get_statistics(),
+            'neighbour_graph': self.neighbour_graph.get_statistics()
+            if self.neighbour_graph is not None else None
         }
\ No newline at end of file
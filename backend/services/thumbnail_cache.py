@@ -0,0 +1,136 @@
+"""
+Thumbnail Cache for the CBIR System
+Downscaled WebP / JPEG derivatives of uploaded images, generated once and
+kept on disk by (image_id, width, format, quality)
+"""
+
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+import cv2
+
+
+# format -> (file extension, cv2 quality flag)
+THUMBNAIL_FORMATS = {
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY)
+}
+# JPEG sources are decoded at 1/8, 1/4 or 1/2 scale (libjpeg DCT scaling)
+# when the reduced image is still at least as wide as the derivative
+REDUCED_READ_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2)
+)
+
+
+class ThumbnailCache:
+    """
+    On-disk cache of resized image derivatives
+
+    Derivatives live in one folder per image
+    (<folder>/<image_id>/w<width>-q<quality>.<ext>), so deleting an image
+    drops all its derivatives with one rmtree. Requested widths are snapped
+    up to the configured sizes, which bounds the number of variants per
+    image. A derivative older than its source is regenerated, so files
+    replaced on disk never serve stale thumbnails.
+    """
+
+    def __init__(self, folder, sizes=(128, 256, 512, 1024), default_format='webp',
+                 quality=None):
+        """
+        Args:
+            folder: Cache folder (created if missing)
+            sizes: Widths derivatives are generated at
+            default_format: 'webp' or 'jpeg'
+            quality: Default quality per format (1-100),
+                e.g. {'webp': 80, 'jpeg': 85}
+        """
+        if default_format not in THUMBNAIL_FORMATS:
+            raise ValueError(f'Unknown thumbnail format: {default_format}')
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.sizes = sorted(sizes)
+        self.default_format = default_format
+        self.quality = {'webp': 80, 'jpeg': 85, **(quality or {})}
+
+    def snap_width(self, width):
+        """Smallest configured size >= width (the largest size if none is)"""
+        for size in self.sizes:
+            if size >= width:
+                return size
+        return self.sizes[-1]
+
+    def path_for(self, image_id, width, fmt, quality):
+        ext = THUMBNAIL_FORMATS[fmt][0]
+        return self.folder / image_id / f'w{width}-q{quality}{ext}'
+
+    def get(self, image_id, source_path, width, fmt=None, quality=None, source_width=None):
+        """
+        Path of a derivative, generating it if missing or stale
+
+        Args:
+            image_id: Image the source belongs to
+            source_path: Original image file
+            width: Requested width (snapped to the configured sizes; images
+                narrower than that are re-encoded, not upscaled)
+            fmt: 'webp' or 'jpeg' (default: default_format)
+            quality: 1-100 (default: the format's configured quality;
+                ValueError outside that range)
+            source_width: Width of the source if known (enables reduced
+                JPEG decoding)
+
+        Returns:
+            Path of the derivative, or None if the source cannot be decoded
+        """
+        fmt = fmt or self.default_format
+        if fmt not in THUMBNAIL_FORMATS:
+            raise ValueError(f'Unknown thumbnail format: {fmt}')
+        quality = int(self.quality[fmt] if quality is None else quality)
+        if not 1 <= quality <= 100:
+            raise ValueError(f'Thumbnail quality must be 1-100, got {quality}')
+        width = self.snap_width(width)
+        path = self.path_for(image_id, width, fmt, quality)
+
+        try:
+            if path.stat().st_mtime >= os.stat(source_path).st_mtime:
+                return path
+        except FileNotFoundError:
+            pass
+        return self._generate(source_path, path, width, fmt, quality, source_width)
+
+    def _read(self, source_path, width, source_width):
+        if source_width and Path(source_path).suffix.lower() in ('.jpg', '.jpeg'):
+            for factor, flag in REDUCED_READ_FLAGS:
+                if source_width // factor >= width:
+                    img = cv2.imread(str(source_path), flag)
+                    if img is not None:
+                        return img
+                    break
+        return cv2.imread(str(source_path))
+
+    def _generate(self, source_path, path, width, fmt, quality, source_width):
+        img = self._read(source_path, width, source_width)
+        if img is None:
+            return None
+        h, w = img.shape[:2]
+        if w > width:
+            img = cv2.resize(img, (width, max(1, round(h * width / w))), interpolation=cv2.INTER_AREA)
+
+        ext, flag = THUMBNAIL_FORMATS[fmt]
+        ok, encoded = cv2.imencode(ext, img, [flag, quality])
+        if not ok:
+            return None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Unique tmp name: concurrent requests for one derivative both succeed
+        tmp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded.tobytes())
+        tmp_path.replace(path)
+        return path
+
+    def invalidate(self, image_id):
+        """Drop every derivative of an image"""
+        shutil.rmtree(self.folder / image_id, ignore_errors=True)
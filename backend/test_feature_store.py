@@ -0,0 +1,278 @@
+"""
+Test script for the columnar feature store
+Covers encode / put / remove, write-log replay after a crash, the snapshot
+round trip, batch() rollback, generation bumps and the import of legacy
+features.json databases.
+Usage: python test_feature_store.py
+"""
+
+import json
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from services.feature_store import FeatureStore
+from test_neighbour_graph import random_features
+
+
+def detections(n=1, class_name='car'):
+    return [{'bbox': [0, 0, 10, 10], 'confidence': 0.5, 'class': class_name, 'class_id': 0}
+            for _ in range(n)]
+
+
+def assert_same_features(actual, expected, path='features'):
+    """Feature dicts equal up to float32 rounding"""
+    if isinstance(expected, dict):
+        assert isinstance(actual, dict) and set(actual) == set(expected), \
+            f'{path}: keys {sorted(actual)} != {sorted(expected)}'
+        for key in expected:
+            assert_same_features(actual[key], expected[key], f'{path}.{key}')
+    elif isinstance(expected, list) and expected and all(
+            isinstance(x, (int, float)) and not isinstance(x, bool) for x in expected):
+        assert np.allclose(actual, expected, rtol=1e-5, atol=1e-5), f'{path} differs'
+    elif isinstance(expected, float):
+        assert abs(actual - expected) <= 1e-4 * max(1.0, abs(expected)), f'{path} differs'
+    else:
+        assert actual == expected, f'{path}: {actual!r} != {expected!r}'
+
+
+def new_store(folder=None, **options):
+    folder = Path(folder or tempfile.mkdtemp())
+    return FeatureStore(folder / 'features.store', legacy_path=folder / 'features.json', **options)
+
+
+def fill(store, rng, n_images=10):
+    """Commit n_images images with 1-3 objects each; returns {(image_id, object_id): features}"""
+    expected = {}
+    for i in range(n_images):
+        image_id = f'img-{i:03d}'
+        n_objects = i % 3 + 1
+        store.set_detections(image_id, detections(n_objects))
+        for object_id in range(n_objects):
+            features = random_features(rng)
+            store.put(image_id, object_id, features)
+            expected[(image_id, object_id)] = features
+        store.commit()
+    return expected
+
+
+def assert_store_holds(store, expected):
+    assert len(store.row_of) == len(expected), f'{len(store.row_of)} rows, expected {len(expected)}'
+    for (image_id, object_id), features in expected.items():
+        assert_same_features(store.get(image_id, object_id), features, f'{image_id}/{object_id}')
+
+
+def test_put_get_remove():
+    """Encoded rows decode to the original dicts; every mutation bumps the generation"""
+    store = new_store()
+    rng = np.random.default_rng(0)
+    generation = store.generation
+    expected = fill(store, rng)
+    assert store.generation > generation
+    assert_store_holds(store, expected)
+
+    # Overwrite keeps the row, None removes it, remove_image drops the rest
+    row = store.row_of[('img-001', 0)]
+    features = random_features(rng)
+    store.put('img-001', 0, features)
+    assert store.row_of[('img-001', 0)] == row
+    assert_same_features(store.get('img-001', 0), features)
+
+    generation = store.generation
+    store.put('img-001', 1, None)
+    assert store.generation == generation + 1
+    assert store.get('img-001', 1) is None
+    assert ('img-001', 1) not in store.row_of
+
+    assert store.remove_image('img-002')
+    assert store.image_rows('img-002') == [] and 'img-002' not in store.images
+    assert not store.remove_image('img-002')
+
+    # Removing features that were never stored is a no-op
+    generation = store.generation
+    store.put('missing', 0, None)
+    assert 'missing' not in store.images and store.generation == generation
+    print('✅ put / get / remove round trip')
+
+
+def test_replay_after_crash():
+    """Committed records survive a crash; a torn tail and uncommitted mutations do not"""
+    folder = tempfile.mkdtemp()
+    store = new_store(folder, compact_min_ops=10 ** 9)
+    rng = np.random.default_rng(1)
+    expected = fill(store, rng)
+    store.remove_image('img-004')
+    store.commit()
+    for object_id in range(2):
+        del expected[('img-004', object_id)]
+    assert not store.path.exists(), 'nothing should have been compacted yet'
+
+    # Uncommitted mutation, then a record torn half-way by the crash
+    store.put('img-000', 0, random_features(rng))
+    log_size = store.log_path.stat().st_size
+    with open(store.log_path, 'ab') as f:
+        f.write(b'[{"op": "remove_image", "image_id": "img-00')
+
+    reopened = new_store(folder, compact_min_ops=10 ** 9)
+    assert_store_holds(reopened, expected)
+    assert 'img-004' not in reopened.images
+    assert reopened.log_path.stat().st_size == log_size, 'torn tail was not truncated'
+
+    # New records append cleanly after the truncated tail
+    reopened.put('img-000', 0, expected[('img-000', 0)])
+    reopened.commit()
+    assert_store_holds(new_store(folder, compact_min_ops=10 ** 9), expected)
+    print('✅ Log replay after a simulated crash')
+
+
+def test_snapshot_round_trip():
+    """save() writes the snapshot + manifest and empties the log"""
+    folder = tempfile.mkdtemp()
+    store = new_store(folder, compact_min_ops=10 ** 9)
+    rng = np.random.default_rng(2)
+    expected = fill(store, rng)
+    store.remove_image('img-003')
+    store.commit()
+    del expected[('img-003', 0)]
+    store.save()
+
+    assert not store.log_path.exists()
+    with open(store.path / 'manifest.json') as f:
+        manifest = json.load(f)
+    assert manifest['rows'] == len(expected)
+    assert 'img-003' not in manifest['images']
+
+    reopened = new_store(folder)
+    assert_store_holds(reopened, expected)
+    assert reopened.images == store.images
+    assert sorted(reopened.rows_for_class('car')) == list(range(len(expected)))
+    print('✅ Snapshot round trip')
+
+
+def test_batch_rollback():
+    """A raising batch() restores the previous rows in memory and on disk"""
+    folder = tempfile.mkdtemp()
+    store = new_store(folder, compact_min_ops=10 ** 9)
+    rng = np.random.default_rng(3)
+    expected = fill(store, rng)
+    detections_before = json.loads(json.dumps(store.images))
+
+    try:
+        with store.batch():
+            store.put('img-000', 0, random_features(rng))
+            store.put('img-001', 1, None)
+            store.remove_image('img-005')
+            store.set_detections('img-006', detections(1, 'dog'))
+            store.set_detections('new', detections(1))
+            store.put('new', 0, random_features(rng))
+            raise RuntimeError('abort')
+    except RuntimeError:
+        pass
+
+    assert_store_holds(store, expected)
+    assert store.images == detections_before
+    assert len(store.rows_for_class('dog')) == 0
+    assert_store_holds(new_store(folder, compact_min_ops=10 ** 9), expected)
+
+    # A batch that completes is written as a single record
+    lines = store.log_path.read_text().count('\n')
+    with store.batch():
+        store.set_detections('new', detections(1))
+        store.put('new', 0, random_features(rng))
+    assert store.log_path.read_text().count('\n') == lines + 1
+    print('✅ batch() rollback')
+
+
+def test_compaction_waits_for_open_batches():
+    """A snapshot never captures another thread's uncommitted batch"""
+    folder = tempfile.mkdtemp()
+    store = new_store(folder, compact_min_ops=5, compact_ratio=0)
+    rng = np.random.default_rng(4)
+    entered, release = threading.Event(), threading.Event()
+
+    def open_batch():
+        try:
+            with store.batch():
+                store.set_detections('pending', detections(1))
+                store.put('pending', 0, random_features(rng))
+                entered.set()
+                release.wait()
+                raise RuntimeError('abort')
+        except RuntimeError:
+            pass
+
+    thread = threading.Thread(target=open_batch, daemon=True)
+    thread.start()
+    entered.wait()
+    try:
+        fill(store, rng, n_images=6)
+        assert not store.path.exists(), 'compacted while a batch was open'
+        # What a crash at this point would leave on disk
+        crashed = new_store(folder, read_only=True)
+        assert 'pending' not in crashed.images
+    finally:
+        release.set()
+        thread.join()
+    store.put('img-000', 0, random_features(rng))
+    store.commit()
+    assert store.path.exists() and not store.log_path.exists()
+    assert 'pending' not in new_store(folder).images
+    print('✅ Compaction waits for open batches')
+
+
+def test_legacy_json_migration():
+    """features.json (including old dominant_colors layouts) is imported once"""
+    folder = Path(tempfile.mkdtemp())
+    rng = np.random.default_rng(5)
+    current = random_features(rng)
+    legacy = random_features(rng)
+    # Earlier versions stored dominant colors as plain RGB lists
+    legacy['color']['dominant_colors'] = [[255, 0, 0], [0, 128, 255]]
+    database = {
+        'images': {
+            'current': {'detections': detections(1), 'features': [current]},
+            'legacy': {'detections': detections(2, 'dog'), 'features': [legacy, None]}
+        },
+        'metadata': {'created': '2024-01-01T00:00:00'}
+    }
+    with open(folder / 'features.json', 'w') as f:
+        json.dump(database, f)
+
+    store = new_store(folder)
+    assert store.path.exists(), 'import should be written as a snapshot'
+    assert store.metadata['created'] == '2024-01-01T00:00:00'
+    assert_store_holds(store, {('current', 0): current, ('legacy', 0): legacy})
+    assert store.images['legacy']['detections'] == database['images']['legacy']['detections']
+
+    # Only the current layout takes part in dominant color matching
+    assert store.dominant_mask[store.row_of[('current', 0)]].any()
+    assert not store.dominant_mask[store.row_of[('legacy', 0)]].any()
+
+    # Later starts read the snapshot, not features.json
+    with open(folder / 'features.json', 'w') as f:
+        json.dump({'images': {}}, f)
+    reopened = new_store(folder)
+    assert_store_holds(reopened, {('current', 0): current, ('legacy', 0): legacy})
+
+    # Snapshots from before the padded dominant color columns are rebuilt from extras
+    for name in ('dominant_rgb', 'dominant_weights', 'dominant_mask'):
+        (store.path / f'{name}.npy').unlink()
+    rebuilt = new_store(folder)
+    assert np.array_equal(rebuilt.dominant_mask[:rebuilt.size], reopened.dominant_mask[:reopened.size])
+    assert np.allclose(rebuilt.dominant_rgb[:rebuilt.size], reopened.dominant_rgb[:reopened.size])
+    print('✅ Legacy features.json migration')
+
+
+def main():
+    test_put_get_remove()
+    test_replay_after_crash()
+    test_snapshot_round_trip()
+    test_batch_rollback()
+    test_compaction_waits_for_open_batches()
+    test_legacy_json_migration()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Test script for the neighbour graph
+Builds the graph incrementally (batches smaller than a class) on a synthetic
+feature store and checks every lookup against a live scan.
+Usage: python test_neighbour_graph.py
+"""
+
+import tempfile
+
+import numpy as np
+
+from services.similarity_search import SimilaritySearchService
+from services.neighbour_graph import NeighbourGraph
+
+CLASSES = ['car', 'dog', 'cat']
+
+
+def random_histogram(rng, n):
+    hist = rng.random(n) ** 3
+    return (hist / hist.sum()).tolist()
+
+
+def random_features(rng):
+    """Feature dict shaped like FeatureExtractionService output"""
+    return {
+        'color': {
+            'hist_rgb': random_histogram(rng, 48),
+            'hist_hsv': random_histogram(rng, 48),
+            'mean_rgb': (rng.random(3) * 255).tolist(),
+            'std_rgb': (rng.random(3) * 60).tolist(),
+            'dominant_colors': [
+                {'rgb': rng.integers(0, 256, 3).tolist(), 'hex': '#000000', 'percentage': 50.0}
+                for _ in range(2)
+            ]
+        },
+        'texture_tamura': {'coarseness': float(rng.random() * 30),
+                           'contrast': float(rng.random() * 90),
+                           'directionality': float(rng.random() * 5)},
+        'texture_gabor': {'gabor_responses': (rng.random(16) * 50).tolist()},
+        'texture_lbp': {'lbp_hist': random_histogram(rng, 10),
+                        'lbp_mean': float(rng.random() * 9), 'lbp_std': float(rng.random() * 3)},
+        'shape_hu': {'hu_moments': (rng.random(7) * 20).tolist()},
+        'shape_hog': {'hog': (rng.random(108) * 0.4).tolist()},
+        'shape_contour': {'orientation_hist': random_histogram(rng, 18),
+                          'main_orientation': float(rng.integers(0, 18) * 10),
+                          'orientation_variance': float(rng.random())}
+    }
+
+
+def build_service(n_images=80, seed=0):
+    rng = np.random.default_rng(seed)
+    service = SimilaritySearchService(
+        f'{tempfile.mkdtemp()}/features.store', result_cache_size=0
+    )
+    with service.batch():
+        for i in range(n_images):
+            image_id = f'img-{i:05d}'
+            objects = int(rng.integers(1, 4))
+            service.save_detections(image_id, [
+                {'bbox': [0, 0, 10, 10], 'confidence': 0.5,
+                 'class': CLASSES[int(rng.integers(0, len(CLASSES)))], 'class_id': 0}
+                for _ in range(objects)
+            ])
+            for object_id in range(objects):
+                service.save_features(image_id, object_id, random_features(rng))
+    return service, rng
+
+
+def run_graph(graph):
+    while graph.step():
+        pass
+
+
+def assert_no_repeated_neighbours(graph):
+    for row in range(graph.store.size):
+        neighbours = graph.neighbours[row][graph.neighbours[row] >= 0]
+        assert len(set(neighbours.tolist())) == len(neighbours), f'row {row} lists a neighbour twice'
+
+
+def assert_matches_live_scan(service, graph):
+    """Every stored object's graph answer equals the live scan"""
+    store = service.store
+    answered = 0
+    for image_id, data in list(store.images.items()):
+        for object_id, detection in enumerate(data['detections']):
+            features = service.get_features(image_id, object_id)
+            if features is None:
+                continue
+            for top_k in (5, 20):
+                kwargs = dict(top_k=top_k, exclude_image_id=image_id, query_key=(image_id, object_id))
+                stats = {}
+                graph_results = service.find_similar(features, detection['class'], stats=stats, **kwargs)
+                live_results = service.find_similar(features, detection['class'], live_scan=True, **kwargs)
+                answered += 'graph' in stats
+                assert [r['image_id'] for r in graph_results] == [r['image_id'] for r in live_results]
+                for a, b in zip(graph_results, live_results):
+                    assert abs(a['similarity'] - b['similarity']) < 1e-5
+    assert answered > 0, 'no query was answered by the graph'
+    return answered
+
+
+def test_incremental_build_matches_live_scan():
+    """Startup build in batches smaller than a class partition"""
+    service, _ = build_service()
+    graph = NeighbourGraph(service, k=30, batch_size=7)
+    service.neighbour_graph = graph
+    run_graph(graph)
+    assert_no_repeated_neighbours(graph)
+    answered = assert_matches_live_scan(service, graph)
+    print(f'✅ Initial build: {answered} graph answers match the live scan')
+
+
+def test_updates_match_live_scan():
+    """Inserts, rewrites, relabels and removals after the build"""
+    service, rng = build_service(seed=1)
+    graph = NeighbourGraph(service, k=30, batch_size=7)
+    service.neighbour_graph = graph
+    run_graph(graph)
+
+    image_ids = list(service.store.images)
+    service.delete_image_data(image_ids[3])
+    for i in range(12):
+        image_id = f'new-{i}'
+        service.save_detections(image_id, [
+            {'bbox': [0, 0, 10, 10], 'confidence': 0.5, 'class': CLASSES[i % len(CLASSES)], 'class_id': 0}
+        ])
+        service.save_features(image_id, 0, random_features(rng))
+        if i % 4 == 0:
+            # Interleave background steps with the writes
+            graph.step()
+    service.save_features(image_ids[5], 0, random_features(rng))
+    detections = [dict(d) for d in service.get_detections(image_ids[6])]
+    detections[0]['class'] = 'dog' if detections[0]['class'] != 'dog' else 'car'
+    service.save_detections(image_ids[6], detections)
+    run_graph(graph)
+
+    assert_no_repeated_neighbours(graph)
+    answered = assert_matches_live_scan(service, graph)
+    print(f'✅ After updates: {answered} graph answers match the live scan')
+
+
+def main():
+    test_incremental_build_matches_live_scan()
+    test_updates_match_live_scan()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+"""
+Test script for the vectorized similarity scorers
+Scores synthetic objects with SimilaritySearchService._score_rows and
+_score_rows_batch and checks them against the per-pair reference
+implementation below (the scalar scorers the vectorized ones replaced).
+Usage: python test_similarity_scoring.py
+"""
+
+import tempfile
+
+import numpy as np
+
+from services.similarity_search import SimilaritySearchService
+from test_neighbour_graph import random_features
+
+
+# ----------------------------------------------------------------------
+# Reference implementation: one pair of feature dicts at a time
+# ----------------------------------------------------------------------
+
+def compute_similarity(features1, features2, weights):
+    """
+    Compute weighted similarity between two feature sets
+    Gracefully handles missing features by adjusting weights dynamically
+    """
+    total_similarity = 0.0
+    total_weight = 0.0
+
+    # Color similarity
+    if 'color' in features1 and 'color' in features2:
+        sim = color_similarity(features1['color'], features2['color'])
+        w = weights.get('color', SimilaritySearchService.FALLBACK_WEIGHTS['color'])
+        total_similarity += sim * w
+        total_weight += w
+
+    # Tamura texture similarity
+    if 'texture_tamura' in features1 and 'texture_tamura' in features2:
+        sim = tamura_similarity(features1['texture_tamura'], features2['texture_tamura'])
+        w = weights.get('texture_tamura', SimilaritySearchService.FALLBACK_WEIGHTS['texture_tamura'])
+        total_similarity += sim * w
+        total_weight += w
+
+    # Gabor texture similarity
+    if 'texture_gabor' in features1 and 'texture_gabor' in features2:
+        sim = gabor_similarity(features1['texture_gabor'], features2['texture_gabor'])
+        w = weights.get('texture_gabor', SimilaritySearchService.FALLBACK_WEIGHTS['texture_gabor'])
+        total_similarity += sim * w
+        total_weight += w
+
+    # LBP texture similarity
+    if 'texture_lbp' in features1 and 'texture_lbp' in features2:
+        sim = lbp_similarity(features1['texture_lbp'], features2['texture_lbp'])
+        w = weights.get('texture_lbp', SimilaritySearchService.FALLBACK_WEIGHTS['texture_lbp'])
+        total_similarity += sim * w
+        total_weight += w
+
+    # Hu moments similarity
+    if 'shape_hu' in features1 and 'shape_hu' in features2:
+        sim = hu_similarity(features1['shape_hu'], features2['shape_hu'])
+        w = weights.get('shape_hu', SimilaritySearchService.FALLBACK_WEIGHTS['shape_hu'])
+        total_similarity += sim * w
+        total_weight += w
+
+    # HOG similarity
+    if 'shape_hog' in features1 and 'shape_hog' in features2:
+        sim = hog_similarity(features1['shape_hog'], features2['shape_hog'])
+        w = weights.get('shape_hog', SimilaritySearchService.FALLBACK_WEIGHTS['shape_hog'])
+        total_similarity += sim * w
+        total_weight += w
+
+    # Contour orientation similarity
+    if 'shape_contour' in features1 and 'shape_contour' in features2:
+        sim = contour_similarity(features1['shape_contour'], features2['shape_contour'])
+        w = weights.get('shape_contour', SimilaritySearchService.FALLBACK_WEIGHTS['shape_contour'])
+        total_similarity += sim * w
+        total_weight += w
+
+    # Normalize by actual weight sum (handles missing features)
+    if total_weight > 0:
+        return total_similarity / total_weight
+
+    # Fallback: if no features matched, return 0
+    return 0.0
+
+
+def color_similarity(color1, color2):
+    """
+    Compute color similarity using multiple metrics
+    Combines histogram comparison + dominant color matching
+    """
+    # 1. RGB Histogram comparison (Chi-Square distance)
+    hist1 = np.array(color1.get('hist_rgb', []))
+    hist2 = np.array(color2.get('hist_rgb', []))
+
+    hist_sim = 0.0
+    if len(hist1) > 0 and len(hist2) > 0:
+        # Chi-Square distance (more discriminative than intersection)
+        epsilon = 1e-10
+        chi_square = 0.5 * np.sum(
+            ((hist1 - hist2) ** 2) / (hist1 + hist2 + epsilon)
+        )
+        # Convert distance to similarity (0=identical, higher=different)
+        hist_sim = 1.0 / (1.0 + chi_square)
+
+    # 2. Dominant color comparison
+    dom_sim = dominant_color_similarity(color1, color2)
+
+    # 3. Mean color distance
+    mean1 = np.array(color1.get('mean_rgb', [0, 0, 0]))
+    mean2 = np.array(color2.get('mean_rgb', [0, 0, 0]))
+    mean_distance = np.linalg.norm(mean1 - mean2) / 441.67  # Normalize by max RGB distance (sqrt(255^2 * 3))
+    mean_sim = 1.0 - mean_distance
+
+    # Combine (70% histogram, 20% dominant colors, 10% mean)
+    final_sim = 0.7 * hist_sim + 0.2 * dom_sim + 0.1 * mean_sim
+
+    return float(max(0.0, min(1.0, final_sim)))
+
+
+def dominant_color_similarity(color1, color2):
+    """
+    Compare dominant colors using weighted color distance
+    Considers both color values and their percentages
+    """
+    dom1 = color1.get('dominant_colors', [])
+    dom2 = color2.get('dominant_colors', [])
+
+    if not dom1 or not dom2:
+        return 0.0
+
+    # Extract top 5 dominant colors
+    colors1 = []
+    weights1 = []
+    for c in dom1[:5]:
+        colors1.append(c['rgb'])
+        weights1.append(c['percentage'] / 100.0)
+
+    colors2 = []
+    weights2 = []
+    for c in dom2[:5]:
+        colors2.append(c['rgb'])
+        weights2.append(c['percentage'] / 100.0)
+
+    colors1 = np.array(colors1)
+    weights1 = np.array(weights1)
+    colors2 = np.array(colors2)
+    weights2 = np.array(weights2)
+
+    # Compute weighted minimum color distance
+    total_distance = 0.0
+    for i, (c1, w1) in enumerate(zip(colors1, weights1)):
+        # Find closest color in second set
+        min_dist = float('inf')
+        for c2 in colors2:
+            # Euclidean distance in RGB space
+            dist = np.linalg.norm(c1 - c2) / 441.67  # Normalize
+            min_dist = min(min_dist, dist)
+        total_distance += w1 * min_dist
+
+    # Reverse: do the same from colors2 to colors1
+    for i, (c2, w2) in enumerate(zip(colors2, weights2)):
+        min_dist = float('inf')
+        for c1 in colors1:
+            dist = np.linalg.norm(c2 - c1) / 441.67
+            min_dist = min(min_dist, dist)
+        total_distance += w2 * min_dist
+
+    # Average bidirectional distance
+    total_distance /= 2.0
+
+    similarity = 1.0 - total_distance
+    return float(max(0.0, similarity))
+
+
+def tamura_similarity(tamura1, tamura2):
+    """
+    Compute Tamura feature similarity with normalization
+    Tamura features have different scales, so normalize them
+    """
+    # Extract features
+    coarse1 = tamura1.get('coarseness', 0)
+    contrast1 = tamura1.get('contrast', 0)
+    directionality1 = tamura1.get('directionality', 0)
+
+    coarse2 = tamura2.get('coarseness', 0)
+    contrast2 = tamura2.get('contrast', 0)
+    directionality2 = tamura2.get('directionality', 0)
+
+    # Compute individual similarities with appropriate scaling
+    # Coarseness: typically 0-10
+    coarse_sim = 1.0 - min(abs(coarse1 - coarse2) / 10.0, 1.0)
+
+    # Contrast: typically 0-100
+    contrast_sim = 1.0 - min(abs(contrast1 - contrast2) / 100.0, 1.0)
+
+    # Directionality: typically 0-5 (entropy-based)
+    dir_sim = 1.0 - min(abs(directionality1 - directionality2) / 5.0, 1.0)
+
+    # Weighted combination (coarseness is most important)
+    final_sim = 0.5 * coarse_sim + 0.3 * contrast_sim + 0.2 * dir_sim
+
+    return float(max(0.0, min(1.0, final_sim)))
+
+
+def gabor_similarity(gabor1, gabor2):
+    """Compute Gabor feature similarity"""
+    features1 = np.array(gabor1.get('gabor_responses', []))
+    features2 = np.array(gabor2.get('gabor_responses', []))
+
+    if len(features1) == 0 or len(features2) == 0:
+        return 0.0
+
+    # Cosine similarity
+    if np.linalg.norm(features1) > 0 and np.linalg.norm(features2) > 0:
+        features1 = features1 / np.linalg.norm(features1)
+        features2 = features2 / np.linalg.norm(features2)
+        similarity = np.dot(features1, features2)
+        return float(max(0, similarity))
+    return 0.0
+
+
+def hu_similarity(hu1, hu2):
+    """
+    Compute Hu moments similarity with improved distance metric
+    Hu moments are log-transformed, so use absolute difference
+    """
+    moments1 = np.array(hu1.get('hu_moments', []))
+    moments2 = np.array(hu2.get('hu_moments', []))
+
+    if len(moments1) == 0 or len(moments2) == 0:
+        return 0.0
+
+    # Hu moments can have very different scales, so normalize each moment
+    # Use weighted distance where earlier moments (more significant) have higher weight
+    weights = SimilaritySearchService.HU_MOMENT_WEIGHTS  # 7 Hu moments
+
+    # Absolute difference (since Hu moments are log-transformed)
+    abs_diff = np.abs(moments1 - moments2)
+
+    # Weighted Euclidean distance
+    weighted_distance = np.sqrt(np.sum(weights * (abs_diff ** 2)))
+
+    # Convert to similarity with adaptive scaling
+    # Scale factor based on empirical observation (Hu moments typically range 0-20 after log transform)
+    similarity = 1.0 / (1.0 + weighted_distance / 10.0)
+
+    return float(max(0.0, min(1.0, similarity)))
+
+
+def hog_similarity(hog1, hog2):
+    """Compute HOG feature similarity"""
+    features1 = np.array(hog1.get('hog', []))
+    features2 = np.array(hog2.get('hog', []))
+
+    if len(features1) == 0 or len(features2) == 0:
+        return 0.0
+
+    # Cosine similarity
+    if np.linalg.norm(features1) > 0 and np.linalg.norm(features2) > 0:
+        features1 = features1 / np.linalg.norm(features1)
+        features2 = features2 / np.linalg.norm(features2)
+        similarity = np.dot(features1, features2)
+        return float(max(0, similarity))
+    return 0.0
+
+
+def lbp_similarity(lbp1, lbp2):
+    """
+    Compute LBP texture similarity using Chi-Square distance
+    More discriminative than simple histogram intersection
+    """
+    hist1 = np.array(lbp1.get('lbp_hist', []))
+    hist2 = np.array(lbp2.get('lbp_hist', []))
+
+    if len(hist1) == 0 or len(hist2) == 0:
+        return 0.0
+
+    # Chi-Square distance for texture patterns
+    epsilon = 1e-10
+    chi_square = 0.5 * np.sum(
+        ((hist1 - hist2) ** 2) / (hist1 + hist2 + epsilon)
+    )
+
+    # Convert to similarity
+    similarity = 1.0 / (1.0 + chi_square)
+
+    # Also consider mean and std for texture roughness
+    mean1 = lbp1.get('lbp_mean', 0)
+    mean2 = lbp2.get('lbp_mean', 0)
+    std1 = lbp1.get('lbp_std', 0)
+    std2 = lbp2.get('lbp_std', 0)
+
+    # Normalize mean and std differences
+    mean_diff = abs(mean1 - mean2) / 255.0  # Normalize by max LBP value
+    std_diff = abs(std1 - std2) / 100.0  # Approximate normalization
+
+    mean_std_sim = 1.0 - (mean_diff + std_diff) / 2.0
+
+    # Combine: 80% histogram, 20% mean/std
+    final_sim = 0.8 * similarity + 0.2 * mean_std_sim
+
+    return float(max(0.0, min(1.0, final_sim)))
+
+
+def contour_similarity(contour1, contour2):
+    """
+    Compute contour orientation similarity
+    Uses both histogram and orientation statistics
+    """
+    hist1 = np.array(contour1.get('orientation_hist', []))
+    hist2 = np.array(contour2.get('orientation_hist', []))
+
+    if len(hist1) == 0 or len(hist2) == 0:
+        return 0.0
+
+    # Chi-Square distance for orientation histogram
+    epsilon = 1e-10
+    chi_square = 0.5 * np.sum(
+        ((hist1 - hist2) ** 2) / (hist1 + hist2 + epsilon)
+    )
+    hist_sim = 1.0 / (1.0 + chi_square)
+
+    # Compare main orientation angles
+    main1 = contour1.get('main_orientation', 0)
+    main2 = contour2.get('main_orientation', 0)
+
+    # Angular difference (wrap around at 180 degrees)
+    angle_diff = abs(main1 - main2)
+    if angle_diff > 90:  # Wrap around
+        angle_diff = 180 - angle_diff
+
+    angle_sim = 1.0 - (angle_diff / 90.0)  # Normalize to [0, 1]
+
+    # Compare orientation variance (how spread out the orientations are)
+    var1 = contour1.get('orientation_variance', 0)
+    var2 = contour2.get('orientation_variance', 0)
+    var_diff = abs(var1 - var2)
+    var_sim = 1.0 / (1.0 + var_diff)
+
+    # Combine: 60% histogram, 25% main angle, 15% variance
+    final_sim = 0.6 * hist_sim + 0.25 * angle_sim + 0.15 * var_sim
+
+    return float(max(0.0, min(1.0, final_sim)))
+
+
+# ----------------------------------------------------------------------
+# Tests
+# ----------------------------------------------------------------------
+
+WEIGHT_PROFILES = [
+    {},
+    {'color': 0.5, 'shape_hog': 0.3, 'texture_lbp': 0.2},
+    {'shape_hu': 1.0, 'shape_contour': 0.5, 'texture_tamura': 0.25, 'texture_gabor': 0.25}
+]
+
+
+def build_objects(n_objects=120, seed=0):
+    """Stored service plus the raw feature dicts, some with missing families"""
+    rng = np.random.default_rng(seed)
+    service = SimilaritySearchService(
+        f'{tempfile.mkdtemp()}/features.store', result_cache_size=0
+    )
+    objects = []
+    with service.batch():
+        for i in range(n_objects):
+            features = random_features(rng)
+            if i % 7 == 0:
+                del features['texture_lbp']
+            if i % 11 == 0:
+                features['color']['dominant_colors'] = []
+            if i % 13 == 0:
+                del features['shape_hog']
+            image_id = f'img-{i:05d}'
+            service.save_detections(image_id, [
+                {'bbox': [0, 0, 10, 10], 'confidence': 0.5, 'class': 'car', 'class_id': 0}
+            ])
+            service.save_features(image_id, 0, features)
+            objects.append(features)
+    rows = np.array([service.store.row_of[(f'img-{i:05d}', 0)] for i in range(n_objects)])
+    return service, objects, rows
+
+
+def test_score_rows_matches_reference():
+    """One query against every row"""
+    service, objects, rows = build_objects()
+    for weights in WEIGHT_PROFILES:
+        for q in range(0, len(objects), 9):
+            query = service.store.encode(objects[q])
+            scores = service._score_rows(query, rows, weights)
+            expected = [compute_similarity(objects[q], features, weights) for features in objects]
+            assert np.allclose(scores, expected, atol=1e-4), f'query {q}, weights {weights}'
+    print('✅ _score_rows matches the reference scorer')
+
+
+def test_score_rows_batch_matches_reference():
+    """Many queries against every row in one call"""
+    service, objects, rows = build_objects(seed=1)
+    picked = list(range(0, len(objects), 5))
+    queries = [service.store.encode(objects[q]) for q in picked]
+    for weights in WEIGHT_PROFILES:
+        scores = service._score_rows_batch(queries, rows, weights)
+        for q, row_scores in zip(picked, scores):
+            expected = [compute_similarity(objects[q], features, weights) for features in objects]
+            assert np.allclose(row_scores, expected, atol=1e-4), f'query {q}, weights {weights}'
+    print('✅ _score_rows_batch matches the reference scorer')
+
+
+def main():
+    test_score_rows_matches_reference()
+    test_score_rows_batch_matches_reference()
+
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,8 @@ function App() {
   const [showFeatures, setShowFeatures] = useState(false)
   const [currentFeatures, setCurrentFeatures] = useState(null)
   const [toast, setToast] = useState(null)
+  // Last search's object + query token: re-weighting only recombines cached scores
+  const [searchSession, setSearchSession] = useState(null)
 
   // NEW: Step workflow state
   const [currentStep, setCurrentStep] = useState(1)
@@ -173,10 +175,15 @@ function App() {
   
   try {
     const objectId = selectedObjects[0]
+    const session = searchSession &&
+      searchSession.imageId === imageId && searchSession.objectId === objectId
+      ? searchSession : null
     
-    // Extract features first (ensure they exist)
-    console.log('🔧 Ensuring features are extracted...', { imageId, objectId })
-    await api.extractFeatures(imageId, objectId)
+    // Extract features first (ensure they exist); re-extracting would invalidate the token
+    if (!session) {
+      console.log('🔧 Ensuring features are extracted...', { imageId, objectId })
+      await api.extractFeatures(imageId, objectId)
+    }
     
     // ✅ FIX: Handle null weights (automatic mode)
     let apiWeights = null
@@ -196,8 +203,12 @@ function App() {
     
     console.log('🔍 Searching with weights:', apiWeights ? 'custom' : 'automatic')
     
-    // Search
-    const searchResult = await api.searchSimilar(imageId, objectId, 20, apiWeights)
+    // Search (custom weights come from the weights panel: keep the scores so
+    // the next weight change is a re-rank instead of a rescan)
+    const searchResult = await api.searchSimilar(
+      imageId, objectId, 20, apiWeights, session ? session.queryToken : null, apiWeights !== null
+    )
+    setSearchSession({ imageId, objectId, queryToken: searchResult.query_token || null })
     
     console.log('✅ Search results:', searchResult.similar_objects.length)
     
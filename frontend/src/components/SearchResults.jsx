@@ -53,7 +53,8 @@ function SearchResults({ results, isLoading }) {
           <div key={result.id} className="image-card bg-white shadow-md">
 
             <img 
-              src={api.getImageUrl(result.filename)}
+              src={api.getImageUrl(result.filename, 512)}
+              loading="lazy"
               alt={`${result.className} - ${result.similarity}% match`}
               className="w-full object-cover"  // Removed h-56, now controlled by CSS
               onError={(e) => {
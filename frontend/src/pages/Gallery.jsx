@@ -6,9 +6,16 @@ import api from '../services/api'
 import ImageEditor from '../components/ImageEditor'
 import ConfirmModal from '../components/ConfirmModal'
 
+const PAGE_SIZE = 60
+const THUMBNAIL_WIDTH = 256
+
 function Gallery({ onUseAsQuery, showToast }) {
   const [images, setImages] = useState([])
   const [loading, setLoading] = useState(true)
+  const [loadingMore, setLoadingMore] = useState(false)
+  const [nextCursor, setNextCursor] = useState(null)
+  const [total, setTotal] = useState(0)
+  const [filters, setFilters] = useState({ sort: 'newest', className: null, hasFeatures: null })
   const [selectedImages, setSelectedImages] = useState([])
   const [stats, setStats] = useState(null)
   const [editingImage, setEditingImage] = useState(null) // { imageId, imageUrl }
@@ -16,15 +23,21 @@ function Gallery({ onUseAsQuery, showToast }) {
   const [confirmModal, setConfirmModal] = useState(null)
 
   useEffect(() => {
-    loadGallery()
     loadStats()
   }, [])
 
+  useEffect(() => {
+    loadGallery()
+  }, [filters])
+
+  // First page for the current filters (also used to refresh after changes)
   const loadGallery = async () => {
     setLoading(true)
     try {
-      const result = await api.getAllImages()
+      const result = await api.getImages({ limit: PAGE_SIZE, ...filters })
       setImages(result.images || [])
+      setNextCursor(result.next_cursor)
+      setTotal(result.total || 0)
     } catch (error) {
       console.error('Failed to load gallery:', error)
     } finally {
@@ -32,6 +45,26 @@ function Gallery({ onUseAsQuery, showToast }) {
     }
   }
 
+  const loadMore = async () => {
+    if (!nextCursor) return
+    setLoadingMore(true)
+    try {
+      const result = await api.getImages({ limit: PAGE_SIZE, cursor: nextCursor, ...filters })
+      setImages(prev => [...prev, ...(result.images || [])])
+      setNextCursor(result.next_cursor)
+      setTotal(result.total || 0)
+    } catch (error) {
+      console.error('Failed to load more images:', error)
+    } finally {
+      setLoadingMore(false)
+    }
+  }
+
+  const updateFilter = (name, value) => {
+    setSelectedImages([])
+    setFilters(prev => ({ ...prev, [name]: value }))
+  }
+
   const loadStats = async () => {
     try {
       const result = await api.getStats()
@@ -260,7 +293,7 @@ function Gallery({ onUseAsQuery, showToast }) {
           <div>
             <h2 className="text-2xl font-bold text-slate-800 mb-2">📸 Image Gallery</h2>
             <p className="text-slate-600">
-              {images.length} images • {stats?.total_objects || 0} objects detected • {stats?.total_features_extracted || 0} features extracted
+              {total} images • {stats?.total_objects || 0} objects detected • {stats?.total_features_extracted || 0} features extracted
             </p>
           </div>
           <ImageIcon className="w-12 h-12 text-blue-600 opacity-50" />
@@ -273,21 +306,67 @@ function Gallery({ onUseAsQuery, showToast }) {
           <h3 className="font-bold text-slate-800 mb-4 text-lg">Detected Object Classes</h3>
           <div className="flex flex-wrap gap-2">
             {Object.entries(stats.class_distribution).map(([className, count]) => (
-              <div key={className} className="px-4 py-2 bg-gradient-to-r from-blue-100 to-indigo-100 text-blue-700 rounded-full text-sm font-semibold shadow-sm hover:shadow-md transition-shadow">
+              <button
+                key={className}
+                onClick={() => updateFilter('className', filters.className === className ? null : className)}
+                className={`px-4 py-2 rounded-full text-sm font-semibold shadow-sm hover:shadow-md transition-shadow ${
+                  filters.className === className
+                    ? 'bg-blue-600 text-white'
+                    : 'bg-gradient-to-r from-blue-100 to-indigo-100 text-blue-700'
+                }`}
+              >
                 {className}: {count}
-              </div>
+              </button>
             ))}
           </div>
         </div>
       )}
 
+      {/* Filters */}
+      <div className="flex flex-wrap items-center gap-3">
+        <select
+          value={filters.sort}
+          onChange={(e) => updateFilter('sort', e.target.value)}
+          className="px-4 py-2 bg-white border border-slate-200 rounded-xl text-sm font-semibold text-slate-700 shadow-sm"
+        >
+          <option value="newest">Newest first</option>
+          <option value="oldest">Oldest first</option>
+        </select>
+        <select
+          value={filters.hasFeatures === null ? 'all' : String(filters.hasFeatures)}
+          onChange={(e) => updateFilter('hasFeatures', e.target.value === 'all' ? null : e.target.value === 'true')}
+          className="px-4 py-2 bg-white border border-slate-200 rounded-xl text-sm font-semibold text-slate-700 shadow-sm"
+        >
+          <option value="all">All images</option>
+          <option value="true">With features</option>
+          <option value="false">Without features</option>
+        </select>
+        {filters.className && (
+          <button
+            onClick={() => updateFilter('className', null)}
+            className="px-4 py-2 bg-blue-600 text-white rounded-xl text-sm font-semibold shadow-sm hover:bg-blue-700"
+          >
+            Class: {filters.className} ✕
+          </button>
+        )}
+      </div>
+
       {/* Gallery Grid */}
       {images.length === 0 ? (
         <div className="bg-white rounded-2xl border border-slate-200 shadow-lg">
           <div className="text-center py-20">
             <ImageIcon className="w-24 h-24 text-slate-300 mx-auto mb-4" />
-            <h3 className="text-xl font-bold text-slate-800 mb-2">No Images Yet</h3>
-            <p className="text-slate-600">Upload images to see them here</p>
+            {filters.className || filters.hasFeatures !== null ? (
+              <>
+                <h3 className="text-xl font-bold text-slate-800 mb-2">No Matching Images</h3>
+                <p className="text-slate-600">No images match the current filters</p>
+              </>
+            ) : (
+              <>
+                <h3 className="text-xl font-bold text-slate-800 mb-2">No Images Yet</h3>
+                <p className="text-slate-600">Upload images to see them here</p>
+              </>
+            )}
           </div>
         </div>
       ) : (
@@ -304,7 +383,8 @@ function Gallery({ onUseAsQuery, showToast }) {
             >
               <div className="aspect-square bg-slate-100">
                 <img
-                  src={api.getImageUrl(image.filename)}
+                  src={api.getImageUrl(image.filename, THUMBNAIL_WIDTH)}
+                  loading="lazy"
                   alt={`Image ${image.image_id}`}
                   className="w-full h-full object-cover"
                   onError={(e) => {
@@ -333,6 +413,20 @@ function Gallery({ onUseAsQuery, showToast }) {
           ))}
         </div>
       )}
+
+      {/* Pagination */}
+      {nextCursor && (
+        <div className="flex justify-center">
+          <button
+            onClick={loadMore}
+            disabled={loadingMore}
+            className="flex items-center space-x-2 px-6 py-3 bg-white border border-slate-200 rounded-xl font-semibold text-slate-700 shadow-md hover:shadow-lg transition-all disabled:opacity-50"
+          >
+            {loadingMore && <Loader2 className="w-5 h-5 animate-spin" />}
+            <span>Load more ({images.length} of {total})</span>
+          </button>
+        </div>
+      )}
     </div>
   )
 }
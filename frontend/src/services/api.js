@@ -38,9 +38,17 @@ class ApiService {
     return response.json();
   }
 
-  // Get all images
-  async getAllImages() {
-    const response = await fetch(`${API_BASE_URL}/images`);
+  // Get one page of images ({ images, next_cursor, total })
+  async getImages({ limit, cursor, sort = 'newest', className, hasFeatures } = {}) {
+    const params = new URLSearchParams({ sort });
+    if (limit) params.set('limit', limit);
+    if (cursor) params.set('cursor', cursor);
+    if (className) params.set('class', className);
+    if (hasFeatures !== undefined && hasFeatures !== null) params.set('has_features', hasFeatures);
+    
+    // no-cache: the browser revalidates with If-None-Match, unchanged pages come back as 304
+    const response = await fetch(`${API_BASE_URL}/images?${params}`, { cache: 'no-cache' });
+    if (!response.ok) throw new Error('Failed to load images');
     return response.json();
   }
 
@@ -96,7 +104,11 @@ class ApiService {
   }
 
   // Search for similar objects
-  async searchSimilar(queryImageId, queryObjectId, topK = 10, weights = null) {
+  // (reweightable keeps the scan's scores server-side and returns a query_token;
+  // the token re-ranks with new weights without a rescan. Only ask for it when the
+  // user is tuning weights: it bypasses the cached / indexed fast paths)
+  async searchSimilar(queryImageId, queryObjectId, topK = 10, weights = null, queryToken = null,
+                      reweightable = false) {
     const response = await fetch(`${API_BASE_URL}/search/similar`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
@@ -105,6 +117,8 @@ class ApiService {
         query_object_id: queryObjectId,
         top_k: topK,
         weights: weights,
+        reweightable: reweightable,
+        query_token: queryToken,
       }),
     });
     
@@ -119,8 +133,9 @@ class ApiService {
     return response.json();
   }
 
-  // Get image URL
-  getImageUrl(filename) {
+  // Get image URL (with a width: a cached, resized WebP derivative)
+  getImageUrl(filename, width) {
+    if (width) return `${API_BASE_URL}/images/file/${filename}?w=${width}`;
     return `${API_BASE_URL}/images/file/${filename}`;
   }
 